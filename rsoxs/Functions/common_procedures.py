@@ -56,6 +56,7 @@ from .rsoxs_plans import do_rsoxs
 run_report(__file__)
 
 
+## alignment/epu_tables.buildeputable_fly builds the same table with fitted peaks, appends each energy as it is measured, and can resume
 def buildeputable(
     start,
     stop,
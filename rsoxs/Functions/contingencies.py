@@ -1,6 +1,7 @@
 import bluesky.plan_stubs as bps
 import datetime, os
 import logging
+import threading
 
 global no_notifications_until
 from ..startup import RE
@@ -203,6 +204,21 @@ def temp_ok_notice():
     )
 
 
+def telemetry_notice(event):
+    ## Hook of the detector telemetry (see devices/detector_telemetry.py), for degradation that has not reached a suspender threshold yet
+    if event["event"] not in ("readout_drift", "file_write_slow", "temperature_drift", "cooling_off"):
+        return
+    ## Sent from a thread, since hooks run in the detector and monitor callbacks
+    threading.Thread(
+        target=send_notice,
+        args=(
+            f"{get_user_slack_tag()} SST-1 detector telemetry: {event['event']}",
+            event["message"] + "\rScans continue, but the detector may need attention.",
+        ),
+        daemon=True,
+    ).start()
+
+
 def beamdown_notice():
     send_notice(
         "SST-1 has lost beam",
@@ -86,6 +86,7 @@ from bluesky.utils import ensure_generator, short_uid as _short_uid, single_gen
 from bluesky.preprocessors import plan_mutator
 
 
+from ..plans.adaptive_energy import adaptive_energy_passes
 from .per_steps import (
     take_exposure_corrected_reading,
     one_nd_sticky_exp_step
@@ -135,6 +136,46 @@ def energy_step_scan(energies, **kwargs):
         final_plan= post_scan_hardware_reset()
     )
 
+def adaptive_energy_scan(
+    energy_parameters,
+    point_budget=None,
+    passes=3,
+    signal=beamstop_waxs,
+    izero=izero_mesh,
+    energy_step_min=0.05,
+    **kwargs
+):
+    """
+    Energy step scan that starts from a coarse grid and adds energies only where the I0-normalized signal changes quickly
+
+    Each pass is a separate energy_step_scan run, so all the usual keyword arguments (dwell, extra_dets, group_name, md, etc.) can be used.
+
+    Parameters
+    ----------
+    energy_parameters : str or tuple
+        Coarse grid, as a name in energy_list_parameters or (start, step, stop, step, stop, ...)
+    point_budget : int, optional
+        Total number of energies over all passes.  Defaults to twice the coarse grid.
+    passes : int
+        Total number of passes, including the coarse one
+    signal, izero : ophyd device
+        Detectors used to decide where to add points.  Both must be read in the scan.
+    energy_step_min : float
+        Smallest spacing in eV that refinement goes down to
+    """
+    _md = {"adaptive_energy_list_parameters": str(energy_parameters)}
+    _md.update(kwargs.pop("md", None) or {})
+    energies, spectrum = yield from adaptive_energy_passes(
+        list_scan=lambda energies, per_step: energy_step_scan(energies, per_step=per_step, md=_md, **kwargs),
+        energy_parameters=energy_parameters,
+        signal_name=signal.name,
+        izero_name=None if izero is None else izero.name,
+        point_budget=point_budget,
+        passes=passes,
+        energy_step_min=energy_step_min,
+    )
+    return energies, spectrum
+
 def step_scan_energy(
     energies=None,
     detectors=None,
@@ -771,13 +812,9 @@ def NEXAFS_fly_scan_core(
     # validate inputs
     valid = True
     validation = ""
-    energies = np.empty(0)
-    speeds = []
     scan_params = deepcopy(scan_params)
-    for scanparam in scan_params:
-        (sten, enden, speed) = scanparam
-        energies = np.append(energies, np.linspace(sten, enden, 10))
-        speeds.append(speed)
+    speeds = [speed for (sten, enden, speed) in scan_params]
+    energies = np.concatenate([np.linspace(sten, enden, 10) for (sten, enden, speed) in scan_params]) if len(scan_params) > 0 else np.empty(0)
     if len(energies) < 10:
         valid = False
         validation += f"scan parameters {scan_params} could not be parsed\n"
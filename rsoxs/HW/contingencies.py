@@ -12,6 +12,7 @@ from ..Functions.contingencies import (
     det_down_notice,
     temp_bad_notice,
     temp_ok_notice,
+    telemetry_notice,
     amp_fault_clear_19,
     amp_fault_clear_20,
     amp_fault_clear_21,
@@ -39,6 +40,7 @@ from ..HW.detectors import (
     stop_det_cooling,
     dark_frame_preprocessor_waxs_spirals,
     dark_frame_preprocessor_waxs,
+    dark_frame_scheduler_waxs,
     # dark_frame_preprocessor_saxs,
 )
 from ..startup import RE
@@ -251,6 +253,8 @@ def turn_on_checks():
     # RE.install_suspender(suspend_saxs_temp_high)
     RE.install_suspender(suspendx)
     RE.install_suspender(suspend_control)
+    ## Early warnings from the detector telemetry, below the thresholds of the suspenders
+    waxs_det.telemetry.add_hook(telemetry_notice)
     logger.addHandler(safe_handler)
     logger.addHandler(mail_handler)
 
@@ -271,6 +275,7 @@ def turn_off_checks():
     # RE.remove_suspender(suspend_saxs_temp_high)
     RE.remove_suspender(suspendx)
     RE.remove_suspender(suspend_control)
+    waxs_det.telemetry.remove_hook(telemetry_notice)
     logger.removeHandler(safe_handler)
     logger.removeHandler(mail_handler)
 
@@ -284,7 +289,14 @@ def waxs_spiral_mode():
        RE.preprocessors.remove(dark_frame_preprocessor_waxs)
    except ValueError:
        pass
+   try:
+       RE.preprocessors.remove(dark_frame_scheduler_waxs)
+   except ValueError:
+       pass
    RE.preprocessors.append(dark_frame_preprocessor_waxs_spirals)
+   ## After the preprocessor, so the preprocessor does not see the triggers of the darks the scheduler takes
+   dark_frame_scheduler_waxs.preprocessor = dark_frame_preprocessor_waxs_spirals
+   RE.preprocessors.append(dark_frame_scheduler_waxs)
 
 
 def waxs_normal_mode():
@@ -296,7 +308,14 @@ def waxs_normal_mode():
        RE.preprocessors.remove(dark_frame_preprocessor_waxs)
    except ValueError:
        pass
+   try:
+       RE.preprocessors.remove(dark_frame_scheduler_waxs)
+   except ValueError:
+       pass
    RE.preprocessors.append(dark_frame_preprocessor_waxs)
+   ## After the preprocessor, so the preprocessor does not see the triggers of the darks the scheduler takes
+   dark_frame_scheduler_waxs.preprocessor = dark_frame_preprocessor_waxs
+   RE.preprocessors.append(dark_frame_scheduler_waxs)
 
 
 # install preprocessors
@@ -4,6 +4,8 @@ from bluesky.preprocessors import make_decorator
 import bluesky_darkframes
 
 from ..devices.detectors import RSOXSGreatEyesDetector, SimGreatEyes
+from ..devices.dark_frames import DarkFrameLibrary, PersistentDarkFramePreprocessor
+from ..devices.dark_scheduler import DarkFrameScheduler
 from nbs_bl.hw import (
     en, 
     shutter_control, 
@@ -179,8 +181,20 @@ def dark_plan(det):
 ## locked_signals
 ## For normal operation, if the motor positions for the locked_signals items change, then a new dark should be taken.
 ## In spirals mode, taking a dark for each sample position would take a lot of extra time, so the sam_X, sam_Th, and sam_Y setpoints are removed.
-
-dark_frame_preprocessor_waxs = bluesky_darkframes.DarkFramePreprocessor(
+## waxs_det.accumulated_frames is locked because darks are summed over the same number of exposures as the light frames (see FrameAccumulator).
+## The readout region (cam min and size) is locked like the binning, since it changes with the detector mode of each acquisition (see detector_modes).
+
+## library
+## Darks are also saved on disk with the CCD temperature.  When the in-memory cache has no dark, a dark from the library is used if it is younger than
+## the max_age of the preprocessor (or library_max_age, if given) and within the library temperature_tolerance, or one is synthesized from darks
+## at other exposure times.  Only then is a new dark taken.  The library max_age only sets how long darks are kept on disk (prune).
+## The directory is created when the first dark is saved, so importing this does not need it to be writable.
+dark_frame_library_waxs = DarkFrameLibrary()
+
+dark_frame_preprocessor_waxs = PersistentDarkFramePreprocessor(
+    library=dark_frame_library_waxs,
+    temperature_signal=waxs_det.cam.temperature_actual,
+    exposure_signal=waxs_det.cam.acquire_time,
     dark_plan=dark_plan,
     detector=waxs_det,
     max_age=180,
@@ -189,6 +203,11 @@ dark_frame_preprocessor_waxs = bluesky_darkframes.DarkFramePreprocessor(
         Det_W.user_setpoint,
         waxs_det.cam.bin_x,
         waxs_det.cam.bin_y,
+        waxs_det.accumulated_frames,
+        waxs_det.cam.min_x,
+        waxs_det.cam.min_y,
+        waxs_det.cam.size.size_x,
+        waxs_det.cam.size.size_y,
         sam_X.user_setpoint,
         sam_Th.user_setpoint,
         sam_Y.user_setpoint,
@@ -196,8 +215,10 @@ dark_frame_preprocessor_waxs = bluesky_darkframes.DarkFramePreprocessor(
     limit=100,
 )
 
-dark_frame_preprocessor_waxs_spirals = bluesky_darkframes.DarkFramePreprocessor(
-
+dark_frame_preprocessor_waxs_spirals = PersistentDarkFramePreprocessor(
+    library=dark_frame_library_waxs,
+    temperature_signal=waxs_det.cam.temperature_actual,
+    exposure_signal=waxs_det.cam.acquire_time,
     dark_plan=dark_plan,
     detector=waxs_det,
     max_age=120,
@@ -206,10 +227,24 @@ dark_frame_preprocessor_waxs_spirals = bluesky_darkframes.DarkFramePreprocessor(
         Det_W.user_setpoint,
         waxs_det.cam.bin_x,
         waxs_det.cam.bin_y,
+        waxs_det.accumulated_frames,
+        waxs_det.cam.min_x,
+        waxs_det.cam.min_y,
+        waxs_det.cam.size.size_x,
+        waxs_det.cam.size.size_y,
     ],
     limit=10,
 )
 
+## scheduler
+## Sample moves, WAXS detector moves, and grating changes are made with the shutter closed.  The scheduler takes the dark for the state after the move
+## while the move is running, if that dark is missing or would be too old in less than lead_time, so the preprocessor finds it instead of stopping for it.
+## It is installed after the preprocessor in use (see waxs_normal_mode and waxs_spiral_mode), and its decisions are in dark_frame_scheduler_waxs.decisions.
+dark_frame_scheduler_waxs = DarkFrameScheduler(
+    dark_frame_preprocessor_waxs,
+    window_devices=[sam_X, sam_Y, sam_Th, Det_W, en.monoen.gratingx],
+    lead_time=60,
+)
 
 ## TODO: It doesn't seem like this is used elsewhere in the code, so test, delete, and/or consolidate more meaningfully elsewhere.
 dark_frames_enable_waxs = make_decorator(dark_frame_preprocessor_waxs)()
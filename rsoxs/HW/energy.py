@@ -1,11 +1,9 @@
-import bluesky.plan_stubs as bps
 import bluesky.plans as bp
 from sst_base.energy import (
     EnPos,
     base_set_polarization,
 )
 from nbs_bl.hw import (
-    psh4,
     en,
     grating,
     mirror2,
@@ -16,6 +14,8 @@ from nbs_bl.hw import (
     sam_Y
 )
 from ophyd import EpicsSignal
+from .epu_gap_model import get_model_gap, get_model_speed_offset, epuGapModels
+from .grating_state import get_grating_state_manager
 from nbs_bl.printing import run_report
 # from ..startup import bec
 
@@ -89,60 +89,16 @@ def set_polarization(pol):
 
 
 def base_grating_to_250(mono_en, en):
-    type = mono_en.gratingx.readback.get()
-    if "250l/mm" in type:
-        print("the grating is already at 250 l/mm")
-        return 0  # the grating is already here
-    print("Moving the grating to 250 l/mm.  This will take a minute...")
-    yield from psh4.close()
-    yield from bps.abs_set(mono_en.gratingx, 2, wait=True)
-    # yield from bps.sleep(60)
-    # yield from bps.mv(mirror2.user_offset, 0.04) #0.0315)
-    # yield from bps.mv(grating.user_offset, -0.0874)#-0.0959)
-    # yield from bps.mv(en.m3offset, 7.90)
-    yield from bps.mv(mono_en.cff, 1.385)
-    yield from bps.mv(en, 270)
-    yield from psh4.open()
-    print("the grating is now at 250 l/mm signifigant higher order")
-    return 1
+    ## The grating state is cached by a monitored subscription, so this is a no-op if the grating is already here
+    return (yield from get_grating_state_manager(mono_en, en).move_to("250"))
 
 
 def base_grating_to_1200(mono_en, en):
-    type = mono_en.gratingx.readback.get()
-    if "1200" in type:
-        print("the grating is already at 1200 l/mm")
-        return 0  # the grating is already here
-    print("Moving the grating to 1200 l/mm.  This will take a minute...")
-    yield from psh4.close()
-    yield from bps.abs_set(mono_en.gratingx, 9, wait=True)
-    # yield from bps.sleep(60)
-    # yield from bps.mv(mirror2.user_offset, 0.2044) #0.1962) #0.2052) # 0.1745)  # 8.1264)
-    # yield from bps.mv(grating.user_offset, 0.0769) #0.0687) # 0.0777) # 0.047)  # 7.2964)  # 7.2948)#7.2956
-    yield from bps.mv(mono_en.cff, 1.7)
-    # yield from bps.mv(en.m3offset, 7.791)
-    yield from bps.mv(en, 270)
-    yield from psh4.open()
-    print("the grating is now at 1200 l/mm")
-    return 1
+    return (yield from get_grating_state_manager(mono_en, en).move_to("1200"))
 
 
 def base_grating_to_rsoxs(mono_en, en):
-    type = mono_en.gratingx.readback.get()
-    if "RSoXS" in type:
-        print("the grating is already at RSoXS")
-        return 0  # the grating is already here
-    print("Moving the grating to RSoXS 250 l/mm.  This will take a minute...")
-    yield from psh4.close()
-    yield from bps.abs_set(mono_en.gratingx, 10, wait=True)
-    # yield from bps.sleep(60)
-    # yield from bps.mv(mirror2.user_offset, 0.2044) #0.1962) #0.2052) # 0.1745)  # 8.1264)
-    # yield from bps.mv(grating.user_offset, 0.0769) #0.0687) # 0.0777) # 0.047)  # 7.2964)  # 7.2948)#7.2956
-    # yield from bps.mv(mono_en.cff, 1.7)
-    # yield from bps.mv(en.m3offset, 7.87)
-    yield from bps.mv(en, 270)
-    yield from psh4.open()
-    print("the grating is now at RSoXS 250 l/mm with low higher order")
-    return 1
+    return (yield from get_grating_state_manager(mono_en, en).move_to("rsoxs"))
 
 
 
@@ -252,13 +208,73 @@ def grating_to_rsoxs(hopgx=None,hopgy=None,hopgtheta=None):
 #     bec.disable_plots()
 #     Sample_TEY.kind='normal'
 
-speed_offset_factor = 30
+speed_offset_factor = 30 ## um per eV/s, used when no speed model is registered for the polarization and harmonic
 
-def get_gap_offset(start,stop,speed):
+def get_gap_offset(start,stop,speed,polarization=None,harmonic=1):
+    offset = None
+    if polarization is not None:
+        offset = get_model_speed_offset(speed, polarization, harmonic)
+    if offset is None:
+        offset = abs(speed) * speed_offset_factor
     if stop>start:
-        return speed * speed_offset_factor
+        return offset
     else:
-        return -speed * speed_offset_factor
+        return -offset
+
+
+def set_fly_gap_offsets(segments, polarization, energy_motor=en):
+    ## Fly segments (start, stop, speed) whose speed-dependent gap offset (get_gap_offset) is added to the gaps the energy pseudo-motor calculates until clear_fly_gap_offsets.
+    ## The harmonic is read once here rather than on every gap calculation.
+    energy_motor._fly_segments = [tuple(segment) for segment in segments]
+    energy_motor._fly_polarization = polarization
+    energy_motor._fly_harmonic = int(energy_motor.harmonic.get()) if hasattr(energy_motor, "harmonic") else 1
+    energy_motor._fly_energy_last = None
+
+
+def clear_fly_gap_offsets(energy_motor=en):
+    energy_motor._fly_segments = None
+
+
+def get_fly_gap_offset(energy, energy_motor=en):
+    ## Gap offset of the fly segment containing energy, 0 when not flying.  Segments flown in both directions (cycles) are told apart by the direction the energy last moved.
+    segments = getattr(energy_motor, "_fly_segments", None)
+    if not segments: return 0
+    energyLast = energy_motor._fly_energy_last
+    energy_motor._fly_energy_last = energy
+    direction = 0 if energyLast is None or energy == energyLast else (1 if energy > energyLast else -1)
+    for start, stop, speed in segments:
+        if not min(start, stop) <= energy <= max(start, stop): continue
+        if direction != 0 and direction != (1 if stop > start else -1): continue
+        return get_gap_offset(start, stop, speed, energy_motor._fly_polarization, energy_motor._fly_harmonic)
+    return 0
+
+
+def use_gap_models(energy_motor=en):
+    ## Makes the energy pseudo-motor use registered gap models, falling back to its own gap calculation where no model applies.
+    ## Opt-in: nothing changes until this is called, e.g., use_gap_models(en) after registering or loading models.  stop_using_gap_models undoes it.
+    ## Models are looked up on every call, so register_gap_model swaps them in without reinstalling.  The harmonic is only read when a model is registered.
+    ## While flying (set_fly_gap_offsets), the speed offset of the segment is added.
+    if getattr(energy_motor, "_gap_builtin", None) is not None: return
+    gap_builtin = energy_motor.gap
+    def gap(energy, pol, locked, sim=0):
+        gapValue = None
+        if not sim and len(epuGapModels) > 0:
+            gapValue = get_model_gap(energy, pol, int(energy_motor.harmonic.get()))
+        if gapValue is None:
+            gapValue = gap_builtin(energy, pol, locked, sim)
+        if not sim:
+            gapValue = gapValue + get_fly_gap_offset(energy, energy_motor)
+        return gapValue
+    energy_motor._gap_builtin = gap_builtin
+    energy_motor.gap = gap
+
+
+def stop_using_gap_models(energy_motor=en):
+    ## Restores the gap calculation of the energy pseudo-motor
+    if getattr(energy_motor, "_gap_builtin", None) is None: return
+    energy_motor.gap = energy_motor._gap_builtin
+    energy_motor._gap_builtin = None
+    clear_fly_gap_offsets(energy_motor)
 
 
 
@@ -0,0 +1,199 @@
+## Fitted EPU gap models that replace the fixed gap polynomials and the constant speed_offset_factor.
+## Models are fit per polarization and harmonic from calibration tables (Energies and EPUGaps columns, as written by buildeputable), checked with a residual report, and registered in epuGapModels.
+## Once use_gap_models in HW/energy.py is called, the energy pseudo-motor looks models up each time it calculates a gap, so registering a new model swaps it in at runtime without reloading anything.
+
+import json
+
+import numpy as np
+from numpy.polynomial import Polynomial
+
+
+gapLimits = (14000.0, 100000.0) ## um, same limits as the EPU gap calculation in the energy pseudo-motor
+polarizationsCircular = (-1, -0.5)
+
+## (polarization, harmonic) : model dict from fit_gap_model.  Assigning a new entry is the hot-swap.
+epuGapModels = {}
+## (polarization, harmonic) : model dict from fit_speed_model
+epuSpeedModels = {}
+
+
+def fit_gap_model(energies, gaps, polarization, harmonic=1, degree=5):
+    """
+    Fits the best EPU gap versus photon energy for one polarization and harmonic.
+
+    Parameters
+    ----------
+    energies : array-like
+        Photon energies in eV where the best gap was measured
+    gaps : array-like
+        Best gap in um at each energy, e.g., the EPUGaps column of a calibration table
+    polarization : float
+        Polarization in degrees, or -1 and -0.5 for the two circular polarizations
+    harmonic : int
+        Undulator harmonic
+    degree : int
+        Polynomial degree.  Energies are scaled to [-1, 1] before fitting, so high degrees stay well conditioned.
+
+    Returns
+    -------
+    dict
+        Model with the polynomial, its valid energy range, and the residual report of the fit
+    """
+    energies = np.asarray(energies, dtype=float)
+    gaps = np.asarray(gaps, dtype=float)
+    valid = np.isfinite(energies) & np.isfinite(gaps)
+    energies, gaps = energies[valid], gaps[valid]
+    if len(energies) <= degree:
+        raise ValueError("Need more than " + str(degree) + " calibration points to fit a degree " + str(degree) + " gap model, got " + str(len(energies)) + ".")
+
+    polynomial = Polynomial.fit(energies, gaps, degree)
+    model = {
+        "polarization": polarization,
+        "harmonic": int(harmonic),
+        "degree": int(degree),
+        "polynomial": polynomial,
+        "energy_min": float(energies.min()),
+        "energy_max": float(energies.max()),
+    }
+    model["residuals"] = get_residual_report(model, energies, gaps)
+    return model
+
+
+def fit_speed_model(speeds, gap_offsets, polarization, harmonic=1, degree=1):
+    """
+    Fits how far the best gap during a fly scan is from the static best gap as a function of scan speed.
+
+    gap_offsets are measured as (best gap while flying) - (best gap from the static model) with the energy increasing.
+    The fit is forced through zero offset at zero speed.
+    """
+    speeds = np.abs(np.asarray(speeds, dtype=float))
+    gap_offsets = np.asarray(gap_offsets, dtype=float)
+    if len(speeds) < degree:
+        raise ValueError("Need at least " + str(degree) + " fly calibration scans to fit a degree " + str(degree) + " speed model, got " + str(len(speeds)) + ".")
+    ## Columns speed, speed**2, ... without a constant term
+    powers = np.vander(speeds, degree + 1, increasing=True)[:, 1:]
+    coefficients, _, _, _ = np.linalg.lstsq(powers, gap_offsets, rcond=None)
+    residuals = gap_offsets - powers @ coefficients
+    return {
+        "polarization": polarization,
+        "harmonic": int(harmonic),
+        "coefficients": np.concatenate(([0.0], coefficients)),
+        "speed_max": float(speeds.max()),
+        "residual_rms": float(np.sqrt(np.mean(residuals**2))),
+    }
+
+
+def get_residual_report(model, energies, gaps):
+    ## Fit quality in um.  Use calibration points that were not part of the fit to validate a model before registering it.
+    residuals = np.asarray(gaps, dtype=float) - evaluate_gap_model(model, energies, clip=False)
+    return {
+        "number_points": int(len(residuals)),
+        "rms": float(np.sqrt(np.mean(residuals**2))),
+        "max_abs": float(np.max(np.abs(residuals))),
+        "energy_worst": float(np.asarray(energies)[np.argmax(np.abs(residuals))]),
+    }
+
+
+def print_residual_report(model, report=None):
+    report = report or model["residuals"]
+    print(
+        "Gap model for polarization " + str(model["polarization"]) + ", harmonic " + str(model["harmonic"])
+        + " (" + str(model["energy_min"]) + " to " + str(model["energy_max"]) + " eV): "
+        + str(report["number_points"]) + " points, rms residual " + str(round(report["rms"], 1))
+        + " um, worst " + str(round(report["max_abs"], 1)) + " um at " + str(report["energy_worst"]) + " eV"
+    )
+
+
+def evaluate_gap_model(model, energies, clip=True):
+    gaps = model["polynomial"](np.asarray(energies, dtype=float))
+    if clip: gaps = np.clip(gaps, *gapLimits)
+    return gaps
+
+
+def register_gap_model(model, residual_max=None):
+    """
+    Makes a gap model active for its polarization and harmonic, replacing any previous model.
+
+    If residual_max (um) is given, models whose worst residual is larger are rejected with ValueError.
+    """
+    if residual_max is not None and model["residuals"]["max_abs"] > residual_max:
+        raise ValueError("Gap model for polarization " + str(model["polarization"]) + " has a worst residual of " + str(round(model["residuals"]["max_abs"], 1)) + " um, more than the allowed " + str(residual_max) + " um.  It was not registered.")
+    epuGapModels[(model["polarization"], model["harmonic"])] = model
+    print_residual_report(model)
+
+
+def register_speed_model(model):
+    epuSpeedModels[(model["polarization"], model["harmonic"])] = model
+
+
+def unregister_gap_models():
+    ## Falls back to the built-in gap calculation of the energy pseudo-motor
+    epuGapModels.clear()
+    epuSpeedModels.clear()
+
+
+def _get_bracketing_models(models, polarization, harmonic):
+    ## Exact match first.  Linear polarizations between two calibrated ones are interpolated, with 90-180 folded onto 0-90 like the built-in calculation.
+    if (polarization, harmonic) in models: return [(models[(polarization, harmonic)], 1.0)]
+    if polarization in polarizationsCircular or not 0 <= polarization <= 180: return []
+    polarizationFolded = 180 - polarization if polarization > 90 else polarization
+    if (polarizationFolded, harmonic) in models: return [(models[(polarizationFolded, harmonic)], 1.0)]
+    polarizationsLinear = sorted(key[0] for key in models if key[1] == harmonic and key[0] not in polarizationsCircular and 0 <= key[0] <= 90)
+    below = [value for value in polarizationsLinear if value < polarizationFolded]
+    above = [value for value in polarizationsLinear if value > polarizationFolded]
+    if len(below) == 0 or len(above) == 0: return []
+    weightAbove = (polarizationFolded - below[-1]) / (above[0] - below[-1])
+    return [(models[(below[-1], harmonic)], 1 - weightAbove), (models[(above[0], harmonic)], weightAbove)]
+
+
+def get_model_gap(energy, polarization, harmonic=1):
+    """
+    Best gap in um from the registered models, or None if no model covers this energy, polarization, and harmonic.
+    """
+    modelsWeighted = _get_bracketing_models(epuGapModels, polarization, harmonic)
+    if len(modelsWeighted) == 0: return None
+    if any(not model["energy_min"] <= energy <= model["energy_max"] for model, weight in modelsWeighted): return None
+    gap = sum(weight * float(model["polynomial"](energy)) for model, weight in modelsWeighted)
+    return float(np.clip(gap, *gapLimits))
+
+
+def get_model_speed_offset(speed, polarization, harmonic=1):
+    ## Gap offset magnitude in um for flying at speed (eV/s), or None if no speed model is registered
+    modelsWeighted = _get_bracketing_models(epuSpeedModels, polarization, harmonic)
+    if len(modelsWeighted) == 0: return None
+    return sum(weight * float(np.polynomial.polynomial.polyval(abs(speed), model["coefficients"])) for model, weight in modelsWeighted)
+
+
+def load_gap_calibration_table(path):
+    ## Energies and best gaps from a calibration table written by buildeputable
+    import pandas as pd
+    table = pd.read_csv(path)
+    return table["Energies"].to_numpy(dtype=float), table["EPUGaps"].to_numpy(dtype=float)
+
+
+def save_gap_models(path):
+    ## Polynomials are saved in the scaled domain with their energy window, so loading them gives back the same model
+    entries = []
+    for model in epuGapModels.values():
+        entry = {key: value for key, value in model.items() if key != "polynomial"}
+        entry["coefficients"] = model["polynomial"].coef.tolist()
+        entry["domain"] = model["polynomial"].domain.tolist()
+        entries.append({"type": "gap", **entry})
+    for model in epuSpeedModels.values():
+        entries.append({"type": "speed", **model, "coefficients": np.asarray(model["coefficients"]).tolist()})
+    with open(path, "w") as file:
+        json.dump(entries, file, indent=1)
+
+
+def load_gap_models(path):
+    ## Registers every model in a file written by save_gap_models
+    with open(path) as file:
+        entries = json.load(file)
+    for entry in entries:
+        modelType = entry.pop("type")
+        if modelType == "gap":
+            entry["polynomial"] = Polynomial(entry.pop("coefficients"), domain=entry.pop("domain"))
+            register_gap_model(entry)
+        else:
+            entry["coefficients"] = np.asarray(entry["coefficients"])
+            register_speed_model(entry)
@@ -0,0 +1,133 @@
+## Cached grating and mirror state of the monochromator, so that grating changes that are already done cost nothing.
+## The grating readback, cff, and grating and mirror offsets are kept up to date by monitored subscriptions instead of being read from the PVs on every request.
+## Requests for the grating that is already in place are no-ops, as in the base_grating_to_* functions, so setup plans can ask for a grating as often as they like.
+
+import bluesky.plan_stubs as bps
+from nbs_bl.hw import psh4
+
+
+## Grating name : gratingx setpoint, text in the gratingx readback that identifies it, and the cff to set (None to leave it)
+gratingSettings = {
+    "250": {"gratingx": 2, "readback": "250l/mm", "cff": 1.385, "description": "250 l/mm"},
+    "1200": {"gratingx": 9, "readback": "1200", "cff": 1.7, "description": "1200 l/mm"},
+    "rsoxs": {"gratingx": 10, "readback": "RSoXS", "cff": None, "description": "RSoXS 250 l/mm"},
+}
+energyAfterGratingMove = 270 ## eV
+
+
+class GratingStateManager:
+    """
+    Cached state of the grating and mirror of a monochromator, with idempotent grating transitions.
+
+    Parameters
+    ----------
+    mono_en : ophyd.Device
+        Monochromator with gratingx, cff, grating, and mirror2
+    energy_motor : ophyd.Device
+        Energy pseudo-motor that is moved to energyAfterGratingMove after a grating change
+    """
+
+    def __init__(self, mono_en, energy_motor):
+        self.mono_en = mono_en
+        self.energy_motor = energy_motor
+        self.state = {"grating": None, "cff": None, "grating_offset": None, "mirror_offset": None}
+        self.metrics = {"requests": 0, "moves": 0, "avoided": 0}
+        self._subscriptions = []
+        self._signals = {
+            "grating": mono_en.gratingx.readback,
+            "cff": mono_en.cff,
+            "grating_offset": mono_en.grating.user_offset,
+            "mirror_offset": mono_en.mirror2.user_offset,
+        }
+        for key, signal in self._signals.items():
+            self._subscribe(key, signal)
+
+    def _subscribe(self, key, signal):
+        def update(value=None, **kwargs):
+            self.state[key] = value
+
+        try:
+            self._subscriptions.append((signal, signal.subscribe(update, run=True)))
+        except Exception as error:
+            print("Could not monitor " + signal.name + ", it will be read on every request: " + str(error))
+
+    def unsubscribe(self):
+        for signal, subscription in self._subscriptions:
+            signal.unsubscribe(subscription)
+        self._subscriptions = []
+
+    def get_state(self, key):
+        ## The monitored value, or a PV read if the monitor has not delivered one yet
+        if self.state[key] is None:
+            self.state[key] = self._signals[key].get()
+        return self.state[key]
+
+    def get_grating_readback(self):
+        return self.get_state("grating")
+
+    def get_cff(self):
+        return self.get_state("cff")
+
+    def is_at(self, grating_name):
+        return gratingSettings[grating_name]["readback"] in str(self.get_grating_readback())
+
+    def move_to(self, grating_name):
+        """
+        Moves to a grating unless it is already in place.
+
+        A grating that is already in place is left as it is, including its cff.
+
+        Returns
+        -------
+        int
+            1 if the grating was moved, 0 otherwise, like the base_grating_to_* functions
+        """
+        if grating_name not in gratingSettings:
+            raise ValueError("Unknown grating " + str(grating_name) + ", should be one of " + str(list(gratingSettings)) + ".")
+        settings = gratingSettings[grating_name]
+        self.metrics["requests"] += 1
+
+        if self.is_at(grating_name):
+            self.metrics["avoided"] += 1
+            print("the grating is already at " + settings["description"])
+            return 0  # the grating is already here
+
+        print("Moving the grating to " + settings["description"] + ".  This will take a minute...")
+        self.metrics["moves"] += 1
+        self.state["grating"] = None ## unknown until the monitor reports the new grating
+        yield from psh4.close()
+        yield from bps.abs_set(self.mono_en.gratingx, settings["gratingx"], wait=True)
+        if settings["cff"] is not None:
+            yield from bps.mv(self.mono_en.cff, settings["cff"])
+            self.state["cff"] = settings["cff"]
+        yield from bps.mv(self.energy_motor, energyAfterGratingMove)
+        yield from psh4.open()
+        print("the grating is now at " + settings["description"])
+        return 1
+
+    def reset_metrics(self):
+        for key in self.metrics: self.metrics[key] = 0
+
+    def print_metrics(self):
+        print(
+            "Grating requests: " + str(self.metrics["requests"]) + ", grating moves: " + str(self.metrics["moves"])
+            + ", avoided moves: " + str(self.metrics["avoided"])
+        )
+        return dict(self.metrics)
+
+    def print_state(self):
+        print(
+            "Grating: " + str(self.get_grating_readback()) + ", cff " + str(self.get_cff())
+            + ", grating offset " + str(self.get_state("grating_offset")) + ", mirror offset " + str(self.get_state("mirror_offset"))
+        )
+        return dict(self.state)
+
+
+## mono_en name : GratingStateManager, so each monochromator is subscribed to only once
+gratingStateManagers = {}
+
+
+def get_grating_state_manager(mono_en, energy_motor):
+    if mono_en.name not in gratingStateManagers:
+        gratingStateManagers[mono_en.name] = GratingStateManager(mono_en, energy_motor)
+    return gratingStateManagers[mono_en.name]
@@ -10,6 +10,8 @@ from ophyd import (
 from ophyd.status import MoveStatus
 from ophyd.mixins import EpicsSignalPositioner
 from collections import deque
+import time
+import bluesky.plan_stubs as bps
 from nbs_bl.printing import run_report
 
 run_report(__file__)
@@ -90,6 +92,9 @@ class Lakeshore336Picky(Device):
         # parameters for done testing
         self.mean_thresh = .01
         self.ptp_thresh = .1
+        # readback within this of the setpoint for _lagtime counts as settled in wait_for_setpoint
+        self.settle_tolerance = .1
+        self._settled_setpoint = None
 
     def _value_cb(self, value, timestamp, **kwargs):
         self._cache.append((value, timestamp))
@@ -154,6 +159,39 @@ class Lakeshore336Picky(Device):
 
         return self._done_sts
 
+    def wait_for_setpoint(self, setpoint=None, poll_time=1, timeout=None):
+        """
+        Plan that waits until the readback has stayed within settle_tolerance of setpoint for _lagtime, without writing the setpoint.
+
+        set returns right away when the setpoint already has the value, and with target='setpoint' it only waits for the setpoint,
+        so this is used after the setpoint is written, e.g., when the ramp was started earlier.
+        It returns right away if the stage already settled at this setpoint and is still within the tolerance.
+        """
+        if setpoint is None: setpoint = yield from bps.rd(self.setpoint)
+        timeout = self._timeout if timeout is None else timeout
+        value = yield from bps.rd(self.readback)
+        if self._settled_setpoint == setpoint and abs(value - setpoint) <= self.settle_tolerance:
+            return value
+        self._settled_setpoint = None
+        timeStart = time.monotonic()
+        timeInside = None ## since when the readback has been within the tolerance
+        while True:
+            timeNow = time.monotonic()
+            if abs(value - setpoint) > self.settle_tolerance: timeInside = None
+            elif timeInside is None: timeInside = timeNow
+            if timeInside is not None and timeNow - timeInside >= self._lagtime: break
+            if timeNow - timeStart > timeout:
+                raise TimeoutError("Temperature did not settle at " + str(setpoint) + " C within " + str(timeout) + " s, last readback " + str(value) + " C")
+            yield from bps.sleep(poll_time)
+            value = yield from bps.rd(self.readback)
+        self._settled_setpoint = setpoint
+        return value
+
+    def set_and_wait_plan(self, setpoint, **kwargs):
+        ## Plan that writes the setpoint and waits until the readback settles there
+        yield from bps.mv(self.setpoint, setpoint)
+        return (yield from self.wait_for_setpoint(setpoint, **kwargs))
+
 
 
 
@@ -0,0 +1,261 @@
+## EPU gap table builder based on one continuous gap fly scan per energy.
+## The peak of each fly scan is fit instead of taking the highest reading, so the best gap is found to a fraction of the reading spacing and the gap can be flown faster.
+## Each energy is appended to the table as soon as it is measured, so a table that was interrupted can be resumed, and the table can be loaded with load_gap_calibration_table to fit gap models.
+
+import os
+
+import numpy as np
+import pandas as pd
+import bluesky.plan_stubs as bps
+from bluesky.preprocessors import finalize_wrapper
+import bluesky.preprocessors as bpp
+from nbs_bl.hw import (
+    en,
+    izero_mesh,
+    beamstop_waxs,
+    shutter_control,
+    shutter_enable,
+)
+from nbs_bl.plans.flyscan_base import fly_scan
+from ..HW.energy import mono_en, epu_gap, epu_phase, epu_mode
+from ..HW.epu_gap_model import gapLimits, get_model_gap, fit_gap_model, print_residual_report
+from ..plans.adaptive_energy import get_reading_value
+
+
+epuModes = {"C": 0, "CW": 1, "L": 2, "L3": 3}
+epuTableDirectory_Default = "/nsls2/data/sst/legacy/RSoXS/"
+
+
+def fit_gap_peak(gaps, signal, fraction_fit=0.5):
+    """
+    Fits a Gaussian to the top of a gap fly scan.
+
+    The Gaussian is fit as a parabola to the log of the baseline-subtracted signal, using the readings above fraction_fit of the peak.
+
+    Returns
+    -------
+    dict
+        center (um), height, fwhm (um), r_squared of the parabola fit,
+        and at_edge, which is True if the peak is not inside the scanned range and the scan needs to be repeated over a wider range.
+        Without any valid readings, center and height are nan.
+    """
+    gaps = np.asarray(gaps, dtype=float)
+    signal = np.asarray(signal, dtype=float)
+    valid = np.isfinite(gaps) & np.isfinite(signal)
+    gaps, signal = gaps[valid], signal[valid]
+    if len(signal) == 0: return {"center": np.nan, "height": np.nan, "fwhm": np.nan, "r_squared": 0.0, "at_edge": True}
+    order = np.argsort(gaps)
+    gaps, signal = gaps[order], signal[order]
+
+    indexMax = int(np.argmax(signal))
+    result = {"center": float(gaps[indexMax]), "height": float(signal[indexMax]), "fwhm": np.nan, "r_squared": 0.0, "at_edge": True}
+    baseline = np.min(signal)
+    amplitude = signal[indexMax] - baseline
+    if amplitude <= 0: return result
+
+    ## Contiguous readings around the maximum that are above fraction_fit of the peak
+    above = (signal - baseline) > fraction_fit * amplitude
+    indexLow = indexMax
+    while indexLow > 0 and above[indexLow - 1]: indexLow -= 1
+    indexHigh = indexMax
+    while indexHigh < len(signal) - 1 and above[indexHigh + 1]: indexHigh += 1
+    result["at_edge"] = indexLow == 0 or indexHigh == len(signal) - 1
+    if indexHigh - indexLow < 2: return result
+
+    gapsFit = gaps[indexLow:indexHigh + 1]
+    logSignal = np.log(signal[indexLow:indexHigh + 1] - baseline)
+    gapCenter = gaps[indexMax]
+    curvature, slope, offset = np.polyfit(gapsFit - gapCenter, logSignal, 2)
+    if curvature >= 0: return result
+
+    residuals = logSignal - np.polyval((curvature, slope, offset), gapsFit - gapCenter)
+    totalVariance = np.sum((logSignal - logSignal.mean())**2)
+    center = gapCenter - slope / (2 * curvature)
+    sigma = np.sqrt(-1 / (2 * curvature))
+    result.update({
+        "center": float(center),
+        "height": float(baseline + np.exp(offset - slope**2 / (4 * curvature))),
+        "fwhm": float(2 * np.sqrt(2 * np.log(2)) * sigma),
+        "r_squared": float(1 - np.sum(residuals**2) / totalVariance) if totalVariance > 0 else 0.0,
+        "at_edge": result["at_edge"] or not gapsFit[0] <= center <= gapsFit[-1],
+    })
+    return result
+
+
+def read_epu_table(path):
+    if not os.path.exists(path): return pd.DataFrame()
+    return pd.read_csv(path)
+
+
+def append_epu_table_row(path, row):
+    ## Appends one energy, writing the header only when the file is new
+    pd.DataFrame([row]).to_csv(path, mode="a", header=not os.path.exists(path), index=False)
+
+
+def predict_starting_gap(table, energy, polarization=None, harmonic=1, startinggap=14000):
+    ## Registered gap model first, then linear extrapolation from the last two measured energies, then the last measured gap
+    if polarization is not None:
+        gap = get_model_gap(energy, polarization, harmonic)
+        if gap is not None: return gap
+    good = table[table["FitRSquared"] > 0] if len(table) > 0 else table
+    if len(good) >= 2:
+        energies = good["Energies"].to_numpy()[-2:]
+        gaps = good["EPUGaps"].to_numpy()[-2:]
+        if energies[1] != energies[0]:
+            return float(gaps[1] + (gaps[1] - gaps[0]) / (energies[1] - energies[0]) * (energy - energies[1]))
+    if len(good) == 1: return float(good["EPUGaps"].iloc[-1])
+    return startinggap
+
+
+def _fly_gap_scan(detectors, gap_start, gap_stop, speed, period, md):
+    ## Returns the gap readback and the reading of each detector for one continuous gap move, collected from the primary stream as it is emitted.
+    ## Data keys are matched to device names as in get_reading_value, and devices without readings get empty arrays.
+    readings = {}
+    descriptorsPrimary = set()
+
+    def collect(name, doc):
+        if name == "descriptor" and doc.get("name") == "primary": descriptorsPrimary.add(doc["uid"])
+        if name == "event" and doc["descriptor"] in descriptorsPrimary:
+            for key, value in doc["data"].items(): readings.setdefault(key, []).append(value)
+
+    yield from bpp.subs_wrapper(fly_scan(detectors, epu_gap, gap_start, gap_stop, speed, period=period, md=md), collect)
+    reading = {key: {"value": np.asarray(values)} for key, values in readings.items()}
+    data = {}
+    for name in [epu_gap.name] + [detector.name for detector in detectors]:
+        try:
+            data[name] = get_reading_value(reading, name)
+        except KeyError:
+            data[name] = np.array([])
+    return data
+
+
+def buildeputable_fly(
+    start,
+    stop,
+    step,
+    gap_width=4000,
+    startinggap=14000,
+    phase=0,
+    mode="L",
+    polarization=None,
+    harmonic=1,
+    name="test",
+    directory=epuTableDirectory_Default,
+    scan_time=10,
+    period=0.1,
+    resume=True,
+    rsquared_min=0.9,
+    retries=1,
+):
+    """
+    Builds an EPU gap table with one gap fly scan per energy.
+
+    Parameters
+    ----------
+    start, stop, step : float
+        Energies in eV, as in np.arange
+    gap_width : float
+        Range of the gap fly scan in um, centered on the predicted gap
+    startinggap : float
+        Gap in um to center the first fly scan on if there is no gap model or measured energy to predict it from
+    phase : float
+        EPU phase
+    mode : str
+        "C", "CW", "L", or "L3"
+    polarization : float, optional
+        If given, registered gap models for this polarization and harmonic are used to center the fly scans
+    name : str
+        Table is saved to directory + "EPUdata_fly_" + name + ".csv"
+    scan_time : float
+        Time in s for one fly scan.  The gap speed is gap_width / scan_time.
+    period : float
+        Time in s between detector readings
+    resume : bool
+        If True, energies that are already in the table are skipped.  If False, an existing table is moved aside to a .bak file.
+    rsquared_min : float
+        Fits below this are repeated over a doubled range, up to retries times.  Energies that still fail are saved with FitRSquared 0.
+    """
+    path = os.path.join(directory, "EPUdata_fly_" + name + ".csv")
+    if not resume and os.path.exists(path): os.replace(path, path + ".bak")
+    table = read_epu_table(path)
+    energiesDone = table["Energies"].to_numpy() if len(table) > 0 else np.array([])
+    energies = [energy for energy in np.arange(start, stop, step) if not np.any(np.isclose(energiesDone, energy, atol=step / 10))]
+    print("EPU table " + path + ": " + str(len(energiesDone)) + " energies already measured, " + str(len(energies)) + " to go")
+    if len(energies) == 0: return table
+
+    detectors = [izero_mesh, beamstop_waxs]
+    yield from bps.mv(epu_mode, epuModes.get(mode, 2))
+    yield from bps.mv(epu_phase, phase)
+    yield from bps.mv(epu_gap.tolerance, 0)
+
+    def _cleanup():
+        yield from bps.mv(shutter_control, 0)
+
+    def _build():
+        nonlocal table
+        yield from bps.mv(shutter_enable, 0)
+        yield from bps.mv(shutter_control, 1)
+        direction = 1
+        for energy in energies:
+            gapCenter = predict_starting_gap(table, energy, polarization, harmonic, startinggap)
+            width = gap_width
+            for attempt in range(retries + 1):
+                gapStart = float(np.clip(gapCenter - direction * width / 2, *gapLimits))
+                gapStop = float(np.clip(gapCenter + direction * width / 2, *gapLimits))
+                speed = width / scan_time ## recorded with the fit that is kept
+                yield from bps.mv(mono_en, energy, en.scanlock, False, epu_gap, gapStart)
+                data = yield from _fly_gap_scan(
+                    detectors, gapStart, gapStop, speed, period,
+                    md={"plan_name": "buildeputable_fly", "energy": energy, "epu_table": path},
+                )
+                fitI0 = fit_gap_peak(data[epu_gap.name], data[izero_mesh.name])
+                fitBS = fit_gap_peak(data[epu_gap.name], data[beamstop_waxs.name])
+                direction = -direction
+                if not fitI0["at_edge"] and fitI0["r_squared"] >= rsquared_min: break
+                if np.isfinite(fitI0["center"]): gapCenter = fitI0["center"]
+                width = 2 * width
+            good = not fitI0["at_edge"] and fitI0["r_squared"] >= rsquared_min
+            row = {
+                "Energies": mono_en.position,
+                "EPUGaps": fitI0["center"],
+                "PeakCurrent": fitI0["height"],
+                "EPUGapsBS": fitBS["center"],
+                "PeakCurrentBS": fitBS["height"],
+                "FitWidth": fitI0["fwhm"],
+                "FitRSquared": fitI0["r_squared"] if good else 0.0,
+                "GapSpeed": speed,
+                "Phase": phase,
+                "Mode": mode,
+            }
+            append_epu_table_row(path, row)
+            table = pd.concat((table, pd.DataFrame([row])), ignore_index=True)
+            print(str(round(row["Energies"], 2)) + " eV: gap " + str(round(row["EPUGaps"], 1)) + " um, fit R^2 " + str(round(fitI0["r_squared"], 4)) + ("" if good else ", flagged"))
+
+    yield from finalize_wrapper(_build(), _cleanup())
+    summarize_epu_table(path, polarization=polarization, harmonic=harmonic)
+    return table
+
+
+def summarize_epu_table(path, polarization=None, harmonic=1, degree=5):
+    ## Fit-quality metrics of a table, and the residuals of a smooth gap model fit to its good rows
+    table = read_epu_table(path)
+    if len(table) == 0:
+        print("EPU table " + path + " is empty")
+        return {}
+    good = table[table["FitRSquared"] > 0]
+    summary = {
+        "number_energies": len(table),
+        "number_flagged": len(table) - len(good),
+        "rsquared_median": float(good["FitRSquared"].median()) if len(good) > 0 else np.nan,
+        "fwhm_median": float(good["FitWidth"].median()) if len(good) > 0 else np.nan,
+    }
+    print(
+        "EPU table " + path + ": " + str(summary["number_energies"]) + " energies, "
+        + str(summary["number_flagged"]) + " flagged, median fit R^2 " + str(round(summary["rsquared_median"], 4))
+        + ", median peak FWHM " + str(round(summary["fwhm_median"], 1)) + " um"
+    )
+    if len(good) > degree:
+        model = fit_gap_model(good["Energies"], good["EPUGaps"], polarization, harmonic, degree)
+        print_residual_report(model)
+        summary["model"] = model
+    return summary
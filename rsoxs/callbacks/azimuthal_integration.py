@@ -0,0 +1,407 @@
+## Live azimuthal integration of WAXS frames, as a callback on the document stream.
+## The beam center, sample-detector distance, and WAXS_Mask from load_configuration (rescaled to the detector mode by load_detector_mode) are read from the start document.
+## Each pixel is assigned to a (chi, sin(theta)) bin once per geometry, and the assignment is stored as a sparse matrix, so integrating a frame is one sparse matrix-vector product.
+## sin(theta) does not depend on energy, so the same matrix is used at every energy and only the q axis is scaled: q = 4 pi sin(theta) / wavelength.
+## Reduced frames are emitted as a separate stream of the same run, after the light frame they come from and before the stop document.
+## Frames are loaded and integrated on a worker thread, so the RunEngine callback only queues them.
+
+import queue
+import threading
+import time
+import uuid
+
+import numpy as np
+from scipy import sparse
+from event_model import DocumentRouter, unpack_datum_page
+
+from ..devices.dark_frames import darkImageFormats
+
+
+pixelSize_Default = 0.06 ## mm, WAXS detector pixels as read out
+hc = 12398.4198 ## eV Angstrom
+integrationGeometriesLimit = 20
+
+## Geometry key : pixel-to-bin matrix and bin axes, see get_integration_geometry
+integrationGeometries = {}
+
+
+def get_polygon_mask(shape, vertices):
+    """
+    Boolean image that is True inside a polygon, e.g., the beamstop shadow in WAXS_Mask.
+
+    vertices are (x, y) = (column, row) pixel coordinates.  Uses the even-odd rule.
+    """
+    rows, columns = np.indices(shape, dtype=float)
+    inside = np.zeros(shape, dtype=bool)
+    vertices = np.asarray(vertices, dtype=float)
+    for (x1, y1), (x2, y2) in zip(vertices, np.roll(vertices, -1, axis=0)):
+        if y1 == y2: continue
+        crosses = (y1 > rows) != (y2 > rows)
+        xCross = x1 + (rows - y1) * (x2 - x1) / (y2 - y1)
+        inside ^= crosses & (columns < xCross)
+    return inside
+
+
+def get_integration_geometry(
+    shape,
+    beam_center_x,
+    beam_center_y,
+    distance,
+    pixel_size=pixelSize_Default,
+    mask_polygon=None,
+    number_q_bins=200,
+    number_chi_bins=36,
+):
+    """
+    Sparse matrix that sums pixels into (chi, sin(theta)) bins, cached per geometry.
+
+    Parameters
+    ----------
+    shape : tuple
+        Image shape (rows, columns)
+    beam_center_x, beam_center_y : float
+        Beam center in pixels (column, row), e.g., RSoXS_WAXS_BCX and RSoXS_WAXS_BCY
+    distance : float
+        Sample-detector distance in mm, e.g., RSoXS_WAXS_SDD
+    mask_polygon : list of (x, y), optional
+        Masked region, e.g., WAXS_Mask
+
+    Returns
+    -------
+    dict
+        matrix (number_chi_bins * number_q_bins by number of pixels), number of unmasked pixels per bin,
+        and the sin(theta) and chi (degrees) bin centers
+    """
+    maskKey = None if mask_polygon is None else tuple(tuple(float(value) for value in vertex) for vertex in mask_polygon)
+    key = (tuple(shape), float(beam_center_x), float(beam_center_y), float(distance), float(pixel_size), maskKey, number_q_bins, number_chi_bins)
+    if key in integrationGeometries: return integrationGeometries[key]
+
+    rows, columns = np.indices(shape, dtype=float)
+    x = (columns - beam_center_x) * pixel_size
+    y = (rows - beam_center_y) * pixel_size
+    sinTheta = np.sin(np.arctan2(np.hypot(x, y), distance) / 2).ravel()
+    chi = np.degrees(np.arctan2(y, x)).ravel()
+    valid = np.ones(sinTheta.shape, dtype=bool)
+    if mask_polygon is not None and len(mask_polygon) > 2:
+        valid = ~get_polygon_mask(shape, mask_polygon).ravel()
+
+    sinThetaEdges = np.linspace(0, sinTheta[valid].max() if valid.any() else sinTheta.max(), number_q_bins + 1)
+    chiEdges = np.linspace(-180, 180, number_chi_bins + 1)
+    indexQ = np.clip(np.digitize(sinTheta, sinThetaEdges) - 1, 0, number_q_bins - 1)
+    indexChi = np.clip(np.digitize(chi, chiEdges) - 1, 0, number_chi_bins - 1)
+    pixels = np.flatnonzero(valid)
+    matrix = sparse.csr_matrix(
+        (np.ones(len(pixels)), (indexChi[pixels] * number_q_bins + indexQ[pixels], pixels)),
+        shape=(number_chi_bins * number_q_bins, sinTheta.size),
+    )
+    geometry = {
+        "matrix": matrix,
+        "counts": np.asarray(matrix.sum(axis=1)).reshape(number_chi_bins, number_q_bins),
+        "sin_theta": (sinThetaEdges[:-1] + sinThetaEdges[1:]) / 2,
+        "chi": (chiEdges[:-1] + chiEdges[1:]) / 2,
+    }
+    if len(integrationGeometries) >= integrationGeometriesLimit:
+        del integrationGeometries[next(iter(integrationGeometries))]
+    integrationGeometries[key] = geometry
+    return geometry
+
+
+def _get_sector(chi, center, width):
+    ## chi bins within width / 2 of center or of center + 180
+    difference = np.abs((chi - center + 90) % 180 - 90)
+    return difference <= width / 2
+
+
+def integrate_frame(image, geometry, energy, dark=None, chi_parallel=0, sector_width=45):
+    """
+    Reduces one frame to I(q), I(chi, q), and the anisotropy.
+
+    The anisotropy is (I_parallel - I_perpendicular) / (I_parallel + I_perpendicular), with sectors of sector_width degrees
+    around chi_parallel and chi_parallel + 90 (and the opposite sides).
+    """
+    image = np.asarray(image, dtype=float)
+    if dark is not None: image = image - dark
+    sums = (geometry["matrix"] @ image.ravel()).reshape(geometry["counts"].shape)
+    counts = geometry["counts"]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        intensityChi = sums / counts
+        intensity = sums.sum(axis=0) / counts.sum(axis=0)
+        parallel = _get_sector(geometry["chi"], chi_parallel, sector_width)
+        perpendicular = _get_sector(geometry["chi"], chi_parallel + 90, sector_width)
+        intensityParallel = sums[parallel].sum(axis=0) / counts[parallel].sum(axis=0)
+        intensityPerpendicular = sums[perpendicular].sum(axis=0) / counts[perpendicular].sum(axis=0)
+        anisotropy = (intensityParallel - intensityPerpendicular) / (intensityParallel + intensityPerpendicular)
+    return {
+        "q": 4 * np.pi * geometry["sin_theta"] * energy / hc,
+        "intensity": intensity,
+        "intensity_chi": intensityChi,
+        "chi": geometry["chi"],
+        "anisotropy": anisotropy,
+    }
+
+
+class LiveAzimuthalIntegration(DocumentRouter):
+    """
+    Callback that integrates each WAXS frame of a run as it arrives and emits the results as a separate stream.
+
+    Nothing subscribes it by default; it is opt-in, e.g., RE.subscribe(LiveAzimuthalIntegration(emit=publisher)).
+    Every document is passed on to emit.  Frames are loaded and integrated on a worker thread, and the documents of the reduced stream
+    are inserted as they finish, always after the light event they come from.  The stop document waits for the queued frames.
+    Runs without a WAXS geometry in the start document (e.g., NEXAFS configurations) are passed on unchanged.
+
+    Parameters
+    ----------
+    emit : callable, optional
+        Receives (name, doc) for every document.  If None, reduced frames are only kept in results.
+    image_key : str, optional
+        Data key of the detector image.  Defaults to the first external data key with two or more dimensions.
+    energy_key : str
+        Data key of the photon energy in the light stream
+    light_stream_name, dark_stream_name : str
+        Streams of the light and dark frames.  The latest dark is subtracted from each light frame.
+    stream_name : str
+        Name of the emitted stream
+    results_limit : int
+        Number of reduced frames kept in results
+    """
+
+    def __init__(
+        self,
+        emit=None,
+        image_key=None,
+        energy_key="en_energy_setpoint",
+        light_stream_name="primary",
+        dark_stream_name="dark",
+        stream_name="azimuthal_integration",
+        pixel_size=pixelSize_Default,
+        number_q_bins=200,
+        number_chi_bins=36,
+        chi_parallel=0,
+        sector_width=45,
+        results_limit=1000,
+    ):
+        super().__init__()
+        self.emit = emit
+        self.image_key = image_key
+        self.energy_key = energy_key
+        self.light_stream_name = light_stream_name
+        self.dark_stream_name = dark_stream_name
+        self.stream_name = stream_name
+        self.pixel_size = pixel_size
+        self.number_q_bins = number_q_bins
+        self.number_chi_bins = number_chi_bins
+        self.chi_parallel = chi_parallel
+        self.sector_width = sector_width
+        self.results_limit = results_limit
+        self.results = []
+        self.times_integration = [] ## s per frame of the current run
+        self._queued = queue.Queue() ## (stream, image or datum id, energy, light seq_num) to load and integrate
+        self._finished = queue.Queue() ## (reduced, light seq_num) to emit
+        self._worker = None
+        self._reset()
+
+    def _reset(self):
+        self._start = None
+        self._geometry = None
+        self._streams = {} ## descriptor uid : stream name
+        self._image_keys = {} ## descriptor uid : image data key
+        self._resources = {}
+        self._datums = {}
+        self._dark = None
+        self._energy = None
+        self._descriptor = None
+        self._sequence = 0
+
+    def __call__(self, name, doc, validate=False):
+        result = super().__call__(name, doc, validate)
+        if self.emit is not None:
+            if name == "stop":
+                self._emit_finished()
+                if self._descriptor is not None:
+                    doc = dict(doc, num_events=dict(doc.get("num_events", {}), **{self.stream_name: self._sequence}))
+            self.emit(name, doc)
+            if name != "stop": self._emit_finished()
+        return result
+
+    def _emit_finished(self):
+        ## Emits the reduced frames the worker has finished, on the thread that emits the other documents
+        while True:
+            try:
+                reduced, sequenceLight = self._finished.get_nowait()
+            except queue.Empty:
+                return
+            self._emit_reduced(reduced, sequenceLight)
+
+    def _queue_frame(self, stream, value, energy, sequence_light):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._integrate_queued, daemon=True)
+            self._worker.start()
+        self._queued.put((stream, value, energy, sequence_light))
+
+    def _integrate_queued(self):
+        while True:
+            item = self._queued.get()
+            try:
+                self._integrate(*item)
+            finally:
+                self._queued.task_done()
+
+    def start(self, doc):
+        self._queued.join() ## frames of a run that never stopped
+        self._reset()
+        self._finished = queue.Queue()
+        self._start = doc
+        self.times_integration = []
+        if doc.get("RSoXS_WAXS_SDD") is None or doc.get("RSoXS_WAXS_BCX") is None or doc.get("RSoXS_WAXS_BCY") is None:
+            return
+        self._geometry = {
+            "beam_center_x": doc["RSoXS_WAXS_BCX"],
+            "beam_center_y": doc["RSoXS_WAXS_BCY"],
+            "distance": doc["RSoXS_WAXS_SDD"],
+            "mask_polygon": doc.get("WAXS_Mask"),
+            "pixel_size": doc.get("RSoXS_WAXS_Pixel_Size") or self.pixel_size, ## binned pixel size of the detector mode, see load_detector_mode
+        }
+
+    def descriptor(self, doc):
+        self._streams[doc["uid"]] = doc.get("name")
+        imageKey = self.image_key
+        if imageKey is None:
+            imageKey = next((key for key, value in doc["data_keys"].items() if value.get("external") and len(value.get("shape", [])) >= 2), None)
+        if imageKey in doc["data_keys"]:
+            self._image_keys[doc["uid"]] = imageKey
+
+    def resource(self, doc):
+        self._resources[doc["uid"]] = doc
+
+    def datum(self, doc):
+        self._datums[doc["datum_id"]] = doc
+
+    def datum_page(self, doc):
+        for datum in unpack_datum_page(doc):
+            self.datum(datum)
+
+    def _load_image(self, value):
+        if isinstance(value, str):
+            datum = self._datums.get(value)
+            if datum is None: return None
+            resource = self._resources[datum["resource"]]
+            if resource["spec"] not in darkImageFormats: return None
+            value = darkImageFormats[resource["spec"]][0](resource, datum)
+        image = np.asarray(value, dtype=float)
+        while image.ndim > 2: image = image.mean(axis=0) ## several exposures per point
+        return image
+
+    def event(self, doc):
+        if self._geometry is None: return
+        stream = self._streams.get(doc["descriptor"])
+        if stream == self.light_stream_name and self.energy_key in doc["data"]:
+            self._energy = float(doc["data"][self.energy_key])
+        imageKey = self._image_keys.get(doc["descriptor"])
+        if imageKey is None or imageKey not in doc["data"]: return
+        if stream not in (self.light_stream_name, self.dark_stream_name): return
+        if stream == self.light_stream_name and self._energy is None: return
+        self._queue_frame(stream, doc["data"][imageKey], self._energy, doc["seq_num"])
+
+    def _integrate(self, stream, value, energy, sequence_light):
+        ## Runs on the worker thread, in the order the frames were queued, so each light frame gets the latest dark before it
+        try:
+            image = self._load_image(value)
+        except (OSError, KeyError) as error:
+            print("Live integration could not load " + str(value) + ": " + str(error))
+            return
+        if image is None: return
+        if stream == self.dark_stream_name:
+            self._dark = image
+            return
+
+        timeStart = time.monotonic()
+        geometry = get_integration_geometry(
+            image.shape, number_q_bins=self.number_q_bins, number_chi_bins=self.number_chi_bins, **self._geometry
+        )
+        dark = self._dark if self._dark is not None and self._dark.shape == image.shape else None
+        reduced = integrate_frame(image, geometry, energy, dark, self.chi_parallel, self.sector_width)
+        self.times_integration.append(time.monotonic() - timeStart)
+        reduced.update({"energy": energy, "seq_num": sequence_light, "uid": self._start["uid"]})
+        self.results.append(reduced)
+        if len(self.results) > self.results_limit: self.results.pop(0)
+        self._finished.put((reduced, sequence_light))
+
+    def _emit_reduced(self, reduced, sequence_light):
+        if self.emit is None: return
+        keysArray = ("q", "intensity", "anisotropy", "intensity_chi", "chi")
+        if self._descriptor is None:
+            self._descriptor = {
+                "uid": str(uuid.uuid4()),
+                "run_start": self._start["uid"],
+                "time": time.time(),
+                "name": self.stream_name,
+                "data_keys": {
+                    **{key: {"source": "LiveAzimuthalIntegration", "dtype": "array", "shape": list(np.shape(reduced[key]))} for key in keysArray},
+                    "energy": {"source": "LiveAzimuthalIntegration", "dtype": "number", "shape": []},
+                    "light_seq_num": {"source": "LiveAzimuthalIntegration", "dtype": "integer", "shape": []},
+                },
+                "object_keys": {},
+                "configuration": {},
+                "hints": {},
+            }
+            self.emit("descriptor", self._descriptor)
+        self._sequence += 1
+        timeNow = time.time()
+        data = {key: np.nan_to_num(reduced[key]).tolist() for key in keysArray}
+        data.update({"energy": reduced["energy"], "light_seq_num": sequence_light})
+        self.emit("event", {
+            "uid": str(uuid.uuid4()),
+            "descriptor": self._descriptor["uid"],
+            "time": timeNow,
+            "seq_num": self._sequence,
+            "data": data,
+            "timestamps": {key: timeNow for key in data},
+            "filled": {},
+        })
+
+    def stop(self, doc):
+        self._queued.join()
+        if len(self.times_integration) > 0:
+            print(
+                "Live integration: " + str(len(self.times_integration)) + " frames, "
+                + str(round(1000 * np.median(self.times_integration), 1)) + " ms per frame"
+            )
+
+
+def benchmark_live_integration(shape=(1026, 1024), number_frames=20, number_energies=5):
+    """
+    Times the geometry setup and the integration of simulated frames with a scattering ring, at several energies.
+
+    Returns
+    -------
+    dict
+        Time in s to build the geometry, median time in s per frame, and the q of the ring peak at each energy
+    """
+    beamCenter = (474, 502)
+    distance = 31.96
+    mask = [(477.418, 535.415), (446.074, 511.344), (872.214, -0.476), (948.916, -0.476)]
+    integrationGeometries.clear()
+    timeStart = time.monotonic()
+    get_integration_geometry(shape, beamCenter[0], beamCenter[1], distance, mask_polygon=mask)
+    timeGeometry = time.monotonic() - timeStart
+
+    rows, columns = np.indices(shape, dtype=float)
+    radius = np.hypot((columns - beamCenter[0]) * pixelSize_Default, (rows - beamCenter[1]) * pixelSize_Default)
+    sinThetaRing = np.sin(np.arctan2(10.0, distance) / 2) ## ring at 10 mm
+    rng = np.random.default_rng(0)
+    timesFrame = []
+    peaks = []
+    for energy in np.linspace(250, 300, number_energies):
+        for index in range(number_frames // number_energies):
+            image = 100 + 1000 * np.exp(-((radius - 10.0) / 0.3)**2) + rng.normal(0, 5, shape)
+            timeStart = time.monotonic()
+            reduced = integrate_frame(image, get_integration_geometry(shape, beamCenter[0], beamCenter[1], distance, mask_polygon=mask), energy)
+            timesFrame.append(time.monotonic() - timeStart)
+        peaks.append((float(energy), float(reduced["q"][np.nanargmax(reduced["intensity"])]), float(4 * np.pi * sinThetaRing * energy / hc)))
+
+    results = {"time_geometry": timeGeometry, "time_frame": float(np.median(timesFrame)), "peaks": peaks}
+    print(
+        "Geometry: " + str(round(timeGeometry, 2)) + " s once, integration: " + str(round(1000 * results["time_frame"], 2))
+        + " ms per " + str(shape[0]) + "x" + str(shape[1]) + " frame"
+    )
+    return results
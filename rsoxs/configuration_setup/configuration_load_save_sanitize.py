@@ -12,6 +12,8 @@ import re, warnings, httpx
 import uuid
 
 from ..plans.default_energy_parameters import energy_list_parameters
+from ..plans.energy_grids import validate_energy_grid, get_fly_segments, get_energy_edge
+from ..devices.detector_modes import detectorModes
 
 
 
@@ -280,12 +282,17 @@ acquisitionParameters_Default = {
     "exposure_time": 1,
     "exposures_per_energy": 1,
     "cycles": 0,
+    "energy_sweep_order": "ascending",  ## "ascending" starts every sweep from the low energy.  "snake" starts each sweep where the previous one finished to avoid slewing back.
     "sample_angles": [0],
+    "temperatures": None,  ## Temperature setpoint in C for the temperature stage.  None means the acquisition does not need a specific temperature.
+    "detector_mode": None,  ## Binning and readout region of the WAXS CCD, a key of detectorModes.  None picks one from the scan type and configuration (see choose_detector_mode).
+    "exposure_memory": False,  ## True to check and retake exposures of RSoXS scans, seeded from and saved to the exposure memory of the sample, edge, and polarization.  Exposures are not checked by default.
     "spiral_dimensions": None,  ## default for spirals is [0.3, 1.8, 1.8], [step_size, diameter_x, diameter_y], useful if our windows are rectangles, not squares
     "group_name": "Group",
     "priority": 1,
     "acquire_status": "Not begun",
     "uid_local": None,  ## Intended so that I can store updates back into this same acquisition
+    "steps_completed": None,  ## List of step ids that have finished, so that an interrupted acquisition resumes from its first unfinished step.  Cleared when acquire_status is reset (see isAcquisitionResumable).
     "notes": None,
 }
 ## TODO: would like a cycles-like parameter where I can sleep up and down in energy.  Lucas would want that.
@@ -369,8 +376,33 @@ def sanitizeAcquisition(acquisitionInput):
     if not isinstance(acquisition[parameter_name], (int, float)): raise ValueError(str(parameter_name) + " must be a positive integer.")
     acquisition[parameter_name] = int(acquisition[parameter_name])
 
+    parameterName = "energy_sweep_order"
+    if acquisition[parameterName] not in ("ascending", "snake"): raise ValueError("Please enter valid " + str(parameterName) + ", either ascending or snake.")
+
+    parameterName = "detector_mode"
+    if acquisition[parameterName] is not None and acquisition[parameterName] not in detectorModes: raise ValueError("Please enter valid " + str(parameterName) + ", one of " + str(list(detectorModes)) + ".")
+
+    parameterName = "exposure_memory"
+    if not isinstance(acquisition[parameterName], (bool, int, float, np.bool_)): raise TypeError(str(parameterName) + " must be True or False.")
+    acquisition[parameterName] = bool(acquisition[parameterName])
+
     parameterName = "priority"
     if not isinstance(acquisition[parameterName], (int, float)): raise TypeError(str(parameterName) + " must be an integer.")
+
+    parameterName = "temperatures"
+    if isinstance(acquisition[parameterName], (list, tuple)):
+        if len(acquisition[parameterName]) == 0: acquisition[parameterName] = None
+        elif len(acquisition[parameterName]) == 1: acquisition[parameterName] = acquisition[parameterName][0]
+        else: raise ValueError("Only one temperature per acquisition is supported.  Please enter a separate acquisition for each temperature.")
+    if acquisition[parameterName] is not None and not isinstance(acquisition[parameterName], (int, float)): raise TypeError(str(parameterName) + " must be a single number in C.")
+
+    parameterName = "steps_completed"
+    ## Set here rather than in the defaults so that every acquisition gets its own list
+    if acquisition[parameterName] is None: acquisition[parameterName] = []
+    if not isinstance(acquisition[parameterName], (list, tuple)): raise TypeError(str(parameterName) + " must be a list.")
+    acquisition[parameterName] = list(acquisition[parameterName])
+    ## Completed steps only carry over while the acquisition is Started (resume) or Finished.  Any other acquire_status, e.g., set back to "Not begun" to requeue it, runs every step again.
+    if not isAcquisitionResumable(acquisition): acquisition[parameterName] = []
     
     
     ## Sanitize parameters for specific scan types
@@ -381,6 +413,9 @@ def sanitizeAcquisition(acquisitionInput):
         acquisition = sanitizeSpirals(acquisition)
     elif acquisition[parameterName] in ("nexafs", "rsoxs"):
         acquisition = sanitizeEnergyScan(acquisition)
+    elif acquisition[parameterName] == "nexafs_fly":
+        acquisition = sanitizeEnergyScan(acquisition)
+        acquisition = sanitizeFlyScan(acquisition)
     else: raise ValueError("Please enter valid " + str(parameterName))
 
     ## Adding a local UID (not the same as Tiled's UID) so that I can identify this scan when I want to update it with data while it is running like acquireStatus
@@ -437,6 +472,20 @@ def sanitizeEnergyScan(acquisitionInput):
     if isinstance(acquisition[parameterName], str):
         if acquisition[parameterName] not in list(energy_list_parameters.keys()):
             raise ValueError("Please enter valid energy plan.")
+    ## Steps that do not divide their region and grids that change direction only give a warning, because nbs_energy_scan runs them as they are.
+    validate_energy_grid(acquisition[parameterName], strict=False)
+
+    return acquisition
+
+
+def sanitizeFlyScan(acquisitionInput):
+    acquisition = copy.deepcopy(acquisitionInput)
+    ## Fly scans need at least one region to move through, so a single energy is not enough
+    parameterName = "energy_list_parameters"
+    get_fly_segments(acquisition[parameterName], acquisition["exposure_time"])
+    
+    parameterName = "exposures_per_energy"
+    if acquisition[parameterName] != 1: raise ValueError(str(parameterName) + " must be 1 for nexafs_fly.  Use a longer exposure_time to slow down the scan instead.")
 
     return acquisition
 
@@ -446,7 +495,96 @@ def sanitizeEnergyScan(acquisitionInput):
 ## One of the features of dry running in the old code was that it could indicate if something might fall out of a motor range.  But if that is documented and hard-coded and sanitized here, that might be better?
 
 
-def sortAcquisitionsQueue(acquisitions, sortBy=["priority"]):
+## Spreadsheet-friendly names for the grouping directives accepted by sortAcquisitionsQueue.
+## e.g., "group by configuration" and "configuration" both map onto the configuration_instrument parameter.
+sortingCriteria_Aliases = {
+    "priority": "priority",
+    "configuration": "configuration_instrument",
+    "configuration_instrument": "configuration_instrument",
+    "edge": "edge",
+    "energy": "edge",
+    "temperature": "temperature",
+    "temperatures": "temperature",
+    "bar_side": "bar_side",
+    "side": "bar_side",
+    "sample": "sample_id",
+    "sample_id": "sample_id",
+    "scan_type": "scan_type",
+    "group_name": "group_name",
+}
+
+
+def sanitizeSortingCriteria(sortBy):
+    """
+    Converts sorting directives into a list of acquisition parameters to sort by.
+
+    Accepts either a list (e.g., ["group by configuration", "priority"]) or a single comma-separated string
+    as it might be typed into a spreadsheet cell (e.g., "group by edge, priority").
+    """
+    if sortBy is None: return ["priority"]
+    if isinstance(sortBy, str): sortBy = sortBy.split(",")
+
+    sortingCriteria = []
+    for sortingCriterion in sortBy:
+        criterion = str(sortingCriterion).strip().lower()
+        criterion = re.sub(r"^group\s+by\s+", "", criterion)
+        criterion = re.sub(r"\s+", "_", criterion)
+        if criterion == "": continue
+        if criterion not in sortingCriteria_Aliases and criterion not in acquisitionParameters_Default:
+            raise ValueError("Sorting criterion " + str(sortingCriterion) + " is not recognized.")
+        sortingCriteria.append(sortingCriteria_Aliases.get(criterion, criterion))
+
+    return sortingCriteria
+
+
+def getAcquisitionEdge(acquisition):
+    """
+    Returns a name for the absorption edge that an acquisition is run at so that acquisitions can be grouped by edge.
+
+    See get_energy_edge for how the edge is found from the energy list parameters.
+    """
+    return get_energy_edge(acquisition.get("energy_list_parameters"))
+
+
+def getAcquisitionSortingValue(acquisition, sortingCriterion, barSides={}):
+    ## Value that identifies the group an acquisition belongs to for a given sorting criterion
+    if sortingCriterion == "edge": return getAcquisitionEdge(acquisition)
+    if sortingCriterion == "temperature":
+        temperatures = acquisition.get("temperatures")
+        if isinstance(temperatures, (list, tuple)): temperatures = temperatures[0] if len(temperatures) > 0 else None
+        return temperatures
+    if sortingCriterion == "bar_side": return barSides.get(acquisition["sample_id"])
+    value = acquisition.get(sortingCriterion)
+    ## Lists are not hashable, so they would not be usable as group identifiers
+    if isinstance(value, list): value = tuple(value)
+    return value
+
+
+def isAcquisitionResumable(acquisition):
+    ## Whether steps_completed applies: the acquisition was started or finished and its status has not been reset since
+    status = str(acquisition.get("acquire_status"))
+    return "Started" in status or "Finished" in status
+
+
+def resetAcquisitionSteps(acquisition):
+    ## Requeues an acquisition so that all of its steps run again
+    acquisition["acquire_status"] = acquisitionParameters_Default["acquire_status"]
+    acquisition["steps_completed"] = []
+    return acquisition
+
+
+def sortAcquisitionsQueue(acquisitions, sortBy=["priority"], configuration=None):
+    """
+    Builds the queue of acquisitions to run and puts it in order.
+
+    sortBy is a list of criteria in decreasing order of importance.
+    "priority" sorts numerically.  Every other criterion is a grouping directive (e.g., "group by configuration",
+    "group by edge", "group by temperature", "group by bar side") that keeps acquisitions with the same value together.
+    Groups are ordered by where they first show up in the spreadsheet, except for temperature, which is ordered by setpoint.
+    A single stable sort on a composite key is used, so acquisitions that tie on every criterion stay in spreadsheet order.
+
+    configuration is only needed to group by bar side, because sample information is not stored in the acquisition.
+    """
     queue = []
     for indexAcquisition, acquisition in enumerate(copy.deepcopy(acquisitions)):
         ## Acquisitions that should not be added to queue
@@ -454,12 +592,36 @@ def sortAcquisitionsQueue(acquisitions, sortBy=["priority"]):
         if acquisition["scan_type"] == "spiral":
             ## If a good spot is found before the spiral scan is complete, can pause the queue.  Once the queue is resumed, a started spiral scan will get skipped.
             if "Started" in acquisition["acquire_status"]: continue
-        
+
         queue.append(acquisition)
 
-    for indexSortingCriterion, sortingCriterion in enumerate(sortBy):
-        if sortingCriterion == "priority":
-            queue = sorted(queue, key=lambda x: x["priority"])
+    sortingCriteria = sanitizeSortingCriteria(sortBy)
+
+    barSides = {}
+    if "bar_side" in sortingCriteria:
+        if configuration is None: raise ValueError("A configuration is needed to group acquisitions by bar side.")
+        barSides = {sample["sample_id"]: ("front" if sample["front"] else "back") for sample in configuration}
+
+    ## Rank each group once so that the sort key is a cheap tuple lookup.  Overall, sorting is O(n log n).
+    groupRanks = {}
+    for sortingCriterion in sortingCriteria:
+        if sortingCriterion == "priority": continue
+        values = [getAcquisitionSortingValue(acquisition, sortingCriterion, barSides) for acquisition in queue]
+        if sortingCriterion == "temperature":
+            ## Setpoints are ordered monotonically to avoid ramping the temperature up and down.  Acquisitions without a setpoint go first.
+            valuesOrdered = sorted(set(values), key=lambda value: (value is not None, value if value is not None else 0))
+        else:
+            valuesOrdered = list(dict.fromkeys(values))
+        groupRanks[sortingCriterion] = {value: rank for rank, value in enumerate(valuesOrdered)}
+
+    def getSortingKey(acquisition):
+        key = []
+        for sortingCriterion in sortingCriteria:
+            if sortingCriterion == "priority": key.append(acquisition["priority"])
+            else: key.append(groupRanks[sortingCriterion][getAcquisitionSortingValue(acquisition, sortingCriterion, barSides)])
+        return tuple(key)
+
+    queue = sorted(queue, key=getSortingKey)
 
     return queue
 
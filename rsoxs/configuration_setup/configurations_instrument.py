@@ -32,9 +32,13 @@ from nbs_bl.hw import (
 )
 
 from ..HW.energy import mono_en, grating_to_1200
+from ..devices.detector_modes import geometryBinning, detectorMode_Default, get_mode_settings, rescale_geometry, get_beam_center_unbinned
 
 GLOBAL_CONFIGURATION_DICT = GLOBAL_USER_STATUS.request_status_dict("RSoXS_Config")
 
+## WAXS mask of the scattering configurations, in pixels of full frames at geometryBinning
+waxsMask_Default = [(477.418, 535.415), (446.074, 511.344), (872.214, -0.476), (948.916, -0.476)]
+
 
 def load_configuration(
         configuration_name,
@@ -53,6 +57,7 @@ def load_configuration(
             "RSoXS_WAXS_SDD": None,
             "RSoXS_WAXS_BCX": None,
             "RSoXS_WAXS_BCY": None,
+            "WAXS_Mask": None,
             "RSoXS_SAXS_SDD": None,
             "RSoXS_SAXS_BCX": None,
             "RSoXS_SAXS_BCY": None,
@@ -66,13 +71,33 @@ def load_configuration(
             "RSoXS_WAXS_SDD": 31.960803248151926,
             "RSoXS_WAXS_BCX": 474,
             "RSoXS_WAXS_BCY": 502,
-            "WAXS_Mask": [(477.418, 535.415), (446.074, 511.344), (872.214, -0.476), (948.916, -0.476)],
+            "WAXS_Mask": copy.deepcopy(waxsMask_Default),
             "RSD": None,
             "RSoXS_SAXS_BCX": None,
             "RSoXS_SAXS_BCY": None,
         }
         bl.md.update(mdToUpdate)
 
+    ## Every geometry key is set above for full frames at geometryBinning, so nothing rescaled for an earlier mode is carried over.
+    ## It is then rescaled to the detector mode the WAXS CCD is in.
+    bl.md.update({"RSoXS_WAXS_Binning": geometryBinning, "RSoXS_WAXS_Offset": [0, 0]})
+    settings = bl["waxs_det"].detector_mode_settings or get_mode_settings(detectorMode_Default)
+    bl.md.update(rescale_geometry(bl.md, settings))
+
+
+def load_detector_mode(
+        mode,
+        dryrun = False,
+):
+    ## Sets the binning and readout region of the WAXS CCD for an acquisition and rescales the geometry metadata to match.  None leaves the detector as it is.
+    if mode is None: return
+    print("Loading detector mode: " + str(mode))
+
+    if dryrun == True: return
+
+    settings = yield from bl["waxs_det"].set_detector_mode_plan(mode, beam_center=get_beam_center_unbinned(bl.md))
+    bl.md.update(rescale_geometry(bl.md, settings))
+
 
 def move_motors(configuration_name):
     ## configuration is a string that is a key in the default_configurations dictionary
@@ -758,6 +783,7 @@ def clear_rsoxs():
             "RSoXS_WAXS_SDD": None,
             "RSoXS_WAXS_BCX": None,
             "RSoXS_WAXS_BCY": None,
+            "WAXS_Mask": None,
             "RSoXS_SAXS_SDD": None,
             "RSoXS_SAXS_BCX": None,
             "RSoXS_SAXS_BCY": None,
@@ -0,0 +1,422 @@
+## Persistent dark frame library, so that darks survive kernel restarts and are shared between scans with different exposure times.
+## Every dark taken by a PersistentDarkFramePreprocessor is saved on disk with the detector state (the locked signals) and the CCD temperature when it was taken.
+## When the in-memory cache has no dark for the current state, a dark from the library is used if it is recent enough and was taken at nearly the same temperature.
+## If there is none, but there are darks at other exposure times for the same state, a dark is synthesized from a per-pixel fit of bias + dark current * exposure time.
+## Only when neither is possible is a new dark taken with the shutter closed.
+
+import copy
+import json
+import os
+import time
+import uuid
+
+import numpy as np
+from ophyd import Device
+from bluesky_darkframes import DarkFramePreprocessor, SnapshotDevice, NoMatchingSnapshot
+from frozendict import frozendict
+
+
+darkLibraryDirectory_Default = "/nsls2/data/sst/legacy/RSoXS/dark_library/"
+darkLibraryMaxAge_Default = 3600 ## s
+darkLibraryTemperatureTolerance_Default = 0.5 ## degC
+darkLibraryLimit_Default = 500 ## entries per detector
+
+## Counters since the last reset_dark_library_metrics
+darkLibraryMetrics = {
+    "memory": 0, ## darks found in the in-memory cache of the preprocessor
+    "library": 0, ## darks loaded from the library
+    "synthesized": 0, ## darks synthesized from a bias and dark current fit
+    "taken": 0, ## darks taken with the shutter closed
+}
+
+
+def _load_npy_seq(resource, datum):
+    ## File layout of ophyd.sim.SynSignalWithRegistry, used by SimGreatEyes
+    return np.load(os.path.join(resource["root"], resource["resource_path"]) + "_" + str(datum["datum_kwargs"]["index"]) + ".npy")
+
+
+def _write_npy_seq(directory, image):
+    stem = str(uuid.uuid4())
+    np.save(os.path.join(directory, stem + "_0.npy"), image)
+    resource = {"spec": "NPY_SEQ", "root": directory, "resource_path": stem, "resource_kwargs": {}, "path_semantics": "posix", "uid": str(uuid.uuid4())}
+    datum = {"resource": resource["uid"], "datum_kwargs": {"index": 0}, "datum_id": resource["uid"] + "/0"}
+    return resource, datum
+
+
+def _load_ad_tiff(resource, datum):
+    ## File layout of the area detector TIFF plugin.  Frames of one datum are averaged.
+    from PIL import Image
+    kwargs = resource["resource_kwargs"]
+    path = os.path.join(resource["root"], resource["resource_path"], "")
+    framesPerPoint = kwargs.get("frame_per_point", 1)
+    indexStart = datum["datum_kwargs"]["point_number"] * framesPerPoint
+    frames = [np.asarray(Image.open(kwargs["template"] % (path, kwargs["filename"], index)), dtype=float) for index in range(indexStart, indexStart + framesPerPoint)]
+    return np.mean(frames, axis=0)
+
+
+def _write_ad_tiff(directory, image):
+    from PIL import Image
+    filename = str(uuid.uuid4())
+    template = "%s%s_%6.6d.tiff"
+    Image.fromarray(np.asarray(image, dtype=np.float32)).save(template % (os.path.join(directory, ""), filename, 0))
+    resource = {
+        "spec": "AD_TIFF",
+        "root": directory,
+        "resource_path": "",
+        "resource_kwargs": {"template": template, "filename": filename, "frame_per_point": 1},
+        "path_semantics": "posix",
+        "uid": str(uuid.uuid4()),
+    }
+    datum = {"resource": resource["uid"], "datum_kwargs": {"point_number": 0}, "datum_id": resource["uid"] + "/0"}
+    return resource, datum
+
+
+def _load_ad_hdf5(resource, datum):
+    ## Layout of the areaDetector HDF5 plugin and of HDF5FrameWriter.  Frames of one datum are averaged.
+    import h5py
+    framesPerPoint = resource["resource_kwargs"].get("frame_per_point", 1)
+    indexStart = datum["datum_kwargs"]["point_number"] * framesPerPoint
+    with h5py.File(os.path.join(resource["root"], resource["resource_path"]), "r") as file:
+        return np.mean(file["/entry/data/data"][indexStart:indexStart + framesPerPoint], axis=0)
+
+
+def _write_ad_hdf5(directory, image):
+    from .frame_writer import HDF5FrameWriter
+    writer = HDF5FrameWriter(directory)
+    writer.append(np.asarray(image, dtype=np.float32))
+    writer.close()
+    resource, datum = [doc for name, doc in writer.collect_asset_docs()]
+    return resource, datum
+
+
+## Resource spec : (function to load the dark image of a datum, function to write a synthesized dark image).
+## Darks can only be synthesized for detectors whose images are saved in one of these formats.
+darkImageFormats = {
+    "NPY_SEQ": (_load_npy_seq, _write_npy_seq),
+    "AD_TIFF": (_load_ad_tiff, _write_ad_tiff),
+    "AD_HDF5": (_load_ad_hdf5, _write_ad_hdf5),
+}
+
+
+def _to_json(value):
+    if isinstance(value, np.ndarray): return value.tolist()
+    if isinstance(value, np.generic): return value.item()
+    return str(value)
+
+
+def _make_state_key(state, exclude=None):
+    ## state as made by DarkFramePreprocessor: signal name : tuple of (data key, value) pairs
+    return json.dumps([[name, [list(pair) for pair in values]] for name, values in sorted(state.items()) if name != exclude], default=_to_json)
+
+
+def _get_state_value(state, name):
+    ## Value of the first data key of a locked signal, e.g., the exposure time
+    values = state.get(name)
+    if not values: return None
+    return values[0][1]
+
+
+class StoredSnapshotDevice(SnapshotDevice):
+    """
+    SnapshotDevice rebuilt from a library entry, with new resource and datum uids so that documents are not emitted twice.
+    created is the time.time() when the dark was taken, or when the oldest dark it was synthesized from was taken.
+    """
+
+    def __init__(self, stored, created=None):
+        Device.__init__(self, name=stored["name"])
+        self.created = time.time() if created is None else created
+        self._describe = copy.deepcopy(stored["describe"])
+        self._describe_configuration = copy.deepcopy(stored["describe_configuration"])
+        self._read = copy.deepcopy(stored["read"])
+        self._read_configuration = copy.deepcopy(stored["read_configuration"])
+        self._read_attrs = list(self._read)
+        self._configuration_attrs = list(self._read_configuration)
+        self._asset_docs_cache = [(name, copy.deepcopy(doc)) for name, doc in stored["asset_docs"]]
+        self._assets_collected = False
+        self._remake_docs()
+
+
+class DarkFrameLibrary:
+    """
+    Dark frames on disk, indexed by detector, locked signal state, exposure time, and CCD temperature.
+
+    Parameters
+    ----------
+    directory : str
+        Directory for the index and the dark images.  Created when the first dark is saved, so the library can be made where it is not writable.
+    max_age : float
+        Darks older than this (s) are deleted by prune, and are not used by lookups that do not give their own max_age.
+        PersistentDarkFramePreprocessor looks up darks with its own max_age.
+    temperature_tolerance : float
+        Darks taken more than this (degC) away from the current CCD temperature are not used
+    limit : int
+        Largest number of entries kept per detector.  The oldest are deleted first.
+    """
+
+    def __init__(
+        self,
+        directory=darkLibraryDirectory_Default,
+        max_age=darkLibraryMaxAge_Default,
+        temperature_tolerance=darkLibraryTemperatureTolerance_Default,
+        limit=darkLibraryLimit_Default,
+    ):
+        self.directory = directory
+        self.max_age = max_age
+        self.temperature_tolerance = temperature_tolerance
+        self.limit = limit
+        self.entries = []
+        self._models = {} ## fit cache, cleared whenever an entry is added
+        self.path_index = os.path.join(directory, "dark_library.json")
+        if os.path.exists(self.path_index):
+            with open(self.path_index) as file:
+                self.entries = json.load(file)
+
+    def _make_directory(self):
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _save_index(self):
+        self._make_directory()
+        pathTemporary = self.path_index + ".tmp"
+        with open(pathTemporary, "w") as file:
+            json.dump(self.entries, file, default=_to_json)
+        os.replace(pathTemporary, self.path_index) ## a crash while saving leaves the old index
+
+    def is_valid(self, entry, temperature=None, max_age=None):
+        if time.time() - entry["created"] > (self.max_age if max_age is None else max_age): return False
+        if temperature is not None and entry["temperature"] is not None:
+            if abs(temperature - entry["temperature"]) > self.temperature_tolerance: return False
+        return True
+
+    def _get_valid_entries(self, detector_name, temperature, max_age=None, **matches):
+        entries = [entry for entry in self.entries if entry["detector"] == detector_name and self.is_valid(entry, temperature, max_age)]
+        entries = [entry for entry in entries if all(entry[key] == value for key, value in matches.items())]
+        return sorted(entries, key=lambda entry: entry["created"], reverse=True)
+
+    def add(self, detector_name, state, exposure_signal_name, temperature, snapshot):
+        ## Saves a dark that was just taken.  The dark image is copied into the library if its format is known, so it can be used for fits later.
+        assetDocs = list(snapshot._asset_docs_cache)
+        image = self.load_image(snapshot.read(), assetDocs)
+        filenameImage = None
+        if image is not None:
+            self._make_directory()
+            filenameImage = str(uuid.uuid4()) + ".npy"
+            np.save(os.path.join(self.directory, filenameImage), image)
+        self.entries.append({
+            "detector": detector_name,
+            "state": _make_state_key(state),
+            "state_other": _make_state_key(state, exclude=exposure_signal_name),
+            "exposure": _get_state_value(state, exposure_signal_name),
+            "temperature": temperature,
+            "created": time.time(),
+            "image": filenameImage,
+            "snapshot": {
+                "name": snapshot.name,
+                "describe": snapshot.describe(),
+                "describe_configuration": snapshot.describe_configuration(),
+                "read": snapshot.read(),
+                "read_configuration": snapshot.read_configuration(),
+                "asset_docs": assetDocs,
+            },
+        })
+        entriesDetector = [entry for entry in self.entries if entry["detector"] == detector_name]
+        if len(entriesDetector) > self.limit:
+            self._delete_entries(sorted(entriesDetector, key=lambda entry: entry["created"])[:len(entriesDetector) - self.limit])
+        self._models.clear()
+        self._save_index()
+
+    def find(self, detector_name, state, temperature=None, max_age=None):
+        ## Newest valid entry for exactly this state, or None
+        entries = self._get_valid_entries(detector_name, temperature, max_age, state=_make_state_key(state))
+        return entries[0] if len(entries) > 0 else None
+
+    def load_image(self, reading, asset_docs):
+        ## Dark image of a snapshot, or None if it has no external image in a known format
+        resources = {doc["uid"]: doc for name, doc in asset_docs if name == "resource"}
+        datums = {doc["datum_id"]: doc for name, doc in asset_docs if name == "datum"}
+        for key, value in reading.items():
+            datum = datums.get(value["value"]) if isinstance(value["value"], str) else None
+            if datum is None: continue
+            resource = resources[datum["resource"]]
+            if resource["spec"] not in darkImageFormats: return None
+            try:
+                return np.asarray(darkImageFormats[resource["spec"]][0](resource, datum), dtype=float)
+            except (OSError, KeyError) as error:
+                print("Could not load dark image " + str(value["value"]) + ": " + str(error))
+                return None
+        return None
+
+    def fit_dark_model(self, detector_name, state, exposure_signal_name, temperature=None, max_age=None):
+        """
+        Per-pixel bias and dark current fit over the valid darks that match state in everything except the exposure time.
+
+        Returns
+        -------
+        dict or None
+            bias and rate images, the range of fitted exposure times, and the template entry for synthesized snapshots,
+            or None if there are not darks at two or more exposure times
+        """
+        stateOther = _make_state_key(state, exclude=exposure_signal_name)
+        entries = [entry for entry in self._get_valid_entries(detector_name, temperature, max_age, state_other=stateOther) if entry["image"] is not None]
+        keyModel = (detector_name, stateOther, tuple(entry["created"] for entry in entries))
+        if keyModel in self._models: return self._models[keyModel]
+        exposures = np.array([entry["exposure"] for entry in entries], dtype=float)
+        if len(np.unique(exposures)) < 2:
+            return None
+        images = np.stack([np.load(os.path.join(self.directory, entry["image"])) for entry in entries])
+        ## Least squares line through every pixel at once
+        exposureMean = exposures.mean()
+        weights = (exposures - exposureMean) / np.sum((exposures - exposureMean)**2)
+        rate = np.tensordot(weights, images, axes=1)
+        bias = images.mean(axis=0) - rate * exposureMean
+        model = {
+            "bias": bias,
+            "rate": rate,
+            "exposure_min": float(exposures.min()),
+            "exposure_max": float(exposures.max()),
+            "template": entries[0],
+            "created": min(entry["created"] for entry in entries), ## a synthesized dark is as old as the oldest dark of the fit
+        }
+        self._models[keyModel] = model
+        return model
+
+    def synthesize(self, detector_name, state, exposure_signal_name, temperature=None, max_age=None):
+        """
+        Snapshot with a synthesized dark for state, or None if the detector model does not permit it.
+
+        The exposure time has to be within the range of the fitted darks, and the images of the template dark have to be in a format of darkImageFormats.
+        """
+        exposure = _get_state_value(state, exposure_signal_name)
+        model = self.fit_dark_model(detector_name, state, exposure_signal_name, temperature, max_age)
+        if model is None or exposure is None or not model["exposure_min"] <= exposure <= model["exposure_max"]:
+            return None
+        stored = copy.deepcopy(model["template"]["snapshot"])
+        datums = {doc["datum_id"]: doc for name, doc in stored["asset_docs"] if name == "datum"}
+        resources = {doc["uid"]: doc for name, doc in stored["asset_docs"] if name == "resource"}
+        keyImage = next((key for key, value in stored["read"].items() if isinstance(value["value"], str) and value["value"] in datums), None)
+        if keyImage is None: return None
+        spec = resources[datums[stored["read"][keyImage]["value"]]["resource"]]["spec"]
+        if spec not in darkImageFormats: return None
+
+        image = model["bias"] + model["rate"] * exposure
+        self._make_directory()
+        resource, datum = darkImageFormats[spec][1](self.directory, image)
+        stored["asset_docs"] = [("resource", resource), ("datum", datum)]
+        stored["read"][keyImage]["value"] = datum["datum_id"]
+        ## Readings of the exposure time itself have to match the synthesized dark
+        for key, value in stored["read"].items():
+            if key.endswith("acquire_time"): value["value"] = exposure
+        return StoredSnapshotDevice(stored, model["created"])
+
+    def _delete_entries(self, entries):
+        for entry in entries:
+            if entry["image"] is not None and os.path.exists(os.path.join(self.directory, entry["image"])):
+                os.remove(os.path.join(self.directory, entry["image"]))
+            self.entries.remove(entry)
+
+    def prune(self):
+        ## Deletes entries that are too old to be used and returns how many there were
+        entriesOld = [entry for entry in self.entries if not self.is_valid(entry)]
+        self._delete_entries(entriesOld)
+        self._models.clear()
+        self._save_index()
+        return len(entriesOld)
+
+
+class PersistentDarkFramePreprocessor(DarkFramePreprocessor):
+    """
+    DarkFramePreprocessor that falls back on a DarkFrameLibrary before taking a new dark.
+
+    Parameters
+    ----------
+    library : DarkFrameLibrary
+    temperature_signal : ophyd.Signal, optional
+        CCD temperature, e.g., cam.temperature_actual.  If None, temperatures are not checked.
+    exposure_signal : ophyd.Signal, optional
+        Exposure time signal, which has to be one of the locked_signals.  If None, darks are not synthesized.
+    synthesize : bool
+        Whether to synthesize darks for exposure times that are not in the library
+    library_max_age : float, optional
+        Age (s) up to which darks from the library are used.  Defaults to max_age, so library darks are exactly as fresh as the ones in memory.
+        A larger value reuses older darks, e.g., after a kernel restart, and has to be chosen explicitly.
+    Other keyword arguments are passed to DarkFramePreprocessor.
+    """
+
+    def __init__(self, *, library, temperature_signal=None, exposure_signal=None, synthesize=True, library_max_age=None, **kwargs):
+        super().__init__(**kwargs)
+        self.library = library
+        self.library_max_age = library_max_age
+        self.temperature_signal = temperature_signal
+        self.exposure_signal = exposure_signal
+        self.synthesize = synthesize and exposure_signal is not None
+
+    def _get_temperature(self):
+        if self.temperature_signal is None: return None
+        return float(self.temperature_signal.get())
+
+    def get_library_max_age(self):
+        return self.max_age if self.library_max_age is None else self.library_max_age
+
+    def get_snapshot(self, state):
+        try:
+            snapshot = super().get_snapshot(state)
+            darkLibraryMetrics["memory"] += 1
+            return snapshot
+        except NoMatchingSnapshot:
+            pass
+        temperature = self._get_temperature()
+        exposureSignalName = self.exposure_signal.name if self.exposure_signal is not None else None
+        entry = self.library.find(self.detector.name, state, temperature, self.get_library_max_age())
+        snapshot = None
+        if entry is not None:
+            snapshot = StoredSnapshotDevice(entry["snapshot"], entry["created"])
+            darkLibraryMetrics["library"] += 1
+        elif self.synthesize:
+            snapshot = self.library.synthesize(self.detector.name, state, exposureSignalName, temperature, self.get_library_max_age())
+            if snapshot is not None: darkLibraryMetrics["synthesized"] += 1
+        if snapshot is None:
+            raise NoMatchingSnapshot("No dark in memory or in the library for state " + str(state))
+        ## Cached in memory only, it is already in the library or can be synthesized again
+        self._cache_snapshot(snapshot, state)
+        return snapshot
+
+    def _cache_snapshot(self, snapshot, state):
+        ## Like DarkFramePreprocessor.add_snapshot, but dated back by the age of the dark, so the memory cache drops it when the library would.
+        ## add_snapshot would date it now, and a dark nearly library_max_age old would be used for up to another max_age.
+        age = time.time() - snapshot.created
+        self._evict_old_entries()
+        if self._limit is not None and len(self._cache) >= self._limit:
+            self._cache.popitem()
+        self._cache[frozendict(state)] = (time.monotonic() - age + self.get_library_max_age() - self.max_age, snapshot)
+
+    def get_time_left(self, state):
+        ## Time (s) before there is no dark for state in memory or in the library, 0 if there is none now.  Synthesized darks are not counted.
+        timeLeft = 0
+        key = frozendict(state)
+        if key in self.cache:
+            timeLeft = self.max_age - (time.monotonic() - self.cache[key][0])
+        entry = self.library.find(self.detector.name, state, self._get_temperature(), self.get_library_max_age())
+        if entry is not None:
+            timeLeft = max(timeLeft, self.get_library_max_age() - (time.time() - entry["created"]))
+        return max(timeLeft, 0)
+
+    def add_snapshot(self, snapshot, state=None):
+        ## Called by the preprocessor after it took a new dark, and by DarkFrameScheduler
+        super().add_snapshot(snapshot, state)
+        darkLibraryMetrics["taken"] += 1
+        exposureSignalName = self.exposure_signal.name if self.exposure_signal is not None else None
+        try:
+            self.library.add(self.detector.name, state or {}, exposureSignalName, self._get_temperature(), snapshot)
+        except OSError as error:
+            print("Could not save the dark to the dark library: " + str(error))
+
+
+def reset_dark_library_metrics():
+    for key in darkLibraryMetrics: darkLibraryMetrics[key] = 0
+
+
+def print_dark_library_metrics():
+    print(
+        "Darks: " + str(darkLibraryMetrics["taken"]) + " taken, " + str(darkLibraryMetrics["memory"]) + " from memory, "
+        + str(darkLibraryMetrics["library"]) + " from the library, " + str(darkLibraryMetrics["synthesized"]) + " synthesized"
+    )
+    return dict(darkLibraryMetrics)
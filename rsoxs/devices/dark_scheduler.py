@@ -0,0 +1,185 @@
+## Darks taken during moves that happen with the shutter closed anyway (sample moves, configuration changes, grating changes), instead of on demand by the
+## DarkFramePreprocessor, which stops the queue to take them before the next light frame.
+## The scheduler follows the moves of the devices it is given, and when the plan waits for them, it predicts the locked signal state after the move
+## (e.g., new sample setpoints) and takes the dark for that state while the motors are still moving, if the dark is missing or will soon be too old.
+## Every decision is logged and kept, with the time each dark took and how much of it was hidden by the move.
+
+import logging
+import time
+
+import bluesky.plan_stubs as bps
+from bluesky.preprocessors import plan_mutator
+from ophyd.device import Staged
+
+
+logger = logging.getLogger("bluesky_darkframes")
+
+darkLeadTime_Default = 60 ## s, darks with less time than this before they are too old are taken again
+darkDecisionLimit = 1000 ## decisions kept in DarkFrameScheduler.decisions
+setpointAttributes = ("user_setpoint", "setpoint")
+
+
+class DarkFrameScheduler:
+    """
+    Plan preprocessor that takes darks for the upcoming detector state while devices move.
+
+    It has to be applied after (outside) the dark frame preprocessor, e.g., appended to RE.preprocessors after it, so that the preprocessor does not take the triggers
+    of the scheduled darks for light frames.
+
+    Parameters
+    ----------
+    preprocessor : PersistentDarkFramePreprocessor
+        Provides the detector, dark plan, locked signals, and the darks already available
+    window_devices : list of ophyd.Device
+        Devices whose moves are made with the shutter closed, e.g., sample motors, the WAXS detector translation, and the grating
+    lead_time : float
+        Darks are taken when the dark for the upcoming state is missing or becomes too old in less than this (s)
+    """
+
+    def __init__(self, preprocessor, window_devices, lead_time=darkLeadTime_Default):
+        self.preprocessor = preprocessor
+        self.window_devices = list(window_devices)
+        self.lead_time = lead_time
+        self.decisions = []
+        self.metrics = {"windows": 0, "taken": 0, "fresh": 0, "busy": 0, "finished": 0, "time_darks": 0, "time_hidden": 0, "time_added": 0}
+        self._moves = {} ## group : list of (device, target, status) of the moves started in it
+        self._trigger_status = None ## last trigger of the detector by the plan
+        self._latch = False
+        self._disabled = False
+
+    def disable(self):
+        self._disabled = True
+
+    def enable(self):
+        self._disabled = False
+
+    def __call__(self, plan):
+        if self._disabled:
+            return (yield from plan)
+        self._moves = {}
+        self._trigger_status = None
+        return (yield from plan_mutator(plan, self._process_message))
+
+    def _is_window_device(self, device):
+        return any(device is windowDevice for windowDevice in self.window_devices)
+
+    def _process_message(self, msg):
+        if self._latch: return None, None
+        if msg.command == "set" and self._is_window_device(msg.obj) and msg.kwargs.get("group") is not None:
+            return self._track_move(msg), None
+        if msg.command == "trigger" and msg.obj is self.preprocessor.detector:
+            return self._track_trigger(msg), None
+        if msg.command == "wait" and msg.kwargs.get("group") in self._moves:
+            return self._wait_with_dark(msg), None
+        return None, None
+
+    def _track_move(self, msg):
+        status = yield msg
+        self._moves.setdefault(msg.kwargs["group"], []).append((msg.obj, msg.args[0], status))
+        return status
+
+    def _track_trigger(self, msg):
+        status = yield msg
+        self._trigger_status = status
+        return status
+
+    def _wait_with_dark(self, msg):
+        moves = self._moves.pop(msg.kwargs["group"])
+        timeStart = time.monotonic()
+        self._latch = True
+        try:
+            decision = yield from self._maybe_take_dark(moves)
+        finally:
+            self._latch = False
+        timeDark = time.monotonic() - timeStart
+        result = yield msg
+        if decision["decision"] == "taken":
+            ## The move was still going for the time waited after the dark, so the dark was hidden up to the end of the move
+            timesDone = [getattr(status, "time_done", None) for device, target, status in moves]
+            timeMoveEnd = max([timeDone for timeDone in timesDone if timeDone is not None], default=time.monotonic())
+            timeHidden = min(timeDark, max(timeMoveEnd - timeStart, 0))
+            decision.update({"time_dark": timeDark, "time_hidden": timeHidden, "time_added": timeDark - timeHidden})
+            self.metrics["time_darks"] += timeDark
+            self.metrics["time_hidden"] += timeHidden
+            self.metrics["time_added"] += timeDark - timeHidden
+            logger.info(
+                "Dark taken during the move of " + ", ".join(decision["devices"]) + " in " + str(round(timeDark, 2)) + " s, "
+                + str(round(timeHidden, 2)) + " s hidden by the move"
+            )
+        self._log(decision)
+        return result
+
+    def _read_state(self, moves):
+        ## Locked signal state as DarkFramePreprocessor makes it, with the setpoints of moved devices replaced by their targets
+        targets = {id(device): target for device, target, status in moves}
+        state = {}
+        for signal in self.preprocessor.locked_signals:
+            reading = yield from bps.read(signal)
+            parent = getattr(signal, "parent", None)
+            if id(parent) in targets and signal.attr_name in setpointAttributes:
+                state[signal.name] = tuple((key, targets[id(parent)]) for key in reading)
+            else:
+                state[signal.name] = tuple((key, value["value"]) for key, value in reading.items())
+        return state
+
+    def _maybe_take_dark(self, moves):
+        self.metrics["windows"] += 1
+        decision = {"time": time.time(), "devices": [device.name for device, target, status in moves], "decision": None, "time_left": None}
+        if all(getattr(status, "done", False) for device, target, status in moves):
+            ## Nothing left to overlap with, e.g., moves started long before they are waited for
+            decision["decision"] = "finished"
+            self.metrics["finished"] += 1
+            return decision
+        if self._trigger_status is not None and not self._trigger_status.done:
+            decision["decision"] = "busy"
+            self.metrics["busy"] += 1
+            return decision
+        for device, target, status in moves:
+            self._add_done_time(status)
+
+        state = yield from self._read_state(moves)
+        decision["time_left"] = self.preprocessor.get_time_left(state)
+        if decision["time_left"] >= self.lead_time:
+            decision["decision"] = "fresh"
+            self.metrics["fresh"] += 1
+            return decision
+
+        detector = self.preprocessor.detector
+        ## Between scans the detector is not staged, dark_plan expects it to be
+        staged = getattr(detector, "_staged", Staged.no) == Staged.yes
+        if not staged: yield from bps.stage(detector)
+        snapshot = yield from self.preprocessor.dark_plan(detector)
+        if not staged: yield from bps.unstage(detector)
+        self.preprocessor.add_snapshot(snapshot, state)
+        decision["decision"] = "taken"
+        self.metrics["taken"] += 1
+        return decision
+
+    @staticmethod
+    def _add_done_time(status):
+        def record(status):
+            status.time_done = time.monotonic()
+
+        try:
+            status.add_callback(record)
+        except AttributeError:
+            pass
+
+    def _log(self, decision):
+        if decision["decision"] != "taken":
+            logger.debug("No dark during the move of " + ", ".join(decision["devices"]) + ": " + decision["decision"])
+        self.decisions.append(decision)
+        if len(self.decisions) > darkDecisionLimit: del self.decisions[0]
+
+    def reset_metrics(self):
+        for key in self.metrics: self.metrics[key] = 0
+        self.decisions = []
+
+    def print_metrics(self):
+        print(
+            "Moves: " + str(self.metrics["windows"]) + ", darks taken during moves: " + str(self.metrics["taken"]) + ", not needed: " + str(self.metrics["fresh"])
+            + ", detector busy: " + str(self.metrics["busy"]) + ", move already finished: " + str(self.metrics["finished"]) + ", dark time "
+            + str(round(self.metrics["time_darks"], 1)) + " s, hidden by moves " + str(round(self.metrics["time_hidden"], 1)) + " s, added "
+            + str(round(self.metrics["time_added"], 1)) + " s"
+        )
+        return dict(self.metrics)
@@ -0,0 +1,190 @@
+## Readout modes of the WAXS CCD chosen per acquisition: on-chip binning and a region of interest, so scans that only need a coarse image or a sub-region
+## do not pay for a full-frame readout at every step.  Readout time is mostly spent digitizing pixels, so it drops with the number of binned pixels read.
+## The beam center, mask, and pixel size in the metadata are rescaled to the binning and region of the mode, so reductions work on the smaller frames unchanged.
+## Regions are chosen in unbinned pixels of the saved image, which is the sensor turned by the transform plugin (transform_type), and converted to the sensor for the cam.
+
+import copy
+
+
+sensorShape = (2048, 2048) ## unbinned (rows, columns) of the GreatEyes CCD
+pixelSizeUnbinned = 0.015 ## mm, also of the simulated sensor and 4 times the binned pixel size of the reductions
+## Readout model: every row is shifted whatever the binning and region, and only the binned pixels in the region are digitized
+readoutPixelRates = {"50 kHz": 5e4, "500 kHz": 5e5, "1 MHz": 1e6, "3 MHz": 3e6} ## cam.adc_speed : pixels/s
+readoutAdcSpeed_Default = "1 MHz"
+readoutRowShiftTime = 2e-5 ## s per unbinned row
+readoutOverhead = 0.1 ## s per frame
+
+## Mode name : binning (same in x and y), size (rows, columns) in unbinned image pixels of a region centered on the beam center or None for the full frame
+detectorModes = {
+    "default": {"binning": 4, "region_size": None, "description": "4 x 4 binning, full frame"},
+    "coarse": {"binning": 8, "region_size": None, "description": "8 x 8 binning, full frame, for quick images and NEXAFS-adjacent measurements"},
+    "beam_region": {"binning": 4, "region_size": (1024, 1024), "description": "4 x 4 binning, 1024 x 1024 pixels around the beam center, for time-resolved measurements"},
+}
+detectorMode_Default = "default"
+## Binning and offset of the geometry in the instrument configurations (RSoXS_WAXS_BCX, RSoXS_WAXS_BCY, WAXS_Mask), i.e., of the default mode
+geometryBinning = 4
+## Whether modes write a readout region (cam MinX, MinY, SizeX, SizeY).  Off until it is verified that the GreatEyes driver reads out only the region
+## with the transform plugin in place; without it, modes set the binning only and read the full frame.
+readoutRegion_Enabled = False
+## Modes used when the acquisition does not set detector_mode.  Scan types that do not use the WAXS CCD get no mode.
+detectorModeScanTypes = {"rsoxs": "default", "spiral": "default", "time2D": "beam_region"}
+detectorModeConfigurations = {"NEXAFS": "coarse"} ## text in configuration_instrument : mode, checked before the scan type
+
+
+def get_readout_time(bin_x=1, bin_y=1, adc_speed=readoutAdcSpeed_Default, region=None, shape=sensorShape, row_shift_time=readoutRowShiftTime, overhead=readoutOverhead):
+    """
+    Modeled readout time (s) of one frame.
+
+    region is (row, column, rows, columns) in unbinned sensor pixels, or None for the full sensor.
+    """
+    if adc_speed not in readoutPixelRates:
+        raise ValueError("Unknown readout mode " + str(adc_speed) + ", should be one of " + str(list(readoutPixelRates)) + ".")
+    rows, columns = (shape[0], shape[1]) if region is None else (region[2], region[3])
+    return overhead + shape[0] * row_shift_time + (rows // bin_y) * (columns // bin_x) / readoutPixelRates[adc_speed]
+
+
+def choose_detector_mode(acquisition):
+    ## The detector_mode of the acquisition, or one for its configuration or scan type, or None if the scan does not use the WAXS CCD
+    if acquisition["scan_type"] not in detectorModeScanTypes: return None
+    if acquisition.get("detector_mode") is not None: return acquisition["detector_mode"]
+    for text, mode in detectorModeConfigurations.items():
+        if text in str(acquisition.get("configuration_instrument")): return mode
+    return detectorModeScanTypes[acquisition["scan_type"]]
+
+
+def estimate_readout_time(mode, adc_speed=readoutAdcSpeed_Default, use_region=None):
+    ## Readout time of a mode for planning, with its region placed fully on the sensor
+    if mode is None: return 0
+    if use_region is None: use_region = readoutRegion_Enabled
+    settings = detectorModes[mode]
+    region = None if settings["region_size"] is None or not use_region else (0, 0) + tuple(settings["region_size"])
+    return get_readout_time(settings["binning"], settings["binning"], adc_speed, region)
+
+
+def _image_to_sensor_point(row, column, transform_type, shape=sensorShape):
+    """
+    Sensor pixel of an unbinned image pixel, for the NDPluginTransform types.
+
+    0-3 are rotations by 0, 90, 180, and 270 degrees clockwise, and 4-7 are the same rotations followed by a left-right mirror.
+    """
+    quarterTurns = transform_type % 4
+    ## Shape of the image after the rotation
+    rows, columns = shape if quarterTurns % 2 == 0 else (shape[1], shape[0])
+    if transform_type >= 4: column = columns - 1 - column
+    for index in range(quarterTurns):
+        ## Undo one clockwise quarter turn
+        row, column = columns - 1 - column, row
+        rows, columns = columns, rows
+    return row, column
+
+
+def image_to_sensor_region(region, transform_type, shape=sensorShape):
+    ## (row, column, rows, columns) in the unbinned image to the same in the unbinned sensor
+    row, column, rows, columns = region
+    corners = [
+        _image_to_sensor_point(row, column, transform_type, shape),
+        _image_to_sensor_point(row + rows - 1, column + columns - 1, transform_type, shape),
+    ]
+    rowMin, rowMax = min(corner[0] for corner in corners), max(corner[0] for corner in corners)
+    columnMin, columnMax = min(corner[1] for corner in corners), max(corner[1] for corner in corners)
+    return (rowMin, columnMin, rowMax - rowMin + 1, columnMax - columnMin + 1)
+
+
+def get_image_shape(transform_type, shape=sensorShape):
+    return shape if transform_type % 2 == 0 else (shape[1], shape[0])
+
+
+def get_mode_region(mode, beam_center=None, transform_type=0, shape=sensorShape):
+    """
+    Region (row, column, rows, columns) of a mode in unbinned image pixels, or None for the full frame.
+
+    The region is centered on beam_center (x, y in unbinned image pixels), moved to fit on the sensor, and aligned to the binning.
+    Without a beam center, it is centered on the image.
+    """
+    settings = detectorModes[mode]
+    if settings["region_size"] is None: return None
+    binning = settings["binning"]
+    shapeImage = get_image_shape(transform_type, shape)
+    if beam_center is None: beam_center = (shapeImage[1] / 2, shapeImage[0] / 2)
+    region = []
+    for size, center, length in zip(settings["region_size"], (beam_center[1], beam_center[0]), shapeImage):
+        size = min(size, length)
+        size = size - size % binning
+        position = int(round(center - size / 2))
+        position = min(max(position, 0), length - size)
+        region.append((position - position % binning, size))
+    return (region[0][0], region[1][0], region[0][1], region[1][1])
+
+
+def get_mode_settings(mode, beam_center=None, transform_type=0, shape=sensorShape, use_region=None):
+    """
+    Cam settings and image geometry of a mode.
+
+    Without use_region (readoutRegion_Enabled by default), the region of the mode is ignored and the full frame is read at its binning.
+
+    Returns
+    -------
+    dict
+        binning, region_image (unbinned image pixels, None for the full frame), and min_x, min_y, size_x, size_y of the cam in unbinned sensor pixels
+    """
+    if mode not in detectorModes:
+        raise ValueError("Unknown detector mode " + str(mode) + ", should be one of " + str(list(detectorModes)) + ".")
+    if use_region is None: use_region = readoutRegion_Enabled
+    regionImage = get_mode_region(mode, beam_center, transform_type, shape) if use_region else None
+    regionSensor = (0, 0) + tuple(shape) if regionImage is None else image_to_sensor_region(regionImage, transform_type, shape)
+    return {
+        "mode": mode,
+        "binning": detectorModes[mode]["binning"],
+        "region_image": regionImage,
+        "min_x": regionSensor[1],
+        "min_y": regionSensor[0],
+        "size_x": regionSensor[3],
+        "size_y": regionSensor[2],
+    }
+
+
+def _rescale_point(x, y, binning_from, offset_from, binning_to, offset_to):
+    ## Binned pixel coordinates (x, y) to another binning and region offset (x, y in unbinned pixels), with pixel centers at integer coordinates
+    xUnbinned = (x + 0.5) * binning_from - 0.5 + offset_from[0]
+    yUnbinned = (y + 0.5) * binning_from - 0.5 + offset_from[1]
+    return ((xUnbinned - offset_to[0] + 0.5) / binning_to - 0.5, (yUnbinned - offset_to[1] + 0.5) / binning_to - 0.5)
+
+
+def rescale_geometry(md, settings):
+    """
+    WAXS geometry metadata for the frames of a mode, from metadata with RSoXS_WAXS_Binning and RSoXS_WAXS_Offset (defaults: the configuration geometry).
+
+    Returns
+    -------
+    dict
+        Updated RSoXS_WAXS_BCX, RSoXS_WAXS_BCY, WAXS_Mask, RSoXS_WAXS_Pixel_Size, RSoXS_WAXS_Binning, RSoXS_WAXS_Offset, and RSoXS_WAXS_Detector_Mode
+    """
+    binningFrom = md.get("RSoXS_WAXS_Binning") or geometryBinning
+    offsetFrom = tuple(md.get("RSoXS_WAXS_Offset") or (0, 0))
+    binningTo = settings["binning"]
+    offsetTo = (0, 0) if settings["region_image"] is None else (settings["region_image"][1], settings["region_image"][0])
+    geometry = {
+        "RSoXS_WAXS_Binning": binningTo,
+        "RSoXS_WAXS_Offset": list(offsetTo),
+        "RSoXS_WAXS_Pixel_Size": pixelSizeUnbinned * binningTo,
+        "RSoXS_WAXS_Detector_Mode": settings["mode"],
+    }
+    if md.get("RSoXS_WAXS_BCX") is not None and md.get("RSoXS_WAXS_BCY") is not None:
+        geometry["RSoXS_WAXS_BCX"], geometry["RSoXS_WAXS_BCY"] = _rescale_point(md["RSoXS_WAXS_BCX"], md["RSoXS_WAXS_BCY"], binningFrom, offsetFrom, binningTo, offsetTo)
+    if md.get("WAXS_Mask") is not None:
+        geometry["WAXS_Mask"] = [_rescale_point(x, y, binningFrom, offsetFrom, binningTo, offsetTo) for x, y in copy.deepcopy(md["WAXS_Mask"])]
+    return geometry
+
+
+def get_beam_center_unbinned(md):
+    ## (x, y) of the beam center in unbinned image pixels, or None if the configuration has none
+    if md.get("RSoXS_WAXS_BCX") is None or md.get("RSoXS_WAXS_BCY") is None: return None
+    return _rescale_point(md["RSoXS_WAXS_BCX"], md["RSoXS_WAXS_BCY"], md.get("RSoXS_WAXS_Binning") or geometryBinning, tuple(md.get("RSoXS_WAXS_Offset") or (0, 0)), 1, (0, 0))
+
+
+def print_detector_modes(adc_speed=readoutAdcSpeed_Default):
+    ## Modes with their modeled readout time
+    readoutDefault = estimate_readout_time(detectorMode_Default, adc_speed)
+    for mode, settings in detectorModes.items():
+        readout = estimate_readout_time(mode, adc_speed)
+        print(mode.ljust(12) + " readout " + str(round(readout, 3)) + " s (" + str(round(readoutDefault / readout, 1)) + "x faster than " + detectorMode_Default + "), " + settings["description"])
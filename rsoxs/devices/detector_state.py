@@ -0,0 +1,287 @@
+## Cached desired state of detector signals, so that setting up and staging a detector that is already configured costs nothing.
+## Signal values are kept up to date by monitored subscriptions instead of being read from the PVs, only signals whose value differs from the
+## desired one are written, and writes that do not depend on each other are started together and waited for once, instead of one set(...).wait() after the other.
+## This is also applied to the stage_sigs of a detector and its plugins, which ophyd would otherwise write (and restore) one by one on every stage.
+## ophyd's order is kept where it matters: the stage_sigs of one device are written in order, and those of the detector itself before any of its
+## plugins.  Only the stage_sigs of different plugins are written together, one from each plugin at a time.
+## File plugins are left to ophyd: their stage stops capture and sets the file path before their stage_sigs start capture again.
+
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+signalTolerance_Default = 1e-6
+## Attribute names of signals that are written before (first) or after (last) the others, in order, because the IOC needs them in that order,
+## e.g., acquisition is stopped before settings change, and file capture starts after the file settings.  The order is reversed when restoring.
+signalsFirst = ("acquire",)
+signalsLast = ("capture",)
+
+
+def _is_file_plugin(device):
+    ## ophyd file plugins (FileStoreBase) have a write path template
+    return hasattr(device, "write_path_template")
+
+
+def _get_devices(device):
+    ## device and its sub-devices whose stage_sigs go through the cache.  Sub-devices that are not staged (e.g., the file plugin that is not used,
+    ## see RSOXSGreatEyesDetector.set_frame_writer) and file plugins, which stage and unstage themselves through ophyd, are left out.
+    devices = [device]
+    for attr in getattr(device, "_sub_devices", []):
+        subDevice = getattr(device, attr)
+        if not getattr(subDevice, "stage_enabled", True) or _is_file_plugin(subDevice): continue
+        devices.extend(_get_devices(subDevice))
+    return devices
+
+
+class SignalStateCache:
+    """
+    Monitored values of signals, and batched writes of the ones that differ from a desired state.
+
+    Parameters
+    ----------
+    tolerance : float
+        Numbers closer than this to the desired value are not written
+    timeout : float, optional
+        Time (s) to wait for the writes of a batch
+    """
+
+    def __init__(self, tolerance=signalTolerance_Default, timeout=None):
+        self.tolerance = tolerance
+        self.timeout = timeout
+        self.values = {} ## signal : last monitored (or written) value
+        self.metrics = {"checked": 0, "written": 0, "batches": 0, "time_last": 0}
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+
+    def watch(self, signal):
+        ## Keeps the value of signal from a monitor.  Signals that cannot be monitored are read every time, never cached.
+        if signal in self._subscriptions: return
+
+        def update(value=None, **kwargs):
+            with self._lock:
+                self.values[signal] = value
+
+        try:
+            self._subscriptions[signal] = signal.subscribe(update, run=True)
+        except Exception as error:
+            self._subscriptions[signal] = None
+            print("Could not monitor " + signal.name + ", it will be read when needed: " + str(error))
+
+    def unsubscribe(self):
+        for signal, subscription in self._subscriptions.items():
+            if subscription is not None: signal.unsubscribe(subscription)
+        self._subscriptions = {}
+        self.values = {}
+
+    def is_monitored(self, signal):
+        return self._subscriptions.get(signal) is not None
+
+    def get_value(self, signal):
+        ## The monitored value, or a read if the monitor has not delivered one yet or the signal is not monitored
+        self.watch(signal)
+        if not self.is_monitored(signal): return signal.get()
+        with self._lock:
+            if self.values.get(signal) is not None: return self.values[signal]
+        value = signal.get()
+        with self._lock:
+            self.values[signal] = value
+        return value
+
+    def is_equal(self, signal, value, desired):
+        if value is None: return False
+        if isinstance(desired, str) and not isinstance(value, str):
+            ## Enum signal read as an index, set with its string
+            enumStrings = getattr(signal, "enum_strs", None)
+            try:
+                return enumStrings is not None and enumStrings[int(value)] == desired
+            except (TypeError, ValueError, IndexError):
+                return False
+        if isinstance(value, str) and not isinstance(desired, str):
+            enumStrings = getattr(signal, "enum_strs", None)
+            return enumStrings is not None and value in enumStrings and enumStrings.index(value) == desired
+        if isinstance(desired, (bool, int, float, np.number)) and isinstance(value, (bool, int, float, np.number)):
+            return abs(float(value) - float(desired)) <= self.tolerance
+        if isinstance(value, np.ndarray) or isinstance(desired, np.ndarray):
+            return np.array_equal(np.asarray(value), np.asarray(desired))
+        return value == desired
+
+    def get_pending(self, desired):
+        ## The (signal, value) pairs of desired that differ from the cached values
+        pending = []
+        for signal, value in desired:
+            self.metrics["checked"] += 1
+            if not self.is_equal(signal, self.get_value(signal), value):
+                pending.append((signal, value))
+        return pending
+
+    def _write(self, pending, reverse=False):
+        ## Independent (signal, value) pairs: each is its own chain
+        self._write_chains([[item] for item in pending], reverse)
+
+    def _write_chains(self, chains, reverse=False):
+        """
+        Writes chains (lists of (signal, value) pairs that are written in order).
+
+        signalsFirst are written first and signalsLast last, one at a time, and in between the n-th pairs of all chains are written together,
+        for n = 0, 1, ...  With reverse, chains are written from their end, and signalsLast come first.
+        """
+        pairs = [item for chain in chains for item in chain]
+        first = [(signal, value) for signal, value in pairs if signal.attr_name in signalsFirst]
+        last = [(signal, value) for signal, value in pairs if signal.attr_name in signalsLast]
+        chains = [[(signal, value) for signal, value in chain if signal.attr_name not in signalsFirst + signalsLast] for chain in chains]
+        if reverse: first, last, chains = last[::-1], first[::-1], [chain[::-1] for chain in chains]
+        for signal, value in first:
+            signal.set(value).wait(self.timeout)
+        for index in range(max([len(chain) for chain in chains] + [0])):
+            statuses = [chain[index][0].set(chain[index][1]) for chain in chains if index < len(chain)]
+            for status in statuses:
+                status.wait(self.timeout)
+        for signal, value in last:
+            signal.set(value).wait(self.timeout)
+        with self._lock:
+            for signal, value in pairs:
+                if self.is_monitored(signal): self.values[signal] = value ## until the monitor reports the readback
+        self.metrics["written"] += len(pairs)
+        if len(pairs) > 0: self.metrics["batches"] += 1
+
+    def apply(self, desired):
+        """
+        Writes the signals of desired (list of (signal, value)) whose cached value differs, and waits once for all of them.
+
+        Returns
+        -------
+        list
+            The (signal, value) pairs that were written
+        """
+        timeStart = time.monotonic()
+        pending = self.get_pending(desired)
+        self._write(pending)
+        self.metrics["time_last"] = time.monotonic() - timeStart
+        return pending
+
+    def apply_stage_sigs(self, device):
+        """
+        Applies the stage_sigs of device and its sub-devices through the cache, and empties them until restore_stage_sigs.
+
+        ophyd's stage then only calls stage on the sub-devices.  Changed signals are recorded as in ophyd, so unstage restores them.
+        File plugins keep their stage_sigs, which ophyd applies in their own stage.
+        The stage_sigs of device are written in order before those of its sub-devices, which are written together (see _write_chains).
+
+        Returns
+        -------
+        list
+            (device, stage_sigs) pairs for restore_stage_sigs
+        """
+        stripped = []
+        chains = []
+        for dev in _get_devices(device):
+            stageSigs = getattr(dev, "stage_sigs", None)
+            if not stageSigs: continue
+            chain = []
+            for key, value in stageSigs.items():
+                signal = getattr(dev, key) if isinstance(key, str) else key
+                original = self.get_value(signal)
+                self.metrics["checked"] += 1
+                if not self.is_equal(signal, original, value):
+                    chain.append((signal, value))
+                    dev._original_vals[signal] = original
+            stripped.append((dev, stageSigs))
+            dev.stage_sigs = OrderedDict()
+            chains.append((dev, chain))
+        try:
+            if len(chains) > 0 and chains[0][0] is device:
+                self._write_chains([chains.pop(0)[1]])
+            self._write_chains([chain for dev, chain in chains])
+        except Exception:
+            self.restore_stage_sigs(stripped)
+            raise
+        return stripped
+
+    def restore_stage_sigs(self, stripped):
+        for dev, stageSigs in stripped:
+            dev.stage_sigs = stageSigs
+
+    def restore_original_values(self, device):
+        ## Batched version of the restoring done by ophyd's unstage, for device and its sub-devices: each device in reverse order, sub-devices before device
+        pending = []
+        chains = []
+        for dev in _get_devices(device):
+            originals = getattr(dev, "_original_vals", None)
+            if not originals: continue
+            chain = self.get_pending(list(originals.items()))
+            originals.clear()
+            pending.extend(chain)
+            chains.append((dev, chain))
+        chainDevice = chains.pop(0)[1] if len(chains) > 0 and chains[0][0] is device else []
+        self._write_chains([chain for dev, chain in chains], reverse=True)
+        self._write_chains([chainDevice], reverse=True)
+        return pending
+
+    def forget_original_values(self, device):
+        ## Keeps the staged values, so ophyd's unstage of device and its sub-devices restores nothing
+        for dev in _get_devices(device):
+            originals = getattr(dev, "_original_vals", None)
+            if originals: originals.clear()
+
+    def reset_metrics(self):
+        for key in self.metrics: self.metrics[key] = 0
+
+    def print_metrics(self):
+        print(
+            "Detector signals checked: " + str(self.metrics["checked"]) + ", written: " + str(self.metrics["written"])
+            + " in " + str(self.metrics["batches"]) + " batches, last apply " + str(round(1000 * self.metrics["time_last"], 1)) + " ms"
+        )
+        return dict(self.metrics)
+
+
+def benchmark_signal_state_cache(number_signals=20, put_latency=0.1):
+    """
+    Compares one set(...).wait() per signal with SignalStateCache.apply, for signals whose writes take put_latency (s) each.
+
+    Returns
+    -------
+    dict
+        Times (s) of sequential writes, of a first apply where every signal differs, and of a second apply where none does
+    """
+    from ophyd import Signal
+    from ophyd.status import Status
+
+    class SlowSignal(Signal):
+        def set(self, value, **kwargs):
+            status = Status(self)
+
+            def finish():
+                time.sleep(put_latency)
+                self.put(value)
+                status.set_finished()
+
+            threading.Thread(target=finish, daemon=True).start()
+            return status
+
+    signals = [SlowSignal(name="signal" + str(index), value=0) for index in range(number_signals)]
+    desired = [(signal, index + 1) for index, signal in enumerate(signals)]
+
+    timeStart = time.monotonic()
+    for signal, value in desired:
+        signal.set(value).wait()
+    timeSequential = time.monotonic() - timeStart
+    for signal in signals: signal.put(0)
+
+    cache = SignalStateCache()
+    timeStart = time.monotonic()
+    cache.apply(desired)
+    timeFirst = time.monotonic() - timeStart
+    timeStart = time.monotonic()
+    cache.apply(desired)
+    timeUnchanged = time.monotonic() - timeStart
+    cache.unsubscribe()
+
+    results = {"time_sequential": timeSequential, "time_first": timeFirst, "time_unchanged": timeUnchanged}
+    print(
+        str(number_signals) + " signals: sequential writes " + str(round(timeSequential, 3)) + " s, batched writes " + str(round(timeFirst, 3))
+        + " s, nothing changed " + str(round(1000 * timeUnchanged, 2)) + " ms"
+    )
+    return results
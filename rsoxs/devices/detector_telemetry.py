@@ -0,0 +1,421 @@
+## In-process telemetry of a detector: per-frame metrics (readout time, file write time, saturated pixels) and per-second metrics (CCD temperature,
+## cooling) kept in fixed-size ring buffers, with percentiles and trends on request.
+## Recording a sample costs O(1): a write into a preallocated array and an update of a moving average and a baseline per metric.
+## Hooks are called when the moving average of a metric drifts from its baseline, the mean of its first samples (readout time, file writes), or a state
+## changes (temperature off the setpoint, cooling off, saturated frames), so slow degradation is noticed before the hard thresholds of the suspenders in
+## HW/contingencies are reached.  The baseline is fixed, rather than a slower moving average, so that a drift over hours is not absorbed by it.
+
+import logging
+import threading
+import time
+
+import numpy as np
+
+
+logger = logging.getLogger("bluesky.telemetry")
+
+frameBufferSize_Default = 1000 ## frames kept per metric
+statusBufferSize_Default = 3600 ## status samples kept per metric, an hour at statusPeriod_Default
+statusPeriod_Default = 1 ## s, status metrics are sampled at most this often
+averageWeight = 0.2 ## weight of a new sample in the moving average
+baselineSamples = 20 ## first samples of a metric averaged into its baseline, drift is checked after them
+## Metric : relative change of the moving average from the baseline that fires a hook, and smallest absolute change that counts
+driftTolerances = {
+    "readout_ratio": (0.2, 0.02),
+    "file_write_time": (0.5, 0.02),
+}
+fileWriteLimit_Default = 2 ## s, a single file write slower than this fires a hook
+temperatureTolerance_Default = 1 ## degC from the setpoint, well inside the suspenders at -90 and -75 degC
+percentiles_Default = (50, 90, 99)
+
+
+class RingBuffer:
+    """
+    Last size values of a metric with their times, in preallocated arrays.
+
+    append is O(1).  values, percentile, and trend copy the buffer in time order, so they are meant for queries, not for every sample.
+    """
+
+    def __init__(self, size):
+        self.size = int(size)
+        self._values = np.zeros(self.size)
+        self._times = np.zeros(self.size)
+        self._index = 0
+        self.count = 0 ## values appended since the last clear, including the ones overwritten
+
+    def append(self, value, timestamp=None):
+        self._values[self._index] = value
+        self._times[self._index] = time.time() if timestamp is None else timestamp
+        self._index = (self._index + 1) % self.size
+        self.count += 1
+
+    def clear(self):
+        self._index = 0
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def _ordered(self, array):
+        if self.count < self.size: return array[: self.count].copy()
+        return np.concatenate([array[self._index :], array[: self._index]])
+
+    def values(self):
+        return self._ordered(self._values)
+
+    def times(self):
+        return self._ordered(self._times)
+
+    def last(self):
+        if self.count == 0: return None
+        return float(self._values[self._index - 1])
+
+    def percentile(self, q):
+        if self.count == 0: return None
+        return np.percentile(self.values(), q)
+
+    def trend(self):
+        ## Least-squares slope of the values in units per hour, or None with fewer than two values
+        if len(self) < 2: return None
+        times = self.times()
+        if times[-1] == times[0]: return None
+        return float(np.polyfit((times - times[0]) / 3600, self.values(), 1)[0])
+
+
+class DetectorTelemetry:
+    """
+    Ring buffers of per-frame and per-second metrics of a detector, with hooks on drifts and state changes.
+
+    Detectors call start_frame when triggered, which records the frame when the trigger status is done, and sample_status, which is throttled to once per period.
+    File writes and saturated frames are recorded by the code that writes and checks the frames (record_file_write, record_saturation).
+
+    Hooks are called with an event dict (detector, event, metric, value, baseline, time, message) from the thread that recorded the sample,
+    once when a condition starts.  It has to clear before the hook is called again.
+
+    Parameters
+    ----------
+    name : str
+        Name of the detector, for the events
+    frame_size : int
+        Values kept per frame metric
+    status_size : int
+        Values kept per status metric
+    period : float
+        Shortest time (s) between status samples
+    file_write_limit : float
+        A single file write slower than this (s) fires a file_write_slow event
+    temperature_tolerance : float
+        Difference (degC) of the CCD temperature from its setpoint that fires a temperature_drift event
+    """
+
+    def __init__(
+        self,
+        name,
+        frame_size=frameBufferSize_Default,
+        status_size=statusBufferSize_Default,
+        period=statusPeriod_Default,
+        file_write_limit=fileWriteLimit_Default,
+        temperature_tolerance=temperatureTolerance_Default,
+    ):
+        self.name = name
+        self.frame_size = frame_size
+        self.status_size = status_size
+        self.period = period
+        self.file_write_limit = file_write_limit
+        self.temperature_tolerance = temperature_tolerance
+        self.buffers = {} ## metric : RingBuffer
+        self.averages = {} ## metric : [moving average, baseline, samples in the baseline]
+        self.hooks = [log_telemetry_event]
+        self.events = [] ## last events, at most frame_size
+        self.metrics = {"frames": 0, "status_samples": 0, "events": 0}
+        self._active = set() ## conditions that fired and have not cleared
+        self._time_status = 0
+        self._lock = threading.Lock()
+        self._watched = []
+
+    def add_hook(self, hook):
+        if hook not in self.hooks: self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        if hook in self.hooks: self.hooks.remove(hook)
+
+    def _get_buffer(self, metric, size):
+        buffer = self.buffers.get(metric)
+        if buffer is None:
+            buffer = self.buffers[metric] = RingBuffer(size)
+        return buffer
+
+    def record(self, metric, value, timestamp=None, size=None):
+        ## Appends a sample to the buffer of metric and updates its moving averages
+        if value is None: return
+        value = float(value)
+        with self._lock:
+            self._get_buffer(metric, size or self.frame_size).append(value, timestamp)
+            averages = self.averages.get(metric)
+            if averages is None:
+                averages = self.averages[metric] = [value, 0.0, 0]
+            else:
+                averages[0] += averageWeight * (value - averages[0])
+            if averages[2] < baselineSamples:
+                averages[2] += 1
+                averages[1] += (value - averages[1]) / averages[2]
+        if metric in driftTolerances: self._check_drift(metric)
+
+    def _check_drift(self, metric):
+        tolerance, floor = driftTolerances[metric]
+        average, baseline, count = self.averages[metric]
+        if count < baselineSamples: return
+        change = average - baseline
+        self._update_condition(
+            metric,
+            change > tolerance * abs(baseline) and change > floor,
+            change < tolerance * abs(baseline) / 2 or change < floor / 2,
+            "readout_drift" if metric == "readout_ratio" else "file_write_slow",
+            average,
+            baseline,
+            metric + " averages " + str(round(average, 3)) + ", up from a baseline of " + str(round(baseline, 3)),
+        )
+
+    def reset_baseline(self, metric=None):
+        ## Takes the baseline of metric (default: all metrics) again from the next samples, e.g., after the detector or its IOC were serviced
+        with self._lock:
+            for name in [metric] if metric is not None else list(self.averages):
+                self.averages.pop(name, None)
+                self._active.discard(name)
+
+    def _update_condition(self, condition, started, cleared, event, value, baseline, message):
+        ## Calls the hooks when condition starts, and re-arms it when it clears
+        with self._lock:
+            if started and condition not in self._active:
+                self._active.add(condition)
+            elif cleared and condition in self._active:
+                self._active.discard(condition)
+                return
+            else:
+                return
+        self._fire(event, condition, value, baseline, message)
+
+    def _fire(self, event, metric, value, baseline, message):
+        eventInfo = {
+            "detector": self.name,
+            "event": event,
+            "metric": metric,
+            "value": value,
+            "baseline": baseline,
+            "time": time.time(),
+            "message": self.name + ": " + message,
+        }
+        with self._lock:
+            self.metrics["events"] += 1
+            self.metrics[event] = self.metrics.get(event, 0) + 1
+            self.events.append(eventInfo)
+            if len(self.events) > self.frame_size: del self.events[0]
+        for hook in list(self.hooks):
+            try:
+                hook(eventInfo)
+            except Exception as error:
+                logger.error("Telemetry hook " + str(hook) + " failed: " + str(error))
+
+    def start_frame(self, status, exposure_time, number_frames=1, readout_model=None):
+        """
+        Records the frames of a trigger when status is done.
+
+        The readout time is the time per frame beyond the exposure, and readout_ratio compares it with the modeled readout time (readout_model, s),
+        so that drift is detected across binnings and readout regions.
+        """
+        timeStart = time.monotonic()
+
+        def finish(status):
+            if not status.success: return
+            timeFrame = (time.monotonic() - timeStart) / max(number_frames, 1)
+            readoutTime = timeFrame - exposure_time
+            self.metrics["frames"] += 1
+            self.record("frame_time", timeFrame)
+            self.record("readout_time", readoutTime)
+            if readout_model: self.record("readout_ratio", readoutTime / readout_model)
+
+        status.add_callback(finish)
+        return status
+
+    def record_file_write(self, seconds, timestamp=None):
+        self.record("file_write_time", seconds, timestamp)
+        self._update_condition(
+            "file_write_limit",
+            seconds > self.file_write_limit,
+            seconds < self.file_write_limit,
+            "file_write_slow",
+            seconds,
+            self.file_write_limit,
+            "file write took " + str(round(seconds, 2)) + " s, more than " + str(self.file_write_limit) + " s",
+        )
+
+    def record_saturation(self, statistics):
+        ## From the frame statistics (see frame_statistics.check_frame_exposure)
+        self.record("saturated_pixels", statistics.get("saturated_pixels"))
+        self.record("max_value", statistics.get("max_value"))
+        saturated = bool(statistics.get("saturated"))
+        if saturated: self.metrics["saturated_frames"] = self.metrics.get("saturated_frames", 0) + 1
+        self._update_condition(
+            "saturation",
+            saturated,
+            not saturated,
+            "saturation",
+            statistics.get("saturated_pixels"),
+            None,
+            "frame saturated, " + str(statistics.get("saturated_pixels")) + " saturated pixels",
+        )
+
+    def sample_status(self, temperature, setpoint, cooling, force=False):
+        ## Records the CCD temperature and cooling state, at most once per period unless force
+        timeNow = time.monotonic()
+        if not force and timeNow - self._time_status < self.period: return
+        self._time_status = timeNow
+        self.metrics["status_samples"] += 1
+        difference = temperature - setpoint
+        self.record("temperature", temperature, size=self.status_size)
+        self.record("temperature_error", difference, size=self.status_size)
+        self.record("cooling", 1 if cooling else 0, size=self.status_size)
+        self._update_condition(
+            "cooling",
+            not cooling,
+            bool(cooling),
+            "cooling_off",
+            temperature,
+            setpoint,
+            "cooling is off, the CCD is at " + str(round(temperature, 1)) + " degC",
+        )
+        self._update_condition(
+            "temperature",
+            bool(cooling) and abs(difference) > self.temperature_tolerance,
+            abs(difference) < self.temperature_tolerance / 2,
+            "temperature_drift",
+            temperature,
+            setpoint,
+            "the CCD is at " + str(round(temperature, 2)) + " degC, " + str(round(difference, 2)) + " degC from its setpoint",
+        )
+
+    def _is_watched(self, signal):
+        return any(signal is watchedSignal for watchedSignal, subscription in self._watched)
+
+    def watch_status(self, temperature_signal, get_status):
+        """
+        Samples the status when the monitored temperature changes, besides the samples taken at triggers.
+
+        get_status returns (temperature, setpoint, cooling) without blocking, e.g., from monitored values, since it is called from the monitor callback.
+        """
+        if self._is_watched(temperature_signal): return
+
+        def update(value=None, **kwargs):
+            try:
+                self.sample_status(*get_status())
+            except Exception as error:
+                logger.debug("Telemetry status sample of " + self.name + " failed: " + str(error))
+
+        try:
+            self._watched.append((temperature_signal, temperature_signal.subscribe(update, run=False)))
+        except Exception as error:
+            print("Could not monitor " + temperature_signal.name + ", the temperature is sampled at triggers only: " + str(error))
+            self._watched.append((temperature_signal, None))
+
+    def watch_file_writes(self, cam_counter, file_counter):
+        ## Records the time from a frame in the cam to the same frame written by the file plugin, from the timestamps of their array counters
+        if self._is_watched(file_counter): return
+        timesFrame = {}
+
+        def cam_update(value=None, timestamp=None, **kwargs):
+            timesFrame[value] = timestamp
+            if len(timesFrame) > 16: del timesFrame[next(iter(timesFrame))]
+
+        def file_update(value=None, timestamp=None, **kwargs):
+            timeFrame = timesFrame.pop(value, None)
+            if timeFrame is not None and timestamp is not None: self.record_file_write(timestamp - timeFrame)
+
+        try:
+            self._watched.append((cam_counter, cam_counter.subscribe(cam_update, run=False)))
+            self._watched.append((file_counter, file_counter.subscribe(file_update, run=False)))
+        except Exception as error:
+            print("Could not monitor the array counters of " + self.name + ", file writes are not timed: " + str(error))
+
+    def unsubscribe(self):
+        for signal, subscription in self._watched:
+            if subscription is not None: signal.unsubscribe(subscription)
+        self._watched = []
+
+    def get_summary(self, percentiles=percentiles_Default):
+        """
+        Statistics of every metric.
+
+        Returns
+        -------
+        dict
+            Metric : samples, last value, percentiles (p50, ...), trend per hour, moving average, and baseline
+        """
+        summary = {}
+        for metric, buffer in list(self.buffers.items()):
+            if buffer.count == 0: continue
+            values = buffer.values()
+            summary[metric] = {"samples": buffer.count, "last": buffer.last()}
+            for q, value in zip(percentiles, np.percentile(values, percentiles)):
+                summary[metric]["p" + str(q)] = float(value)
+            summary[metric]["trend"] = buffer.trend()
+            summary[metric]["average"], summary[metric]["baseline"] = self.averages.get(metric, [None, None])[:2]
+        return summary
+
+    def reset_metrics(self):
+        with self._lock:
+            for buffer in self.buffers.values(): buffer.clear()
+            self.averages = {}
+            self.events = []
+            self._active = set()
+            self.metrics = {"frames": 0, "status_samples": 0, "events": 0}
+
+    def print_metrics(self, percentiles=percentiles_Default):
+        summary = self.get_summary(percentiles)
+        print(
+            self.name + ": " + str(self.metrics["frames"]) + " frames, " + str(self.metrics["status_samples"]) + " status samples, "
+            + str(self.metrics["events"]) + " events" + "".join(", " + key + " " + str(value) for key, value in self.metrics.items() if key not in ("frames", "status_samples", "events"))
+        )
+        for metric, statistics in summary.items():
+            trend = "" if statistics["trend"] is None else ", trend " + str(round(statistics["trend"], 4)) + " per hour"
+            print(
+                "  " + metric.ljust(18) + " last " + str(round(statistics["last"], 4)) + ", "
+                + ", ".join("p" + str(q) + " " + str(round(statistics["p" + str(q)], 4)) for q in percentiles) + trend
+            )
+        return summary
+
+
+def log_telemetry_event(event):
+    logger.warning("Detector telemetry, " + event["event"] + ": " + event["message"])
+
+
+def benchmark_detector_telemetry(number_samples=100000, size=frameBufferSize_Default):
+    """
+    Times recording samples and computing the summary, and checks that a slow drift of the readout time fires a hook.
+
+    Returns
+    -------
+    dict
+        Time (s) per recorded sample, time of a summary, and the sample at which readout_drift fired (None if it did not)
+    """
+    telemetry = DetectorTelemetry("benchmark", frame_size=size)
+    telemetry.hooks = []
+    fired = []
+    telemetry.add_hook(lambda event: fired.append(event))
+    rng = np.random.default_rng(0)
+    ## Readout time 5 % above the model with 2 % noise, drifting up by half after half of the samples
+    ratios = 1.05 + 0.02 * rng.standard_normal(number_samples)
+    ratios[number_samples // 2 :] += np.linspace(0, 0.5, number_samples - number_samples // 2)
+    timeStart = time.perf_counter()
+    for index, ratio in enumerate(ratios):
+        telemetry.record("readout_ratio", ratio)
+        if fired and "sample" not in fired[0]: fired[0]["sample"] = index
+    timeSample = (time.perf_counter() - timeStart) / number_samples
+    timeStart = time.perf_counter()
+    telemetry.get_summary()
+    timeSummary = time.perf_counter() - timeStart
+    results = {"time_sample": timeSample, "time_summary": timeSummary, "drift_sample": fired[0]["sample"] if fired else None}
+    print(
+        "Recorded " + str(number_samples) + " samples in " + str(round(1e6 * timeSample, 2)) + " us each, summary of " + str(size) + " samples in "
+        + str(round(1e3 * timeSummary, 2)) + " ms, readout drift reported at sample " + str(results["drift_sample"]) + " (drift starts at " + str(number_samples // 2) + ")"
+    )
+    return results
@@ -1,3 +1,4 @@
+import datetime
 import time
 from bluesky.run_engine import Msg
 import bluesky.plan_stubs as bps
@@ -13,6 +14,9 @@ from ophyd.areadetector import (
     TransformPlugin,
 )
 from ophyd.areadetector.base import ad_group
+from ophyd.areadetector.plugins import HDF5Plugin_V33
+from ophyd.areadetector.filestore_mixins import FileStoreHDF5IterativeWrite
+from ophyd.device import Staged
 from nslsii.ad33 import SingleTriggerV33, StatsPluginV33
 from nbs_bl.printing import boxed_text, colored, run_report
 from nbs_bl.hw import (
@@ -23,6 +27,12 @@ from nbs_bl.hw import (
 )
 from nbs_bl.beamline import GLOBAL_BEAMLINE as bl
 from sst_base.cameras import TIFFPluginWithProposalDirectory
+from .frame_statistics import check_frame_exposure
+from .frame_accumulator import FrameAccumulator, saturationLevel_Default
+from .frame_writer import configure_hdf5_plugin
+from .detector_state import SignalStateCache
+from .detector_telemetry import DetectorTelemetry
+from .detector_modes import get_mode_settings, get_readout_time, get_image_shape, detectorMode_Default, readoutPixelRates, readoutAdcSpeed_Default, readoutRegion_Enabled
 import warnings
 
 run_report(__file__)
@@ -89,6 +99,48 @@ class GreateyesTransform(TransformPlugin):
     type = C(EpicsSignal, "Type")
 
 
+class HDF5PluginWithTIFFDirectory(HDF5Plugin_V33, FileStoreHDF5IterativeWrite):
+    """
+    HDF5 plugin saving the frames of a run in one chunked, compressed file (see frame_writer.configure_hdf5_plugin), in the directory of the TIFF plugin.
+
+    It is only staged, and only makes resource and datum documents, when the frame_writer of the parent is "hdf5" (see RSOXSGreatEyesDetector.set_frame_writer)
+    and frames are not accumulated, since the accumulator saves its sums itself.
+    The TIFF plugin is staged before it, so the directory is the one of the current proposal.
+    """
+
+    read_pattern = "frames"  # see frame_writer.choose_frame_chunks
+    itemsize = 4  # bytes per pixel, the frames are 32-bit
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stage_sigs.update([("nd_array_port", "TRANS1")])
+        self.stage_sigs.move_to_end("capture")  # the file is opened once the rest is set
+
+    @property
+    def stage_enabled(self):
+        return getattr(self.parent, "frame_writer", "hdf5") == "hdf5" and getattr(self.parent, "accumulator", None) is None
+
+    def stage(self):
+        if not self.stage_enabled:
+            return []
+        tiff = self.parent.tiff
+        self.reg_root = tiff.reg_root
+        self.write_path_template = tiff.write_path_template
+        self.read_path_template = tiff.read_path_template
+        configure_hdf5_plugin(self, self.parent.get_frame_shape(), self.read_pattern, self.itemsize)
+        return super().stage()
+
+    def unstage(self):
+        if self._staged == Staged.no:
+            return []
+        return super().unstage()
+
+    def generate_datum(self, key, timestamp, datum_kwargs):
+        if self._staged != Staged.yes:
+            return None
+        return super().generate_datum(key, timestamp, datum_kwargs)
+
+
 class RSOXSGreatEyesDetector(SingleTriggerV33, GreatEyesDetector):
 
     image = C(ImagePlugin, "image1:", kind="config")
@@ -104,19 +156,31 @@ class RSOXSGreatEyesDetector(SingleTriggerV33, GreatEyesDetector):
         read_attrs=["time_stamp"],
         kind="hinted",
     )
+    hdf5 = C(HDF5PluginWithTIFFDirectory, "HDF1:", write_path_template="/", kind="omitted")  # used instead of tiff with set_frame_writer("hdf5")
+    frame_writer = "tiff"  # plugin saving the frames, see set_frame_writer
 
     stats1 = C(StatsWithHist, "Stats1:", kind="hinted")
     stats2 = C(StatsWithHist, "Stats2:")
     under_exposed = C(BooleanSignal, value=False, kind="hinted", name="under_exposed")
     saturation_high_threshold = 100000
     saturation_high_pixel_count = 500  # 500 pixels reading over 200,000 means over exposed
+    saturation_level = saturationLevel_Default  # full scale of the 18-bit frames, pixels there are clipped and masked by the accumulator
     saturation_low_threshold = 500
     saturation_low_pixel_count = 500  # 500 pixels reading under 500 means extremely over exposed
     saturated = C(BooleanSignal, value=False, kind="hinted", name="saturated")
+    accumulated_frames = C(Signal, value=1, kind="config")  # exposures summed per trigger, see set_accumulation
     high_sat_check = [False, False]
 
     underexposure_min_value = 2000
     underexposure_num_pixels = 950000  # 700000 pixels reading under 2000 counts means underexposed
+    # Check exposure from the image array in process rather than from the Stats plugin histograms.  Off by default: the histogram callbacks keep
+    # saturated and under_exposed current in every event, while the frame statistics are only computed when exposure is checked and need the
+    # whole image1 array over Channel Access.  The accumulator computes its own statistics from the frames it sums.
+    use_frame_statistics = False
+    frame_statistics = None  # statistics of the last checked frame
+    accumulator = None  # FrameAccumulator when exposures are summed, see set_accumulation
+    detector_mode_settings = None  # binning and region of the mode from set_detector_mode, None for the full frame at binvalue
+    use_readout_region = readoutRegion_Enabled  # write the readout region of modes to the cam, see detector_modes.readoutRegion_Enabled
     # stats3 = C(StatsPluginV33, 'Stats3:')
     # stats4 = C(StatsPlugin, 'Stats4:')
     # stats5 = C(StatsPlugin, 'Stats5:')
@@ -128,9 +192,12 @@ class RSOXSGreatEyesDetector(SingleTriggerV33, GreatEyesDetector):
     # proc1 = C(ProcessPlugin, 'Proc1:')
     binvalue = 4
     useshutter = True
+    keep_staged_state = False  # True leaves the stage_sigs values in place on unstage, so that the next stage has nothing to write.  Off: unstage restores them as in ophyd
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.state_cache = SignalStateCache()  # monitored signal values, so only settings that differ are written
+        self.telemetry = DetectorTelemetry(self.name)  # readout, file write, temperature, and saturation history, see print_telemetry
         self.setup_cam()
         self.stats1.hist_below.subscribe(self.check_saturation_low)
         self.stats2.hist_below.subscribe(self.check_exposure_low)
@@ -138,19 +205,22 @@ class RSOXSGreatEyesDetector(SingleTriggerV33, GreatEyesDetector):
 
     def setup_cam(self):
         self.stats1.kind = "hinted"
-        self.stats1.hist_min.set(self.saturation_low_pixel_count).wait()
-        self.stats2.hist_min.set(self.underexposure_min_value).wait()
-        self.stats1.hist_max.set(self.saturation_high_threshold).wait()
-        self.stats2.hist_max.set(self.saturation_high_threshold).wait()
-        self.trans1.enable.set(1).wait()
-        self.trans1.type.set(self.transform_type).wait()
-        self.image.nd_array_port.set("TRANS1").wait()
-        self.tiff.nd_array_port.set("TRANS1").wait()
-        self.cam.temperature.set(-80).wait()
-        self.cam.enable_cooling.set(1).wait()
-        self.cam.bin_x.set(self.binvalue).wait()
-        self.cam.bin_y.set(self.binvalue).wait()
+        ## Only the settings that differ from their monitored values are written, all at once
+        written = self.state_cache.apply([
+            (self.stats1.hist_min, self.saturation_low_pixel_count),
+            (self.stats2.hist_min, self.underexposure_min_value),
+            (self.stats1.hist_max, self.saturation_high_threshold),
+            (self.stats2.hist_max, self.saturation_high_threshold),
+            (self.trans1.enable, 1),
+            (self.trans1.type, self.transform_type),
+            (self.image.nd_array_port, "TRANS1"),
+            (self.tiff.nd_array_port, "TRANS1"),
+            (self.cam.temperature, -80),
+            (self.cam.enable_cooling, 1),
+        ] + self.get_mode_signals())
         # TODO: turn on automonitor on the cam.arraysize
+        if len(written) == 0:
+            return
         warnings.warn(
             "Camera settings were reset and camera cooling was turned on"
             "\nif you did not intend to turn on the cooling, turn it off now",
@@ -158,13 +228,18 @@ class RSOXSGreatEyesDetector(SingleTriggerV33, GreatEyesDetector):
         )
 
     def check_saturation_high(self, old_value, value, **kwargs):
+        if self.use_frame_statistics:
+            return
         if value > self.saturation_high_pixel_count:
             self.high_sat_check[0] = True
         else:
             self.high_sat_check[0] = False
         self.saturated.set(True in self.high_sat_check).wait()
+        self.telemetry.record_saturation({"saturated_pixels": value, "saturated": True in self.high_sat_check})
 
     def check_saturation_low(self, old_value, value, **kwargs):
+        if self.use_frame_statistics:
+            return
         if value > self.saturation_low_pixel_count:
             self.high_sat_check[1] = True
         else:
@@ -172,11 +247,65 @@ class RSOXSGreatEyesDetector(SingleTriggerV33, GreatEyesDetector):
         self.saturated.set(True in self.high_sat_check).wait()
 
     def check_exposure_low(self, old_value, value, **kwargs):
+        if self.use_frame_statistics:
+            return
         if value > self.underexposure_num_pixels:
             self.under_exposed.set(True).wait()
         else:
             self.under_exposed.set(False).wait()
 
+    def get_frame(self):
+        height = self.image.array_size.height.get()
+        width = self.image.array_size.width.get()
+        return self.image.array_data.get()[: height * width].reshape(height, width)
+
+    def check_frame_exposure(self):
+        ## Sets saturated and under_exposed from the last acquired frame and returns its statistics
+        if self.accumulator is not None and self.accumulator.statistics is not None:
+            return self.accumulator.statistics  # already checked when the sum was made
+        return check_frame_exposure(self, self.get_frame())
+
+    def set_accumulation(self, number_frames, directory=None):
+        """
+        Sums number_frames exposures per trigger in memory and stores only the sum (see FrameAccumulator), or stops accumulating if number_frames is 1.
+
+        The TIFF plugin does not save the sub-frames while accumulating.
+        The sums are saved in directory, or by default in the proposal directory of the TIFF plugin, as HDF5PluginWithTIFFDirectory does.
+        """
+        self.accumulator = FrameAccumulator(number_frames, directory) if number_frames > 1 else None
+        self.accumulated_frames.set(max(1, int(number_frames))).wait()
+        self.tiff.stage_sigs["auto_save"] = "No" if self.accumulator is not None else "Yes"
+
+    def set_frame_writer(self, frame_writer, read_pattern="frames"):
+        """
+        Saves the frames as one TIFF file per frame ("tiff", the default), or in one chunked, compressed HDF5 file per run ("hdf5").
+
+        read_pattern is how the HDF5 files will be read, "frames" or "stacks", see frame_writer.choose_frame_chunks.
+        With "hdf5", the TIFF plugin is still staged, for the proposal directory, but is turned off during the run and its documents are dropped.
+        The change takes effect at the next stage.
+        """
+        if frame_writer not in ("tiff", "hdf5"):
+            raise ValueError("Unknown frame writer " + str(frame_writer) + ", should be tiff or hdf5.")
+        self.frame_writer = frame_writer
+        self.hdf5.read_pattern = read_pattern
+        if frame_writer == "hdf5":
+            if sum(self.hdf5.array_size.get()) == 0:
+                self.hdf5.warmup()  # the plugin does not stage before it has received a frame, so one is taken now, outside of a run with the shutter disabled
+            self.tiff.disable_on_stage()
+            self.tiff.kind = "omitted"
+            self.hdf5.kind = "hinted"
+        else:
+            self.tiff.enable_on_stage()
+            self.tiff.kind = "hinted"
+            self.hdf5.kind = "omitted"
+            self.state_cache.apply([(self.hdf5.enable, 0)])  # not staged, so turned off here
+
+    def get_frame_shape(self):
+        ## (rows, columns) of the saved frames, from the readout region of the mode and the binning
+        settings = self.detector_mode_settings or self._get_mode_settings(detectorMode_Default)
+        rows, columns = get_image_shape(self.transform_type, (settings["size_y"], settings["size_x"]))
+        return (rows // self.binvalue, columns // self.binvalue)
+
     def sim_mode_on(self):
         self.useshutter = False
         self.cam.sync.set(0).wait()
@@ -188,17 +317,17 @@ class RSOXSGreatEyesDetector(SingleTriggerV33, GreatEyesDetector):
         self.cam.shutter_mode.set(2).wait()
 
     def stage(self, *args, **kwargs):
-        self.cam.temperature_actual.read()
-        self.cam.temperature.read()
         # self.cam.sync.set(1)
         # self.cam.temperature.set(-80)
         # self.cam.enable_cooling.set(1)
         # print('staging the detector')
+        # self.stage_sigs["cam.num_images"] = self.number_exposures # if we do it this way, the dark stage will also set this?
+        desired = [(self.cam.num_images, self.number_exposures)]
         if self.useshutter:
-
-            shutter_enable.set(1).wait()
-            shutter_delay.set(0).wait()
-        if abs(self.cam.temperature_actual.get() - self.cam.temperature.get()) > 2.0:
+            desired.extend([(shutter_enable, 1), (shutter_delay, 0)])
+        self.state_cache.apply(desired)
+        temperatureDifference = self.state_cache.get_value(self.cam.temperature_actual) - self.state_cache.get_value(self.cam.temperature)
+        if abs(temperatureDifference) > 2.0:
 
             boxed_text(
                 "Temperature Warning!!!!",
@@ -207,25 +336,60 @@ class RSOXSGreatEyesDetector(SingleTriggerV33, GreatEyesDetector):
                 "yellow",
                 85,
             )
-
-        # self.stage_sigs["cam.num_images"] = self.number_exposures # if we do it this way, the dark stage will also set this?
-        self.cam.num_images.set(self.number_exposures).wait()
+        self.watch_telemetry()
 
         ## The below line was used in 2025 and earlier.
         ## However, it might be the source of errors in 2026 onwards
         #return [self].append(super().stage(*args, **kwargs))
         ## The below line is being tried on 20260320 to avoid potential errors with the above line.
         ## TODO: Once all issues are resolved, and images can be taken with the dark_frames_preprocessor_waxs active, test again the below line vs. the above line.
-        return [self] + super().stage(*args, **kwargs)
+        ## The stage_sigs of the detector and its plugins are applied through the state cache, so ophyd only writes the ones that differ, at once
+        stripped = self.state_cache.apply_stage_sigs(self)
+        try:
+            staged = [self] + super().stage(*args, **kwargs)
+        finally:
+            self.state_cache.restore_stage_sigs(stripped)
+        ## After the TIFF plugin is staged, so that its proposal directory is set
+        if self.accumulator is not None:
+            self.accumulator.stage(datetime.datetime.now().strftime(self.tiff.read_path_template))
+        return staged
 
     def trigger(self, *args, **kwargs):
         # if(self.cam.sync.get() != 1):
         #    print(f'Warning: It looks like the {self.name} restarted, putting in default values again')
         #    self.cam.temperature.set(-80)
-        if self.cam.enable_cooling.get() != 1:
+        if self.state_cache.get_value(self.cam.enable_cooling) != 1:
             print(f"Warning: It looks like the {self.name} restarted, putting in default values again")
             self.setup_cam()
-        return super().trigger(*args, **kwargs)
+        self.telemetry.sample_status(*self.get_telemetry_status())
+        if self.accumulator is not None:
+            status = self.accumulator.trigger(self, lambda: super(RSOXSGreatEyesDetector, self).trigger(*args, **kwargs))
+        else:
+            status = super().trigger(*args, **kwargs)
+        numberFrames = self.state_cache.get_value(self.cam.num_images) * (self.accumulator.number_frames if self.accumulator is not None else 1)
+        return self.telemetry.start_frame(status, self.state_cache.get_value(self.cam.acquire_time), numberFrames, self.get_readout_time())
+
+    def get_telemetry_status(self):
+        ## (temperature, setpoint, cooling) from the monitored values, so it does not block
+        return (
+            self.state_cache.get_value(self.cam.temperature_actual),
+            self.state_cache.get_value(self.cam.temperature),
+            self.state_cache.get_value(self.cam.enable_cooling) == 1,
+        )
+
+    def watch_telemetry(self):
+        ## Status samples on temperature updates, and file write times from the array counters of the cam and the TIFF plugin
+        self.telemetry.watch_status(self.cam.temperature_actual, self.get_telemetry_status)
+        self.telemetry.watch_file_writes(self.cam.array_counter, self.tiff.array_counter)
+
+    def print_telemetry(self):
+        return self.telemetry.print_metrics()
+
+    def read(self):
+        res = super().read()
+        if self.accumulator is not None:
+            res = self.accumulator.update_reading(self, res)
+        return res
 
     def describe(self):
         res = super().describe()
@@ -234,9 +398,22 @@ class RSOXSGreatEyesDetector(SingleTriggerV33, GreatEyesDetector):
         # This will only work if we are 100% confident that we will always have 4D data when using this 3D detector.
         updates["chunks"] = (1, 1, -1, -1)  # TODO: How to do this at a plan level to ensure num dims correct
         res["Wide Angle CCD Detector_image"].update(updates)
+        if self.accumulator is not None:
+            res = self.accumulator.update_description(self, res)
         print(res)
         return res
 
+    def collect_asset_docs(self):
+        if self.accumulator is not None:
+            list(super().collect_asset_docs())  # datums of the sub-frames, which are not saved
+            yield from self.accumulator.collect_asset_docs()
+            return
+        if self.frame_writer == "hdf5":
+            list(self.tiff.collect_asset_docs())  # resource and datums of the TIFF plugin, which is turned off
+            yield from self.hdf5.collect_asset_docs()
+            return
+        yield from super().collect_asset_docs()
+
     def skinnystage(self, *args, **kwargs):
         yield Msg("stage", super())
 
@@ -260,11 +437,18 @@ class RSOXSGreatEyesDetector(SingleTriggerV33, GreatEyesDetector):
         self.cam.shutter_mode.det(0)
 
     def unstage(self, *args, **kwargs):
+        desired = [(self.cam.num_images, 1)]
         if self.useshutter:
-            shutter_enable.set(0).wait()
+            desired.append((shutter_enable, 0))
         else:
             print("not turning on shutter because detector is in simulation mode")
-        self.cam.num_images.set(1).wait()
+        self.state_cache.apply(desired)
+        if self.accumulator is not None:
+            self.accumulator.unstage()
+        if self.keep_staged_state:
+            self.state_cache.forget_original_values(self)
+        else:
+            self.state_cache.restore_original_values(self)
         return [self].append(super().unstage(*args, **kwargs))
 
     def skinnyunstage(self, *args, **kwargs):
@@ -341,6 +525,72 @@ class RSOXSGreatEyesDetector(SingleTriggerV33, GreatEyesDetector):
             colored(self.cam.bin_y.get(), "lightpurple"),
         )
 
+    def get_mode_signals(self):
+        ## (signal, value) pairs of the binning, and of the readout region with use_readout_region, see set_detector_mode
+        settings = self.detector_mode_settings or self._get_mode_settings(detectorMode_Default)
+        signals = [
+            (self.cam.bin_x, self.binvalue),
+            (self.cam.bin_y, self.binvalue),
+        ]
+        if self.use_readout_region:
+            signals.extend([
+                (self.cam.min_x, settings["min_x"]),
+                (self.cam.min_y, settings["min_y"]),
+                (self.cam.size.size_x, settings["size_x"]),
+                (self.cam.size.size_y, settings["size_y"]),
+            ])
+        return signals
+
+    def _get_mode_settings(self, mode, beam_center=None):
+        return get_mode_settings(mode, beam_center, self.transform_type, use_region=self.use_readout_region)
+
+    def _select_detector_mode(self, mode, beam_center=None):
+        ## Keeps the settings of the mode for get_mode_signals
+        settings = self._get_mode_settings(mode, beam_center)
+        self.detector_mode_settings = settings
+        self.binvalue = settings["binning"]
+        return settings
+
+    def set_detector_mode(self, mode, beam_center=None):
+        """
+        Sets the binning and readout region of a mode of detector_modes.detectorModes, waiting for the writes.  In plans, use set_detector_mode_plan.
+
+        beam_center is (x, y) in unbinned pixels of the saved image, for modes with a region around it.
+        Only the cam settings that differ are written.
+
+        Returns
+        -------
+        dict
+            Settings of the mode, see detector_modes.get_mode_settings
+        """
+        settings = self._select_detector_mode(mode, beam_center)
+        self.state_cache.apply(self.get_mode_signals())
+        return settings
+
+    def set_detector_mode_plan(self, mode, beam_center=None):
+        """
+        Plan setting a mode as set_detector_mode, with the writes made by the RunEngine.
+
+        Only the cam settings that differ are written, one at a time in the order of get_mode_signals, since the driver checks the region against the binning.
+
+        Returns
+        -------
+        dict
+            Settings of the mode, see detector_modes.get_mode_settings
+        """
+        settings = self._select_detector_mode(mode, beam_center)
+        for signal, value in self.state_cache.get_pending(self.get_mode_signals()):
+            yield from bps.mv(signal, value)
+        return settings
+
+    def get_readout_time(self):
+        ## Modeled readout time of one frame with the current cam settings, from their monitored values
+        adcSpeed = self.cam.adc_speed.get(as_string=True)
+        if adcSpeed not in readoutPixelRates: adcSpeed = readoutAdcSpeed_Default
+        value = self.state_cache.get_value
+        region = (value(self.cam.min_y), value(self.cam.min_x), value(self.cam.size.size_y), value(self.cam.size.size_x))
+        return get_readout_time(value(self.cam.bin_x), value(self.cam.bin_y), adcSpeed, region)
+
     def exposure(self):
         return self.exptime()
 
@@ -426,30 +676,60 @@ class SyncedDetectors(Device):
         shutter_control.get()
 
 
-from ophyd.sim import SynSignalWithRegistry, SynSignal
+from ophyd.sim import SynSignalWithRegistry
 from ophyd import Device, Component, Signal, DeviceStatus
 import numpy as np
+import os
 import threading
+from .sim_greateyes import SimGreatEyesSensor, readoutModes, readoutMode_Default, temperatureAmbient
+
+
+class SimTemperatureSignal(Signal):
+    ## CCD temperature that relaxes toward the setpoint with cooling on, and toward ambient with cooling off
+    cooling_time_constant = 60  # s
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._time_update = time.time()
 
+    def get(self, **kwargs):
+        cam = self.parent
+        target = cam.temperature.get() if cam.enable_cooling.get() else temperatureAmbient
+        timeNow = time.time()
+        self._readback = target + (self._readback - target) * np.exp(-(timeNow - self._time_update) / self.cooling_time_constant)
+        self._time_update = timeNow
+        return self._readback
 
-def make_random_array():
-    # return numpy array
-    return np.zeros([100, 100])
+
+class SimSize(Device):
+    size_x = Component(Signal, value=2048, kind="config")
+    size_y = Component(Signal, value=2048, kind="config")
 
 
 class SimGreatEyesCam(Device):
-    shutter_mode = Component(Signal, value=3)
-    acquire_time = Component(SynSignal, func=lambda: 3 + np.random.rand())
-    bin_x = Component(Signal, value=3)
-    bin_y = Component(Signal, value=3)
-    temperature = Component(Signal, value=-80)
-    temperature_actual = Component(Signal, value=-80)
-    enable_cooling = Component(Signal, value=1)
+    acquire_time = Component(Signal, value=1, kind="hinted")
+    num_images = Component(Signal, value=1, kind="config")
+    shutter_mode = Component(Signal, value=2, kind="config")
+    sync = Component(Signal, value=1, kind="config")
+    adc_speed = Component(Signal, value=readoutMode_Default, kind="config")
+    bin_x = Component(Signal, value=4, kind="config")
+    bin_y = Component(Signal, value=4, kind="config")
+    min_x = Component(Signal, value=0, kind="config")
+    min_y = Component(Signal, value=0, kind="config")
+    size = Component(SimSize)
+    temperature = Component(Signal, value=-80, kind="config")
+    temperature_actual = Component(SimTemperatureSignal, value=-80)
+    enable_cooling = Component(Signal, value=1, kind="config")
 
     def collect_asset_docs(self):
         yield from []
 
 
+class SimStats(Device):
+    total = Component(Signal, value=0, kind="hinted")
+    max_value = Component(Signal, value=0)
+
+
 #  test out the nxsas suitcase
 #  (/home/xf07id1/conda_envs/nxsas-analysis-2019-3.0) xf07id1@xf07id1-ws19:~$ ipython --profile=collection
 # In [1]: import suitcase.nxsas
@@ -457,47 +737,194 @@ class SimGreatEyesCam(Device):
 # In [3]: suitcase.nxsas.export(h.documents(), directory=".")
 
 
-class PatchedSynSignalWithRegistry(Device, SynSignalWithRegistry):
-    def trigger(self):
-        "Promptly return  a status object that will be marked 'done' after self.exposure_time seconds."
-        super().trigger()  # returns NullStatus, which is "done" immediately -- let's do better
-        status = DeviceStatus(self)
-        # In the background, wait for `self.exposure_time` seconds and then mark the status as "done".
-        threading.Timer(self.exposure_time, status._finished).start()
-        return status
+class SimGreatEyes(Device):
+    """
+    Simulated GreatEyes detector with the signals of RSOXSGreatEyesDetector, for profiling plans, preprocessors, and reductions offline.
 
+    Frames come from a SimGreatEyesSensor with the binning, readout mode (cam.adc_speed), and CCD temperature of the cam, and the energy of energy_signal.
+    They are dark when the shutter is disabled (cam.shutter_mode 0), as in dark_plan.
+    A trigger is done after cam.num_images times the exposure and readout time.
+    """
 
-class SimGreatEyes(Device):
     useshutter = True
-
+    saturation_high_threshold = 100000
+    saturation_high_pixel_count = 500
+    saturation_level = saturationLevel_Default
+    saturation_low_threshold = 500
+    saturation_low_pixel_count = 500
+    underexposure_min_value = 2000
+    underexposure_num_pixels = 950000
+    use_frame_statistics = True
+    frame_statistics = None
+    transform_type = 0
+    number_exposures = 1
+    binvalue = 4
+    energy_signal = None  # e.g., the energy setpoint, so that the pattern follows energy scans
+    energy_default = 285.2  # eV, used without an energy_signal
+    accumulator = None  # FrameAccumulator when exposures are summed, see set_accumulation
+    detector_mode_settings = None  # binning and region of the mode from set_detector_mode
+    use_readout_region = readoutRegion_Enabled
+
+    # exposure_time stays 0 so the frame is made when triggered.  The exposure and readout time is added by trigger.
+    # A Signal is not staged by its parent, so stage and unstage stage the image.
     image = Component(
-        PatchedSynSignalWithRegistry,
-        func=make_random_array,
+        SynSignalWithRegistry,
         save_path="/tmp/sim_detector_storage/",
-        exposure_time=2,
+        exposure_time=0,
     )
     cam = Component(SimGreatEyesCam)
+    stats1 = Component(SimStats, kind="hinted")
+    saturated = Component(BooleanSignal, value=False, kind="hinted")
+    under_exposed = Component(BooleanSignal, value=False, kind="hinted")
+    accumulated_frames = Component(Signal, value=1, kind="config")
+
+    def __init__(self, *args, sensor=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sensor = sensor if sensor is not None else SimGreatEyesSensor()
+        self.telemetry = DetectorTelemetry(self.name)
+        self._frame = None
+        self.image.sim_set_func(self.make_frame)
+
+    def setup_cam(self):
+        self.cam.temperature.set(-80).wait()
+        self.cam.enable_cooling.set(1).wait()
+        self.cam.bin_x.set(self.binvalue).wait()
+        self.cam.bin_y.set(self.binvalue).wait()
+
+    def get_energy(self):
+        if self.energy_signal is None:
+            return self.energy_default
+        return self.energy_signal.get()
+
+    def get_region(self):
+        ## Readout region (row, column, rows, columns) of unbinned sensor pixels
+        return (self.cam.min_y.get(), self.cam.min_x.get(), self.cam.size.size_y.get(), self.cam.size.size_x.get())
+
+    def get_readout_time(self):
+        return self.sensor.get_readout_time(self.cam.bin_x.get(), self.cam.bin_y.get(), self.cam.adc_speed.get(), self.get_region())
+
+    def get_acquisition_time(self):
+        ## Time from trigger to done, as on the real detector
+        return self.cam.num_images.get() * (self.cam.acquire_time.get() + self.get_readout_time())
+
+    def make_frame(self):
+        frames = [
+            self.sensor.make_frame(
+                self.cam.acquire_time.get(),
+                energy=self.get_energy(),
+                bin_x=self.cam.bin_x.get(),
+                bin_y=self.cam.bin_y.get(),
+                temperature=self.cam.temperature_actual.get(),
+                mode=self.cam.adc_speed.get(),
+                light=self.cam.shutter_mode.get() != 0,
+                region=self.get_region(),
+            )
+            for index in range(self.cam.num_images.get())
+        ]
+        self._frame = frames[0] if len(frames) == 1 else np.stack(frames)
+        return self._frame
+
+    def get_frame(self):
+        return self._frame
+
+    def check_frame_exposure(self):
+        if self.accumulator is not None and self.accumulator.statistics is not None:
+            return self.accumulator.statistics
+        return check_frame_exposure(self, self.get_frame())
+
+    def set_accumulation(self, number_frames, directory="/tmp/sim_detector_storage/"):
+        self.accumulator = FrameAccumulator(number_frames, directory) if number_frames > 1 else None
+        self.accumulated_frames.set(max(1, int(number_frames))).wait()
 
     def sim_mode_on(self):
         self.useshutter = False
+        self.cam.sync.set(0).wait()
+        self.cam.shutter_mode.set(0).wait()
 
     def sim_mode_off(self):
         self.useshutter = True
+        self.cam.sync.set(1).wait()
+        self.cam.shutter_mode.set(2).wait()
 
     def stage(self):
-        print("staging")
+        if abs(self.cam.temperature_actual.get() - self.cam.temperature.get()) > 2.0:
+            boxed_text(
+                "Temperature Warning!!!!",
+                self.cooling_state()
+                + "\nPlease wait until temperature has stabilized before collecting important data.",
+                "yellow",
+                85,
+            )
+        self.cam.num_images.set(self.number_exposures).wait()
+        os.makedirs(self.image.save_path, exist_ok=True)
+        self.image.stage()
+        if self.accumulator is not None:
+            self.accumulator.stage()
         return super().stage()
 
     def unstage(self):
-        print("unstaging")
+        self.cam.num_images.set(1).wait()
+        self.image.unstage()
+        if self.accumulator is not None:
+            self.accumulator.unstage()
         return super().unstage()
 
+    def skinnystage(self, *args, **kwargs):
+        yield Msg("stage", super())
+
+    def skinnyunstage(self, *args, **kwargs):
+        yield Msg("unstage", super())
+
     def trigger(self):
-        print("trigger")
-        return self.image.trigger()
+        self.telemetry.sample_status(*self.get_telemetry_status())
+        if self.accumulator is not None:
+            status = self.accumulator.trigger(self, lambda: self._acquire(save=False))
+        else:
+            status = self._acquire()
+        numberFrames = self.cam.num_images.get() * (self.accumulator.number_frames if self.accumulator is not None else 1)
+        return self.telemetry.start_frame(status, self.cam.acquire_time.get(), numberFrames, self.get_readout_time())
+
+    def get_telemetry_status(self):
+        return (self.cam.temperature_actual.get(), self.cam.temperature.get(), self.cam.enable_cooling.get() == 1)
+
+    def print_telemetry(self):
+        return self.telemetry.print_metrics()
+
+    def _acquire(self, save=True):
+        ## The frame is made (and saved) now, and the status is done after the exposure and readout time.
+        ## The timer starts first, so the time to make a large frame is hidden in the readout time as long as it is shorter.
+        status = DeviceStatus(self)
+        threading.Timer(self.get_acquisition_time(), status._finished).start()
+        if save:
+            timeStart = time.monotonic()
+            self.image.trigger()
+            self.telemetry.record_file_write(time.monotonic() - timeStart)
+        else:
+            self.make_frame()
+        frame = self.get_frame()
+        self.stats1.total.put(float(frame.sum()))
+        self.stats1.max_value.put(float(frame.max()))
+        if self.use_frame_statistics:
+            self.check_frame_exposure()
+        return status
+
+    def read(self):
+        res = super().read()
+        if self.accumulator is not None:
+            res = self.accumulator.update_reading(self, res)
+        return res
+
+    def describe(self):
+        res = super().describe()
+        if self.accumulator is not None:
+            res = self.accumulator.update_description(self, res)
+        return res
 
     def collect_asset_docs(self):
-        print("collecting documents")
+        if self.accumulator is not None:
+            list(self.image.collect_asset_docs())  # resource of the unused NPY files
+            yield from self.accumulator.collect_asset_docs()
+            return
         yield from self.image.collect_asset_docs()
 
     def shutter(self):
@@ -514,15 +941,15 @@ class SimGreatEyes(Device):
         self.cam.shutter_mode.set(0).wait()
 
     def set_exptime(self, secs):
-        self.image.exposure_time = secs
+        self.cam.acquire_time.set(secs).wait()
 
     def set_exptime_detonly(self, secs):
-        self.image.exposure_time = secs
+        self.cam.acquire_time.set(secs).wait()
 
     def exptime(self):
         return "{} has an exposure time of {} seconds".format(
             colored(self.name, "lightblue"),
-            colored(str(self.image.exposure_time), "lightgreen"),
+            colored(str(self.cam.acquire_time.get()), "lightgreen"),
         )
 
     def set_temp(self, degc):
@@ -532,6 +959,12 @@ class SimGreatEyes(Device):
     def cooling_off(self):
         self.cam.enable_cooling.set(0).wait()
 
+    def set_temp_plan(self, degc):
+        yield from bps.mv(self.cam.temperature, degc, self.cam.enable_cooling, 1)
+
+    def cooling_off_plan(self):
+        yield from bps.mv(self.cam.enable_cooling, 0)
+
     #    def setROI(self,):
     #        self.cam.
 
@@ -565,6 +998,7 @@ class SimGreatEyes(Device):
                 )
 
     def set_binning(self, binx, biny):
+        self.binvalue = binx
         self.cam.bin_x.set(binx).wait()
         self.cam.bin_y.set(biny).wait()
 
@@ -575,6 +1009,51 @@ class SimGreatEyes(Device):
             colored(self.cam.bin_y.get(), "lightpurple"),
         )
 
+    def get_mode_signals(self):
+        ## As on RSOXSGreatEyesDetector
+        settings = self.detector_mode_settings or self._get_mode_settings(detectorMode_Default)
+        signals = [
+            (self.cam.bin_x, self.binvalue),
+            (self.cam.bin_y, self.binvalue),
+        ]
+        if self.use_readout_region:
+            signals.extend([
+                (self.cam.min_x, settings["min_x"]),
+                (self.cam.min_y, settings["min_y"]),
+                (self.cam.size.size_x, settings["size_x"]),
+                (self.cam.size.size_y, settings["size_y"]),
+            ])
+        return signals
+
+    def _get_mode_settings(self, mode, beam_center=None):
+        return get_mode_settings(mode, beam_center, self.transform_type, self.sensor.shape, use_region=self.use_readout_region)
+
+    def _select_detector_mode(self, mode, beam_center=None):
+        settings = self._get_mode_settings(mode, beam_center)
+        self.detector_mode_settings = settings
+        self.binvalue = settings["binning"]
+        return settings
+
+    def set_detector_mode(self, mode, beam_center=None):
+        ## As on RSOXSGreatEyesDetector
+        settings = self._select_detector_mode(mode, beam_center)
+        for signal, value in self.get_mode_signals():
+            signal.set(value).wait()
+        return settings
+
+    def set_detector_mode_plan(self, mode, beam_center=None):
+        ## As on RSOXSGreatEyesDetector
+        settings = self._select_detector_mode(mode, beam_center)
+        for signal, value in self.get_mode_signals():
+            if signal.get() != value:
+                yield from bps.mv(signal, value)
+        return settings
+
+    def set_readout_mode(self, mode):
+        if mode not in readoutModes:
+            raise ValueError("Unknown readout mode " + str(mode) + ", should be one of " + str(list(readoutModes)) + ".")
+        self.cam.adc_speed.set(mode).wait()
+
     def exposure(self):
         return self.exptime()
 
@@ -0,0 +1,233 @@
+## Accumulation of repeated short exposures on the acquisition side, as an alternative to storing every sub-frame and summing them offline.
+## The detector takes number_frames exposures per trigger, the frames are summed in memory in a 64-bit integer array, and only the sum is written.
+## Pixels that saturate (or wrap to low values) in a frame are left out of the sum for that frame, and the sum is scaled up from the frames where they were valid,
+## so bright features keep their counts while the dynamic range grows with the number of frames.
+## The event has the summed frame, and the maximum and saturated pixels of each frame.
+
+import threading
+import time
+
+import numpy as np
+from ophyd import DeviceStatus
+
+from .frame_statistics import compute_frame_statistics
+from .frame_writer import HDF5FrameWriter
+
+
+frameBitDepth = 18 ## bits of one GreatEyes frame, used to choose the integer type of the stored sum
+saturationLevel_Default = 2**frameBitDepth - 1 ## counts, full scale of one GreatEyes frame, where pixels are clipped
+
+
+class FrameAccumulator:
+    """
+    Sums number_frames exposures of a detector per trigger, with per-frame saturation masking.
+
+    Set on a detector with its set_accumulation method, which also makes its trigger, read, describe, and collect_asset_docs use it.
+    Exposure checks (check_frame_exposure) use the statistics of the mean frame, so exposure time controllers tune the time of each sub-frame.
+    A pixel counts as saturated only if it is saturated in every frame.
+    Pixels are masked in a frame when they reach the saturation_level of the detector (clipped) or are below its saturation_low_threshold.
+
+    Parameters
+    ----------
+    number_frames : int
+        Exposures summed per trigger
+    directory : str, optional
+        Directory of the HDF5 files with the sums.  If None, the directory given to stage is used, e.g., the proposal directory of the TIFF plugin.
+    compression : str
+        See frame_writer.get_compression_options
+    """
+
+    def __init__(self, number_frames, directory=None, compression="auto"):
+        if number_frames < 1:
+            raise ValueError("number_frames should be at least 1, not " + str(number_frames) + ".")
+        self.number_frames = int(number_frames)
+        self.directory = directory
+        self.compression = compression
+        ## The sum of number_frames frames of frameBitDepth bits fits in 32 bits for up to 16384 frames
+        self.dtype = np.uint32 if self.number_frames * 2**frameBitDepth <= 2**32 else np.uint64
+        self.writer = None
+        self.total = None
+        self.valid_count = None
+        self.frame_statistics = []
+        self.statistics = None
+        self.reading = {}
+
+    def stage(self, directory=None):
+        ## One file per staging
+        directory = self.directory if self.directory is not None else directory
+        if directory is None:
+            raise ValueError("FrameAccumulator has no directory for its sums.  Give one to FrameAccumulator or to stage.")
+        self.unstage()
+        self.writer = HDF5FrameWriter(directory, read_pattern="frames", compression=self.compression)
+
+    def unstage(self):
+        if self.writer is not None: self.writer.close()
+
+    def reset(self):
+        self.total = None
+        self.valid_count = None
+        self.frame_statistics = []
+
+    def add(self, detector, frame):
+        ## Adds the valid pixels of one frame and keeps its statistics
+        frame = np.asarray(frame)
+        while frame.ndim > 2: frame = frame[-1]
+        if self.total is None:
+            self.total = np.zeros(frame.shape, dtype=np.int64)
+            self.valid_count = np.zeros(frame.shape, dtype=np.uint16)
+        valid = (frame < detector.saturation_level) & (frame >= detector.saturation_low_threshold)
+        np.add(self.total, frame, out=self.total, where=valid)
+        self.valid_count += valid
+        self.frame_statistics.append(compute_frame_statistics(
+            frame,
+            saturation_high_threshold=detector.saturation_high_threshold,
+            saturation_low_threshold=detector.saturation_low_threshold,
+            underexposure_min_value=detector.underexposure_min_value,
+        ))
+
+    def get_sum(self, saturation_value):
+        """
+        Sum over all frames, with pixels that were masked in some frames scaled up from the frames where they were valid.
+
+        Pixels masked in every frame are set to number_frames * saturation_value.
+        """
+        summed = self.total.copy()
+        masked = (self.valid_count < self.number_frames) & (self.valid_count > 0)
+        summed[masked] = np.rint(self.total[masked] * (self.number_frames / self.valid_count[masked]))
+        summed[self.valid_count == 0] = self.number_frames * saturation_value
+        return summed
+
+    def finish(self, detector):
+        ## Writes the sum and sets the exposure signals of the detector
+        summed = self.get_sum(detector.saturation_level)
+        timeStart = time.monotonic()
+        datumId = self.writer.append(summed.astype(self.dtype))
+        telemetry = getattr(detector, "telemetry", None)
+        if telemetry is not None: telemetry.record_file_write(time.monotonic() - timeStart)
+        statistics = compute_frame_statistics(
+            summed / self.number_frames,
+            saturation_high_threshold=detector.saturation_high_threshold,
+            saturation_low_threshold=detector.saturation_low_threshold,
+            underexposure_min_value=detector.underexposure_min_value,
+        )
+        saturatedAllFrames = int(np.count_nonzero(self.valid_count == 0))
+        statistics.update({
+            "masked_pixels": int(np.count_nonzero(self.valid_count < self.number_frames)),
+            "saturated_all_frames": saturatedAllFrames,
+            "saturated": saturatedAllFrames > detector.saturation_high_pixel_count,
+            "under_exposed": bool(statistics["underexposed_pixels"] > detector.underexposure_num_pixels),
+        })
+        self.statistics = statistics
+        detector.frame_statistics = statistics
+        if telemetry is not None: telemetry.record_saturation(statistics)
+        detector.saturated.set(statistics["saturated"]).wait()
+        detector.under_exposed.set(statistics["under_exposed"]).wait()
+
+        timestamp = time.time()
+        self.reading = {
+            detector.name + "_image": {"value": datumId, "timestamp": timestamp},
+            detector.name + "_frame_max_values": {"value": [frameStatistics["max_value"] for frameStatistics in self.frame_statistics], "timestamp": timestamp},
+            detector.name + "_frame_saturated_pixels": {"value": [frameStatistics["saturated_pixels"] for frameStatistics in self.frame_statistics], "timestamp": timestamp},
+            detector.name + "_masked_pixels": {"value": statistics["masked_pixels"], "timestamp": timestamp},
+        }
+
+    def trigger(self, detector, trigger_frame):
+        """
+        Takes number_frames exposures with trigger_frame (returns a status, after which detector.get_frame is the new frame) in a thread.
+
+        Returns
+        -------
+        DeviceStatus
+            Done when the sum is written
+        """
+        status = DeviceStatus(detector)
+
+        def accumulate():
+            try:
+                self.reset()
+                for index in range(self.number_frames):
+                    trigger_frame().wait()
+                    self.add(detector, detector.get_frame())
+                self.finish(detector)
+            except Exception as error:
+                status.set_exception(error)
+                return
+            status.set_finished()
+
+        threading.Thread(target=accumulate, daemon=True).start()
+        return status
+
+    def update_reading(self, detector, reading):
+        ## The image of the detector is replaced by the sum, and the per-frame statistics are added
+        reading = dict(reading)
+        reading.update(self.reading)
+        return reading
+
+    def update_description(self, detector, description):
+        description = dict(description)
+        imageKey = detector.name + "_image"
+        shape = list(self.total.shape) if self.total is not None else description.get(imageKey, {}).get("shape", [])[-2:]
+        description[imageKey] = dict(
+            {key: value for key, value in description.get(imageKey, {"source": "FrameAccumulator"}).items() if key != "chunks"},
+            shape=shape, dtype="array", dtype_str=np.dtype(self.dtype).str, external="FILESTORE:",
+        )
+        description[detector.name + "_frame_max_values"] = {"source": "FrameAccumulator", "dtype": "array", "shape": [self.number_frames]}
+        description[detector.name + "_frame_saturated_pixels"] = {"source": "FrameAccumulator", "dtype": "array", "shape": [self.number_frames]}
+        description[detector.name + "_masked_pixels"] = {"source": "FrameAccumulator", "dtype": "integer", "shape": []}
+        return description
+
+    def collect_asset_docs(self):
+        if self.writer is not None: yield from self.writer.collect_asset_docs()
+
+
+def benchmark_frame_accumulator(directory, number_frames=10, exposure_time=0.2, energy=285.2, binning=4):
+    """
+    Compares accumulating number_frames short exposures with storing every frame, and with one long exposure, using SimGreatEyesSensor frames.
+
+    Returns
+    -------
+    dict
+        Time per frame to accumulate (s), bytes stored for the sum and for every frame, and saturated pixels in the sum and in one exposure of the total time
+    """
+    import os
+    from .sim_greateyes import SimGreatEyesSensor
+
+    class Thresholds:
+        saturation_level = saturationLevel_Default
+        saturation_high_threshold = 100000
+        saturation_low_threshold = 500
+        underexposure_min_value = 2000
+
+    sensor = SimGreatEyesSensor(seed=0, full_well=Thresholds.saturation_level)
+    frames = [sensor.make_frame(exposure_time, energy, binning, binning) for index in range(number_frames)]
+    accumulator = FrameAccumulator(number_frames, directory)
+    accumulator.stage()
+    timeStart = time.perf_counter()
+    for frame in frames: accumulator.add(Thresholds, frame)
+    summed = accumulator.get_sum(Thresholds.saturation_level)
+    accumulator.writer.append(summed.astype(accumulator.dtype))
+    timeAccumulate = (time.perf_counter() - timeStart) / number_frames
+    pathSum = os.path.join(directory, accumulator.writer.resource["resource_path"])
+    accumulator.unstage()
+
+    writer = HDF5FrameWriter(directory)
+    for frame in frames: writer.append(frame)
+    pathFrames = os.path.join(directory, writer.resource["resource_path"])
+    writer.close()
+
+    longExposure = sensor.make_frame(number_frames * exposure_time, energy, binning, binning)
+    results = {
+        "time_frame": timeAccumulate,
+        "size_sum": os.path.getsize(pathSum),
+        "size_frames": os.path.getsize(pathFrames),
+        "saturated_sum": int(np.count_nonzero(accumulator.valid_count == 0)),
+        "saturated_long_exposure": int(np.count_nonzero(longExposure >= Thresholds.saturation_level)),
+    }
+    print(
+        "Accumulated " + str(number_frames) + " frames of " + str(summed.shape) + " in " + str(round(1e3 * results["time_frame"], 2)) + " ms per frame, stored "
+        + str(results["size_sum"]) + " bytes instead of " + str(results["size_frames"]) + " (" + str(round(results["size_frames"] / results["size_sum"], 1)) + "x less), "
+        + str(results["saturated_sum"]) + " pixels saturated in every frame vs " + str(results["saturated_long_exposure"]) + " saturated in one exposure of the total time"
+    )
+    os.remove(pathSum)
+    os.remove(pathFrames)
+    return results
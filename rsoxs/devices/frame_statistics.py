@@ -0,0 +1,160 @@
+## Exposure statistics computed in process from the acquired detector array, instead of from the areaDetector Stats plugin histograms.
+## Only every stride-th pixel in each direction is used, so a frame is checked in well under a millisecond.
+## Pixel counts are estimated for the whole frame from the sampled fraction, so the same thresholds as the Stats histogram checks apply.
+
+import time
+
+import numpy as np
+
+
+frameStatisticsSamples_Default = 16384 ## sampled pixels per frame
+framePercentiles_Default = (50, 99, 99.9)
+
+
+def get_sampling_stride(shape, samples=frameStatisticsSamples_Default):
+    ## Stride in each direction so that about samples pixels are used
+    return max(1, int(np.sqrt(np.prod(shape[-2:]) / samples)))
+
+
+def _get_sorted_percentile(values_sorted, percentile):
+    ## Linear interpolation between ranks, like np.percentile
+    position = percentile / 100 * (len(values_sorted) - 1)
+    indexLow = int(position)
+    indexHigh = min(indexLow + 1, len(values_sorted) - 1)
+    return float(values_sorted[indexLow] + (position - indexLow) * (float(values_sorted[indexHigh]) - float(values_sorted[indexLow])))
+
+
+def compute_frame_statistics(
+    image,
+    saturation_high_threshold=100000,
+    saturation_low_threshold=500,
+    underexposure_min_value=2000,
+    stride=None,
+    mask=None,
+    percentiles=framePercentiles_Default,
+):
+    """
+    Saturation, underexposure, and intensity statistics of one frame from a strided sample of its pixels.
+
+    Parameters
+    ----------
+    image : array-like
+        Frame, or stack of frames whose last frame is used
+    saturation_high_threshold : float
+        Pixels above this are saturated
+    saturation_low_threshold : float
+        Pixels below this are counted as well, because a strongly saturated GreatEyes pixel can wrap to low values
+    underexposure_min_value : float
+        Pixels below this are underexposed
+    stride : int, optional
+        Sampling stride in each direction.  Defaults to get_sampling_stride.
+    mask : array of bool, optional
+        Region of interest (e.g., the beamstop shadow), same shape as the frame.  Its summed counts are estimated as well.
+
+    Returns
+    -------
+    dict
+        Fractions and estimated whole-frame pixel counts above saturation_high_threshold, below saturation_low_threshold,
+        and below underexposure_min_value, the sampled maximum and percentiles, the estimated counts in mask, and the stride used
+    """
+    image = np.asarray(image)
+    while image.ndim > 2: image = image[-1]
+    if stride is None: stride = get_sampling_stride(image.shape)
+    sample = image[::stride, ::stride]
+    numberPixels = image.size
+    numberSampled = sample.size
+    ## One sort of the sample gives the threshold counts (by bisection), the maximum, and the percentiles, faster than np.percentile alone
+    sampleSorted = np.sort(sample, axis=None)
+    statistics = {
+        "stride": stride,
+        "number_sampled": numberSampled,
+        "saturated_fraction": (numberSampled - np.searchsorted(sampleSorted, saturation_high_threshold, side="right")) / numberSampled,
+        "low_fraction": np.searchsorted(sampleSorted, saturation_low_threshold, side="left") / numberSampled,
+        "underexposed_fraction": np.searchsorted(sampleSorted, underexposure_min_value, side="left") / numberSampled,
+        "max_value": float(sampleSorted[-1]),
+        "percentiles": {percentile: _get_sorted_percentile(sampleSorted, percentile) for percentile in percentiles},
+    }
+    statistics["saturated_pixels"] = statistics["saturated_fraction"] * numberPixels
+    statistics["low_pixels"] = statistics["low_fraction"] * numberPixels
+    statistics["underexposed_pixels"] = statistics["underexposed_fraction"] * numberPixels
+    if mask is not None:
+        maskSample = np.asarray(mask)[::stride, ::stride]
+        statistics["masked_counts"] = float(sample[maskSample].sum()) * stride**2
+    return statistics
+
+
+def evaluate_exposure(statistics, detector):
+    """
+    Whether a frame is under exposed or saturated, with the thresholds of the detector (same rules as the Stats histogram checks).
+
+    Returns
+    -------
+    under_exposed, saturated : bool
+    """
+    ## bool, because the BooleanSignals cannot describe numpy booleans
+    saturated = bool(
+        statistics["saturated_pixels"] > detector.saturation_high_pixel_count
+        or statistics["low_pixels"] > detector.saturation_low_pixel_count
+    )
+    under_exposed = bool(statistics["underexposed_pixels"] > detector.underexposure_num_pixels)
+    return under_exposed, saturated
+
+
+def check_frame_exposure(detector, image, mask=None):
+    """
+    Computes the statistics of a frame with the thresholds of detector, and sets its saturated and under_exposed signals.
+
+    The statistics are also kept as detector.frame_statistics, e.g., for the exposure time predictions, and saturation is recorded by detector.telemetry.
+    """
+    statistics = compute_frame_statistics(
+        image,
+        saturation_high_threshold=detector.saturation_high_threshold,
+        saturation_low_threshold=detector.saturation_low_threshold,
+        underexposure_min_value=detector.underexposure_min_value,
+        mask=mask,
+    )
+    under_exposed, saturated = evaluate_exposure(statistics, detector)
+    statistics.update({"under_exposed": under_exposed, "saturated": saturated})
+    detector.frame_statistics = statistics
+    telemetry = getattr(detector, "telemetry", None)
+    if telemetry is not None: telemetry.record_saturation(statistics)
+    detector.saturated.set(saturated).wait()
+    detector.under_exposed.set(under_exposed).wait()
+    return statistics
+
+
+def benchmark_frame_statistics(detector=None, shape=(1026, 1024), number_frames=100):
+    """
+    Times compute_frame_statistics on frames of shape, and compares it with the statistics of every pixel.
+
+    If a detector with get_frame (e.g., SimGreatEyes) is given, its frames are used instead of simulated ones.
+
+    Returns
+    -------
+    dict
+        Median time in s per frame, and the largest differences from the full-frame fractions
+    """
+    rng = np.random.default_rng(0)
+    timesFrame = []
+    differences = []
+    for index in range(number_frames):
+        if detector is not None:
+            detector.trigger().wait()
+            image = np.asarray(detector.get_frame())
+        else:
+            ## Gaussian spot on a background, brighter each frame, so some frames saturate and some are underexposed
+            rows, columns = np.indices(shape)
+            spot = np.exp(-((rows - shape[0] / 2)**2 + (columns - shape[1] / 2)**2) / (2 * 50**2))
+            image = (1000 + 10**(2 + 4 * index / number_frames) * spot + rng.normal(0, 30, shape)).astype(np.uint32)
+        timeStart = time.perf_counter()
+        statistics = compute_frame_statistics(image)
+        timesFrame.append(time.perf_counter() - timeStart)
+        full = compute_frame_statistics(image, stride=1)
+        differences.append([abs(statistics[key] - full[key]) for key in ("saturated_fraction", "low_fraction", "underexposed_fraction")])
+
+    results = {"time_frame": float(np.median(timesFrame)), "difference_max": np.max(differences, axis=0).tolist()}
+    print(
+        "Frame statistics: " + str(round(1e3 * results["time_frame"], 3)) + " ms per frame, largest fraction differences from all pixels "
+        + str([round(value, 4) for value in results["difference_max"]]) + " (saturated, low, underexposed)"
+    )
+    return results
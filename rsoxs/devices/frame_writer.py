@@ -0,0 +1,233 @@
+## Chunked, compressed HDF5 storage for detector frames, as an alternative to one uncompressed TIFF per frame.
+## Frames are appended to one resizable dataset per run at /entry/data/data, the layout of the areaDetector HDF5 plugin, so the files are read by the usual AD_HDF5 handler.
+## Chunks are chosen for how the frames will be read: whole frames (e.g., reduction frame by frame) or stacks (e.g., time series of a region in time scans and spirals).
+## The same chunk and compression choices can be applied to an areaDetector HDF5 plugin with configure_hdf5_plugin.
+
+import os
+import time
+import uuid
+
+import numpy as np
+
+
+chunkBytesTarget_Default = 1024**2 ## B, chunks of about 1 MB read and compress efficiently
+stackDepth_Default = 16 ## frames per chunk when reading stacks
+
+
+def get_compression_options(compression="auto"):
+    """
+    h5py dataset keyword arguments for a compression option.
+
+    "gzip" (level 1) and "lzf" are built into h5py and are used with the byte shuffle filter, which groups the mostly constant high bytes of 16-bit CCD counts.
+    "blosc_lz4" (bitshuffle + lz4) is much faster at a similar ratio and needs the optional hdf5plugin package, also needed to read the files.
+    "auto" is blosc_lz4 if hdf5plugin is installed, otherwise lzf.
+    """
+    if compression == "auto":
+        try:
+            return get_compression_options("blosc_lz4")
+        except ImportError:
+            return get_compression_options("lzf")
+    if compression == "gzip": return {"compression": "gzip", "compression_opts": 1, "shuffle": True}
+    if compression == "lzf": return {"compression": "lzf", "shuffle": True}
+    if compression == "blosc_lz4":
+        import hdf5plugin
+        return dict(hdf5plugin.Blosc(cname="lz4", clevel=5, shuffle=hdf5plugin.Blosc.BITSHUFFLE))
+    if compression in (None, "none"): return {}
+    raise ValueError("Unknown compression " + str(compression) + ", should be gzip, lzf, blosc_lz4, or none.")
+
+
+def choose_frame_chunks(frame_shape, read_pattern="frames", itemsize=2, stack_depth=stackDepth_Default, chunk_bytes_target=chunkBytesTarget_Default):
+    """
+    Chunk shape (frames, rows, columns) for frames of frame_shape.
+
+    read_pattern "frames" gives one frame per chunk, split into row bands only if a frame is much larger than chunk_bytes_target.
+    read_pattern "stacks" gives stack_depth frames per chunk over square tiles, so reading a region over many frames touches few chunks.
+    """
+    rows, columns = frame_shape[-2:]
+    if read_pattern == "frames":
+        rowsChunk = rows
+        while rowsChunk * columns * itemsize > 4 * chunk_bytes_target and rowsChunk > 1:
+            rowsChunk = int(np.ceil(rowsChunk / 2))
+        return (1, rowsChunk, columns)
+    if read_pattern == "stacks":
+        tile = int(np.sqrt(chunk_bytes_target / (stack_depth * itemsize)))
+        return (stack_depth, min(rows, tile), min(columns, tile))
+    raise ValueError("Unknown read pattern " + str(read_pattern) + ", should be frames or stacks.")
+
+
+class HDF5FrameWriter:
+    """
+    Appends frames to a chunked, compressed HDF5 dataset and makes the resource and datum documents for them.
+
+    Parameters
+    ----------
+    directory : str
+        Directory for the file, created if it does not exist
+    read_pattern : str
+        "frames" or "stacks", see choose_frame_chunks
+    compression : str
+        See get_compression_options
+    """
+
+    def __init__(self, directory, read_pattern="frames", compression="auto", stack_depth=stackDepth_Default):
+        self.directory = directory
+        self.read_pattern = read_pattern
+        self.compression = compression
+        self.stack_depth = stack_depth
+        self.file = None
+        self.dataset = None
+        self.resource = None
+        self._asset_docs_cache = []
+
+    def open(self, frame_shape, dtype=np.uint16, filename=None):
+        import h5py
+        os.makedirs(self.directory, exist_ok=True)
+        filename = filename or str(uuid.uuid4()) + ".h5"
+        path = os.path.join(self.directory, filename)
+        chunks = choose_frame_chunks(frame_shape, self.read_pattern, np.dtype(dtype).itemsize, self.stack_depth)
+        ## The chunk cache has to hold every chunk of a frame until the chunks are full, or each append recompresses them
+        bytesChunks = chunks[0] * int(np.prod(frame_shape)) * np.dtype(dtype).itemsize
+        self.file = h5py.File(path, "w", rdcc_nbytes=2 * bytesChunks, rdcc_nslots=100003)
+        self.dataset = self.file.create_dataset(
+            "/entry/data/data", shape=(0,) + tuple(frame_shape), maxshape=(None,) + tuple(frame_shape), dtype=dtype, chunks=chunks,
+            **get_compression_options(self.compression),
+        )
+        self.resource = {
+            "spec": "AD_HDF5",
+            "root": self.directory,
+            "resource_path": filename,
+            "resource_kwargs": {"frame_per_point": 1},
+            "path_semantics": "posix",
+            "uid": str(uuid.uuid4()),
+        }
+        self._asset_docs_cache.append(("resource", self.resource))
+        return path
+
+    def append(self, frame):
+        ## Writes one frame and returns its datum_id
+        frame = np.asarray(frame)
+        if self.file is None: self.open(frame.shape, frame.dtype)
+        index = self.dataset.shape[0]
+        self.dataset.resize(index + 1, axis=0)
+        self.dataset[index] = frame
+        datum = {"resource": self.resource["uid"], "datum_kwargs": {"point_number": index}, "datum_id": self.resource["uid"] + "/" + str(index)}
+        self._asset_docs_cache.append(("datum", datum))
+        return datum["datum_id"]
+
+    def collect_asset_docs(self):
+        items = list(self._asset_docs_cache)
+        self._asset_docs_cache.clear()
+        yield from items
+
+    def flush(self):
+        if self.file is not None: self.file.flush()
+
+    def close(self):
+        if self.file is not None: self.file.close()
+        self.file = None
+        self.dataset = None
+
+
+def configure_hdf5_plugin(plugin, frame_shape, read_pattern="frames", itemsize=4, stack_depth=stackDepth_Default):
+    """
+    Sets the chunking and compression of an areaDetector HDF5 plugin (ophyd HDF5Plugin_V32 or later) like HDF5FrameWriter.
+
+    Blosc with lz4 and bit shuffle is used, the IOC-side equivalent of "blosc_lz4".
+    itemsize is the bytes per pixel of the frames the plugin receives, 4 for the 32-bit frames of the GreatEyes detector.
+    """
+    chunks = choose_frame_chunks(frame_shape, read_pattern, itemsize, stack_depth)
+    plugin.compression.set(4).wait() ## blosc
+    plugin.blosc_compressor.set(1).wait() ## lz4
+    plugin.blosc_shuffle.set(2).wait() ## bit shuffle
+    plugin.num_frames_chunks.set(chunks[0]).wait()
+    plugin.num_row_chunks.set(chunks[1]).wait()
+    plugin.num_col_chunks.set(chunks[2]).wait()
+    return chunks
+
+
+def _make_synthetic_frames(number_frames, shape, seed=0):
+    ## 16-bit CCD-like frames: bias, dark current noise, and a scattering ring that changes intensity from frame to frame
+    rng = np.random.default_rng(seed)
+    rows, columns = np.indices(shape)
+    radius = np.hypot(rows - shape[0] / 2, columns - shape[1] / 2)
+    ring = np.exp(-((radius - shape[0] / 4) / 20)**2) + 0.3 * np.exp(-radius / 50)
+    for index in range(number_frames):
+        frame = 1000 + rng.normal(0, 8, shape) + rng.poisson(2000 * (1 + 0.1 * np.sin(index)) * ring)
+        yield np.clip(frame, 0, 65535).astype(np.uint16)
+
+
+def benchmark_frame_writers(directory, number_frames=50, shape=(1026, 1024), compressions=("none", "gzip", "lzf", "blosc_lz4")):
+    """
+    Writes the same synthetic 16-bit frames as TIFF files and with HDF5FrameWriter, and compares throughput and size.
+
+    Reading speed is measured for whole frames and for a 32 x 32 region over all frames, with both chunk layouts.
+    Compressions that are not available (e.g., blosc_lz4 without hdf5plugin) are skipped.
+
+    Returns
+    -------
+    list of dict
+        One entry per format with write and read rates (frames/s), size in bytes, and compression ratio relative to raw frames
+    """
+    import h5py
+    from PIL import Image
+    frames = list(_make_synthetic_frames(number_frames, shape))
+    bytesRaw = sum(frame.nbytes for frame in frames)
+    os.makedirs(directory, exist_ok=True)
+    results = []
+
+    directoryTiff = os.path.join(directory, "tiff")
+    os.makedirs(directoryTiff, exist_ok=True)
+    timeStart = time.perf_counter()
+    for index, frame in enumerate(frames):
+        Image.fromarray(frame).save(os.path.join(directoryTiff, "frame_" + str(index) + ".tiff"))
+    timeWrite = time.perf_counter() - timeStart
+    sizeTiff = sum(os.path.getsize(os.path.join(directoryTiff, name)) for name in os.listdir(directoryTiff))
+    timeStart = time.perf_counter()
+    for index in range(number_frames):
+        np.asarray(Image.open(os.path.join(directoryTiff, "frame_" + str(index) + ".tiff")))
+    timeReadFrames = time.perf_counter() - timeStart
+    ## A region over all frames needs every file to be opened and decoded
+    timeStart = time.perf_counter()
+    for index in range(number_frames):
+        np.asarray(Image.open(os.path.join(directoryTiff, "frame_" + str(index) + ".tiff")))[shape[0] // 2:shape[0] // 2 + 32, shape[1] // 2:shape[1] // 2 + 32]
+    timeReadRegion = time.perf_counter() - timeStart
+    results.append({"format": "tiff", "write_rate": number_frames / timeWrite, "read_rate_frames": number_frames / timeReadFrames, "read_time_region": timeReadRegion, "size": sizeTiff, "ratio": bytesRaw / sizeTiff})
+
+    for compression in compressions:
+        try:
+            get_compression_options(compression)
+        except ImportError:
+            print("Skipping " + compression + ", hdf5plugin is not installed")
+            continue
+        for readPattern in ("frames", "stacks"):
+            writer = HDF5FrameWriter(directory, read_pattern=readPattern, compression=compression)
+            timeStart = time.perf_counter()
+            path = writer.open(shape, np.uint16)
+            for frame in frames: writer.append(frame)
+            writer.close()
+            timeWrite = time.perf_counter() - timeStart
+            with h5py.File(path, "r") as file:
+                dataset = file["/entry/data/data"]
+                timeStart = time.perf_counter()
+                for index in range(number_frames): dataset[index]
+                timeReadFrames = time.perf_counter() - timeStart
+                timeStart = time.perf_counter()
+                dataset[:, shape[0] // 2:shape[0] // 2 + 32, shape[1] // 2:shape[1] // 2 + 32]
+                timeReadRegion = time.perf_counter() - timeStart
+            size = os.path.getsize(path)
+            results.append({
+                "format": "hdf5 " + compression + " " + readPattern,
+                "write_rate": number_frames / timeWrite,
+                "read_rate_frames": number_frames / timeReadFrames,
+                "read_time_region": timeReadRegion,
+                "size": size,
+                "ratio": bytesRaw / size,
+            })
+            os.remove(path)
+
+    for result in results:
+        print(
+            result["format"].ljust(24) + " write " + str(round(result["write_rate"], 1)) + " frames/s, read " + str(round(result["read_rate_frames"], 1))
+            + " frames/s, region over all frames " + str(round(1000 * result["read_time_region"], 1)) + " ms, compression ratio " + str(round(result["ratio"], 2))
+        )
+    return results
@@ -0,0 +1,190 @@
+## Model of the GreatEyes CCD for SimGreatEyes, so that timing-sensitive plans, preprocessors, and reductions can be profiled without the beamline.
+## It covers the sensor size and binning, the readout time of each readout mode, bias, dark current that depends on the CCD temperature, read noise,
+## Poisson noise, and a scattering pattern whose ring position, intensity, and anisotropy depend on the photon energy.
+## It has no ophyd dependencies, so frames can also be made directly, e.g., to benchmark reductions.
+
+import time
+
+import numpy as np
+
+from .detector_modes import readoutPixelRates, readoutAdcSpeed_Default, get_readout_time, sensorShape, pixelSizeUnbinned
+
+
+## Readout mode (cam.adc_speed) : pixel rate (pixels/s) and read noise (counts)
+readoutModes = {
+    "50 kHz": {"pixel_rate": readoutPixelRates["50 kHz"], "read_noise": 3},
+    "500 kHz": {"pixel_rate": readoutPixelRates["500 kHz"], "read_noise": 5},
+    "1 MHz": {"pixel_rate": readoutPixelRates["1 MHz"], "read_noise": 7},
+    "3 MHz": {"pixel_rate": readoutPixelRates["3 MHz"], "read_noise": 12},
+}
+readoutMode_Default = readoutAdcSpeed_Default
+temperatureAmbient = 20 ## degC, reached by the CCD with cooling off
+
+## Sample of the synthetic scattering pattern: a domain spacing ring on a diffuse background, with a carbon 1s -> pi* resonance
+ringQ = 0.25 ## nm^-1
+ringWidth = 0.03 ## nm^-1
+resonanceEnergy = 285.2 ## eV
+resonanceWidth = 0.6 ## eV
+edgeEnergy = 284.5 ## eV
+
+
+def get_wavelength(energy):
+    ## nm, for energy in eV
+    return 1239.84193 / energy
+
+
+def _get_resonance(energy):
+    ## Lorentzian that is 1 at the resonance
+    return resonanceWidth**2 / ((energy - resonanceEnergy)**2 + resonanceWidth**2)
+
+
+class SimGreatEyesSensor:
+    """
+    Frames and readout times of a simulated GreatEyes CCD.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        Unbinned sensor size (rows, columns)
+    pixel_size : float
+        Unbinned pixel size (mm)
+    distance : float
+        Sample to detector distance (mm)
+    beam_center : tuple of float, optional
+        Beam center (row, column) in unbinned pixels.  Defaults to the middle of the sensor.
+    bias : float
+        Offset of every readout pixel (counts)
+    dark_current : float
+        Dark current of an unbinned pixel at temperature_reference (counts/s)
+    dark_doubling : float
+        Temperature change that doubles the dark current (degC)
+    full_well : int
+        Largest count of a readout pixel, saturated pixels are clipped to it
+    flux : float
+        Scattering of an unbinned pixel at the ring peak, off resonance (counts/s)
+    row_shift_time : float
+        Time to shift one unbinned row (s).  All rows are shifted whatever the binning.
+    readout_overhead : float
+        Fixed time per frame (s)
+    beamstop_radius : float
+        Radius of the beamstop shadow in unbinned pixels
+    seed : int, optional
+        Seed of the noise
+    """
+
+    def __init__(
+        self,
+        shape=sensorShape,
+        pixel_size=pixelSizeUnbinned,
+        distance=35,
+        beam_center=None,
+        bias=1000,
+        dark_current=0.02,
+        temperature_reference=-80,
+        dark_doubling=6,
+        full_well=262143,
+        flux=3000,
+        row_shift_time=2e-5,
+        readout_overhead=0.1,
+        beamstop_radius=40,
+        seed=None,
+    ):
+        self.shape = tuple(shape)
+        self.pixel_size = pixel_size
+        self.distance = distance
+        self.beam_center = beam_center if beam_center is not None else (self.shape[0] / 2, self.shape[1] / 2)
+        self.bias = bias
+        self.dark_current = dark_current
+        self.temperature_reference = temperature_reference
+        self.dark_doubling = dark_doubling
+        self.full_well = full_well
+        self.flux = flux
+        self.row_shift_time = row_shift_time
+        self.readout_overhead = readout_overhead
+        self.beamstop_radius = beamstop_radius
+        self.rng = np.random.default_rng(seed)
+        self._patterns = {} ## (energy, bin_x, bin_y) : scattering rate of each readout pixel
+
+    def get_binned_shape(self, bin_x=1, bin_y=1):
+        return (self.shape[0] // bin_y, self.shape[1] // bin_x)
+
+    def get_readout_time(self, bin_x=1, bin_y=1, mode=readoutMode_Default, region=None):
+        ## Every row is shifted, but only the binned pixels in region (row, column, rows, columns of unbinned pixels) are digitized
+        return get_readout_time(bin_x, bin_y, mode, region, self.shape, self.row_shift_time, self.readout_overhead)
+
+    def get_dark_rate(self, temperature):
+        ## counts/s of an unbinned pixel
+        return self.dark_current * 2**((temperature - self.temperature_reference) / self.dark_doubling)
+
+    def get_scattering_rate(self, energy, bin_x=1, bin_y=1):
+        """
+        Expected scattering (counts/s) of each readout pixel at energy (eV).
+
+        The ring is at a fixed q, so it moves on the detector with energy.  Its intensity and anisotropy peak at the resonance,
+        and the transmission of the sample drops above the absorption edge.
+        """
+        key = (round(float(energy), 2), bin_x, bin_y)
+        if key in self._patterns: return self._patterns[key]
+        if len(self._patterns) > 64: self._patterns.clear()
+
+        rows, columns = self.get_binned_shape(bin_x, bin_y)
+        ## Centers of the readout pixels relative to the beam center, in mm
+        y = ((np.arange(rows) + 0.5) * bin_y - self.beam_center[0]) * self.pixel_size
+        x = ((np.arange(columns) + 0.5) * bin_x - self.beam_center[1]) * self.pixel_size
+        radius = np.hypot(y[:, None], x[None, :])
+        chi = np.arctan2(y[:, None], x[None, :])
+        q = 4 * np.pi / get_wavelength(energy) * np.sin(np.arctan(radius / self.distance) / 2)
+
+        resonance = _get_resonance(energy)
+        contrast = 1 + 10 * resonance
+        anisotropy = 0.6 * resonance
+        transmission = 0.8 if energy < edgeEnergy else 0.45
+        ring = np.exp(-((q - ringQ) / ringWidth)**2) * (1 + anisotropy * np.cos(2 * chi))
+        diffuse = 0.3 / (1 + (q / 0.08)**3)
+        rate = self.flux * transmission * (contrast * ring + diffuse) * bin_x * bin_y
+        rate[radius < self.beamstop_radius * self.pixel_size] *= 1e-3
+        self._patterns[key] = rate
+        return rate
+
+    def make_frame(self, exposure_time, energy=resonanceEnergy, bin_x=1, bin_y=1, temperature=-80, mode=readoutMode_Default, light=True, region=None):
+        """
+        One frame (uint32 counts) with Poisson noise on the scattering and dark current, bias, and read noise.
+
+        light False gives a dark frame, as with the shutter closed.
+        region (row, column, rows, columns of unbinned pixels, aligned to the binning) reads out only part of the sensor.
+        """
+        rows, columns = self.get_binned_shape(bin_x, bin_y)
+        rowsRead = slice(0, rows) if region is None else slice(region[0] // bin_y, (region[0] + region[2]) // bin_y)
+        columnsRead = slice(0, columns) if region is None else slice(region[1] // bin_x, (region[1] + region[3]) // bin_x)
+        shape = (rowsRead.stop - rowsRead.start, columnsRead.stop - columnsRead.start)
+        expected = np.full(shape, self.get_dark_rate(temperature) * bin_x * bin_y * exposure_time)
+        if light: expected = expected + self.get_scattering_rate(energy, bin_x, bin_y)[rowsRead, columnsRead] * exposure_time
+        frame = self.rng.poisson(expected).astype(np.float64)
+        frame += self.bias + self.rng.normal(0, readoutModes[mode]["read_noise"], shape)
+        return np.clip(frame, 0, self.full_well).astype(np.uint32)
+
+
+def benchmark_sim_greateyes_sensor(sensor=None, binnings=(1, 2, 4), number_frames=5, energy=resonanceEnergy, exposure_time=1):
+    """
+    Times frame generation for each binning, and prints the simulated readout time of each readout mode.
+
+    Returns
+    -------
+    dict
+        Binning : median time (s) to make one frame
+    """
+    if sensor is None: sensor = SimGreatEyesSensor(seed=0)
+    results = {}
+    for binning in binnings:
+        sensor.get_scattering_rate(energy, binning, binning) ## the pattern is cached per energy and binning
+        timesFrame = []
+        for index in range(number_frames):
+            timeStart = time.perf_counter()
+            sensor.make_frame(exposure_time, energy, binning, binning)
+            timesFrame.append(time.perf_counter() - timeStart)
+        results[binning] = float(np.median(timesFrame))
+        print(
+            "Binning " + str(binning) + ": " + str(sensor.get_binned_shape(binning, binning)) + " frame made in " + str(round(1e3 * results[binning], 1)) + " ms, readout "
+            + ", ".join(mode + " " + str(round(sensor.get_readout_time(binning, binning, mode), 2)) + " s" for mode in readoutModes)
+        )
+    return results
@@ -0,0 +1,119 @@
+## Expands a spreadsheet acquisition into the list of atomic steps that run_acquisitions_single executes.
+## A step is one scan: a single sweep at one sample angle and one polarization.
+## Completed step ids are stored in the acquisition's steps_completed list, so an interrupted acquisition can resume from its first unfinished step.
+## Resume and reset: steps_completed is kept while acquire_status is "Started" (rerunning resumes) or "Finished" (the queue skips it).
+## Setting acquire_status to anything else, e.g., back to "Not begun" with resetAcquisitionSteps, clears steps_completed when the acquisition is sanitized, so every step runs again.
+
+import copy
+
+from .default_energy_parameters import energy_list_parameters
+
+
+def get_energy_sweeps(acquisition):
+    """
+    Returns the energy parameters for each sweep of an acquisition, in the order they are run.
+
+    For nexafs, nexafs_fly, and rsoxs scans with cycles = 0, there is one ascending sweep.
+    For cycles > 0, there are pairs of sweeps going in ascending then descending order of energy.
+    Time scans and spirals run at a single energy, so they have a single sweep.
+    """
+    energy_parameters = acquisition["energy_list_parameters"]
+    if acquisition["scan_type"] not in ("nexafs", "nexafs_fly", "rsoxs"):
+        return [energy_parameters]
+
+    if isinstance(energy_parameters, str):
+        energy_parameters = energy_list_parameters[energy_parameters]
+    energy_parameters = tuple(energy_parameters)
+
+    if acquisition["cycles"] == 0:
+        return [energy_parameters]
+    sweeps = []
+    for cycle in range(acquisition["cycles"]):
+        sweeps.append(energy_parameters)
+        sweeps.append(energy_parameters[::-1])  ## Reverse the energy list parameters to produce reversed energy list
+    return sweeps
+
+
+def make_step_id(index_angle, sample_angle, index_polarization, polarization, index_sweep):
+    ## Both index and value are included so that a step id no longer matches if the acquisition is edited afterwards
+    return "angle" + str(index_angle) + "=" + str(sample_angle) + "_polarization" + str(index_polarization) + "=" + str(polarization) + "_sweep" + str(index_sweep)
+
+
+## Axis : offset of the approach position before the first point of a sweep.
+## In snake order, sweeps run in both directions, so the axis is first moved this far past the first point against the sweep direction.
+## The first point is then reached moving in the same direction as the rest of the sweep, which keeps backlash the same for every point.
+## Axes that are not listed are moved straight to their first point.
+hysteresisApproachOffsets = {
+    "energy": 0.5, ## eV, monochromator and EPU gap
+}
+
+
+def get_sweep_direction(energy_parameters):
+    ## 1 for ascending, -1 for descending, 0 for a single energy
+    if isinstance(energy_parameters, str):
+        energy_parameters = energy_list_parameters[energy_parameters]
+    if isinstance(energy_parameters, (int, float)) or len(energy_parameters) < 3: return 0
+    if energy_parameters[-1] > energy_parameters[0]: return 1
+    if energy_parameters[-1] < energy_parameters[0]: return -1
+    return 0
+
+
+def get_approach_position(axis, position, direction):
+    ## Position to move to before the first point of a sweep so that the first point is approached in the sweep direction
+    return position - direction * hysteresisApproachOffsets.get(axis, 0)
+
+
+def expand_acquisition_steps(acquisition):
+    """
+    Expands a sanitized acquisition into an explicit, ordered list of steps.
+
+    With energy_sweep_order = "ascending" (default), every angle and polarization starts from the low end of the energy list.
+    With energy_sweep_order = "snake", each sweep starts at the energy where the previous one finished,
+    and the polarization order is reversed on every other sample angle, so there is no full-range slew of the
+    monochromator and EPU between sweeps.
+
+    Parameters
+    ----------
+    acquisition : dict
+        Sanitized acquisition dictionary
+
+    Returns
+    -------
+    list of dict
+        Each step has a stable step_id and the sample angle, polarization, energy parameters, and sweep direction for one scan.
+    """
+    steps = []
+    sweeps = get_energy_sweeps(acquisition)
+    snake = acquisition.get("energy_sweep_order", "ascending") == "snake"
+    directionPrevious = 0
+    for index_angle, sample_angle in enumerate(acquisition["sample_angles"]):
+        polarizationsOrdered = list(enumerate(acquisition["polarizations"]))
+        if snake and index_angle % 2 == 1: polarizationsOrdered = polarizationsOrdered[::-1]
+        for index_polarization, polarization in polarizationsOrdered:
+            sweepsOrdered = sweeps
+            ## Starting in the direction the previous sweep went would need a slew back across the whole range first
+            if snake and directionPrevious != 0 and get_sweep_direction(sweeps[0]) == directionPrevious:
+                sweepsOrdered = [energy_parameters[::-1] for energy_parameters in sweeps]
+            for index_sweep, energy_parameters in enumerate(sweepsOrdered):
+                direction = get_sweep_direction(energy_parameters) if acquisition["scan_type"] in ("nexafs", "nexafs_fly", "rsoxs") else 0
+                steps.append(
+                    {
+                        "step_id": make_step_id(index_angle, sample_angle, index_polarization, polarization, index_sweep),
+                        "uid_local": acquisition["uid_local"],
+                        "scan_type": acquisition["scan_type"],
+                        "sample_angle": sample_angle,
+                        "polarization": polarization,
+                        "index_sweep": index_sweep,
+                        "energy_parameters": copy.deepcopy(energy_parameters),
+                        "direction": direction,
+                        "approach": snake,
+                    }
+                )
+                if direction != 0: directionPrevious = direction
+    return steps
+
+
+def get_remaining_steps(steps, steps_completed):
+    ## Steps whose ids have not been recorded as completed, kept in their original order
+    steps_completed = set(steps_completed or [])
+    return [step for step in steps if step["step_id"] not in steps_completed]
@@ -0,0 +1,96 @@
+## Adaptive energy sampling: a coarse pass over the energy range, then passes that only add energies where the I0-normalized spectrum changes quickly.
+## The scan plan is passed in, so the same passes run on the beamline with energy_step_scan and on ophyd.sim signals with bluesky's list_scan.
+
+import numpy as np
+from bluesky.plan_stubs import trigger_and_read, move_per_step
+from bluesky.utils import Msg
+
+from .energy_grids import get_energy_grid, refine_energy_grid
+
+
+def make_recording_per_step(readings):
+    ## per_step that works like bluesky's one_nd_step and also keeps each reading so that the next pass can be planned from live data
+    def recording_per_step(detectors, step, pos_cache, take_reading=trigger_and_read):
+        yield Msg("checkpoint")
+        motors = step.keys()
+        yield from move_per_step(step, pos_cache)
+        reading = yield from take_reading(list(detectors) + list(motors))
+        readings.append(reading)
+        return reading
+    return recording_per_step
+
+
+def get_reading_value(reading, name):
+    ## Readings are keyed by data key, which is the signal name or starts with the device name
+    if name in reading: return reading[name]["value"]
+    for key, value in reading.items():
+        if key.startswith(name): return value["value"]
+    raise KeyError(str(name) + " was not found in the reading.  Available keys: " + str(list(reading.keys())))
+
+
+def adaptive_energy_passes(
+        list_scan,
+        energy_parameters,
+        signal_name,
+        izero_name=None,
+        point_budget=None,
+        passes=3,
+        energy_step_min=0.05,
+        weight_curvature=1.0,
+):
+    """
+    Runs a coarse energy scan, then refinement passes that add points only where the spectrum changes quickly.
+
+    Parameters
+    ----------
+    list_scan : callable
+        list_scan(energies, per_step=...) returning a plan, e.g., a partial of energy_step_scan or bluesky's list_scan
+    energy_parameters : str or tuple
+        Coarse grid, as a name in energy_list_parameters or (start, step, stop, step, stop, ...)
+    signal_name : str
+        Data key of the signal, e.g., the beamstop or TEY
+    izero_name : str, optional
+        Data key of I0.  If given, the signal is divided by it before deciding where to add points.
+    point_budget : int, optional
+        Total number of energies over all passes.  Defaults to twice the coarse grid.
+    passes : int
+        Total number of passes, including the coarse one.  The remaining budget is split evenly between refinement passes.
+    energy_step_min : float
+        Smallest spacing in eV that refinement goes down to
+
+    Returns
+    -------
+    energies : numpy.ndarray
+        All measured energies in ascending order
+    spectrum : numpy.ndarray
+        Normalized signal at those energies
+    """
+    energiesNext = np.array(get_energy_grid(energy_parameters))
+    if point_budget is None: point_budget = 2 * len(energiesNext)
+    energiesMeasured = []
+    spectrumMeasured = []
+
+    for indexPass in range(passes):
+        print("Adaptive pass " + str(indexPass + 1) + " of " + str(passes) + ": " + str(len(energiesNext)) + " energies")
+        readings = []
+        yield from list_scan(list(energiesNext), per_step=make_recording_per_step(readings))
+        for energy, reading in zip(energiesNext, readings):
+            value = get_reading_value(reading, signal_name)
+            if izero_name is not None: value = value / get_reading_value(reading, izero_name)
+            energiesMeasured.append(energy)
+            spectrumMeasured.append(value)
+
+        passesRemaining = passes - indexPass - 1
+        pointsRemaining = point_budget - len(energiesMeasured)
+        if passesRemaining == 0 or pointsRemaining <= 0: break
+        energiesNext = refine_energy_grid(
+            energiesMeasured,
+            spectrumMeasured,
+            pointsRemaining // passesRemaining,
+            energy_step_min=energy_step_min,
+            weight_curvature=weight_curvature,
+            )
+        if len(energiesNext) == 0: break
+
+    order = np.argsort(energiesMeasured)
+    return np.asarray(energiesMeasured)[order], np.asarray(spectrumMeasured)[order]
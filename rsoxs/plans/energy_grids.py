@@ -0,0 +1,277 @@
+## Single place where energy grids are built from region definitions.
+## Region definitions use the gscan format of _make_gscan_points in nbs_bl.plans.scan_base: (start, step, stop, step, stop, ...).
+## Steps are positive, the direction of each region comes from its start and stop, and the stop of each region is always included.
+## Grids are expanded with vectorized numpy and memoized by region definition, and point counts for the named grids in energy_list_parameters are precomputed so that schedulers and time estimates do not need to build arrays.
+
+import warnings
+from functools import lru_cache
+
+import numpy as np
+
+from .default_energy_parameters import energy_list_parameters
+
+
+overheadPerPoint_Default = 1 ## s, rough motor move, settle, and readout overhead per exposure in step scans
+
+
+def normalize_energy_parameters(energy_parameters):
+    """
+    Converts any accepted region definition into a hashable tuple of floats.
+
+    Accepts a name in energy_list_parameters, a single energy, or a list, tuple, or array in the gscan format.
+    """
+    if isinstance(energy_parameters, str):
+        if energy_parameters not in energy_list_parameters: raise ValueError("Energy list " + str(energy_parameters) + " was not found in energy_list_parameters.")
+        energy_parameters = energy_list_parameters[energy_parameters]
+    if isinstance(energy_parameters, (int, float, np.integer, np.floating)):
+        energy_parameters = (energy_parameters,)
+    energy_parameters = tuple(float(value) for value in energy_parameters)
+    if len(energy_parameters) == 0 or (len(energy_parameters) - 1) % 2 != 0:
+        raise TypeError("Energy list parameters must have the format (start, step, stop, step, stop, ...).  Either a stop or a step size is missing.")
+    return energy_parameters
+
+
+def _get_region_arrays(energy_parameters):
+    ## Starts, positive steps, stops, and number of points before the stop for each region
+    starts = np.asarray(energy_parameters[0:-1:2])
+    steps = np.abs(np.asarray(energy_parameters[1::2]))
+    stops = np.asarray(energy_parameters[2::2])
+    if np.any(steps == 0): raise ValueError("Energy step size cannot be zero.")
+    ## Points at start + k * step are kept while they are more than half a step before the stop, same as _make_gscan_points
+    numbersBeforeStop = np.maximum(np.ceil(np.abs(stops - starts) / steps - 0.5), 1).astype(int)
+    return starts, steps, stops, numbersBeforeStop
+
+
+def _count_points(energy_parameters):
+    if len(energy_parameters) == 1: return 1
+    starts, steps, stops, numbersBeforeStop = _get_region_arrays(energy_parameters)
+    ## Each region adds its points before the stop and its stop.  The start of every region after the first is the previous stop, so it is not repeated.
+    numberPoints = int(np.sum(numbersBeforeStop) + len(stops))
+    repeatedStarts = np.sum(starts[1:] == stops[:-1])
+    return numberPoints - int(repeatedStarts)
+
+
+@lru_cache(maxsize=256)
+def _expand_energy_grid(energy_parameters):
+    if len(energy_parameters) == 1:
+        grid = np.asarray(energy_parameters, dtype=float)
+        grid.setflags(write=False)
+        return grid
+    starts, steps, stops, numbersBeforeStop = _get_region_arrays(energy_parameters)
+    directions = np.sign(stops - starts)
+    directions[directions == 0] = 1
+
+    ## Index of each point within its region, built without a Python loop over points
+    regionIndices = np.repeat(np.arange(len(starts)), numbersBeforeStop)
+    offsets = np.cumsum(numbersBeforeStop) - numbersBeforeStop
+    pointIndices = np.arange(np.sum(numbersBeforeStop)) - np.repeat(offsets, numbersBeforeStop)
+    pointsBeforeStop = starts[regionIndices] + pointIndices * steps[regionIndices] * directions[regionIndices]
+
+    ## Insert each region's stop after its points, then drop region starts that repeat the previous stop
+    grid = np.insert(pointsBeforeStop, np.cumsum(numbersBeforeStop), stops)
+    positionsStart = np.cumsum(numbersBeforeStop + 1) - (numbersBeforeStop + 1)
+    repeated = positionsStart[1:][starts[1:] == stops[:-1]]
+    grid = np.delete(grid, repeated)
+    grid.setflags(write=False)
+    return grid
+
+
+def get_energy_grid(energy_parameters):
+    """
+    Returns the energy grid for a region definition as a read-only numpy array.
+
+    Results are memoized by region definition, so repeated calls for the same grid do not rebuild it.
+    Use np.array(grid) for a writable copy.
+    """
+    return _expand_energy_grid(normalize_energy_parameters(energy_parameters))
+
+
+def get_energy_points(energy_parameters):
+    ## Energy grid as a list of floats, e.g., for scan arguments and metadata
+    return get_energy_grid(energy_parameters).tolist()
+
+
+def get_number_points(energy_parameters):
+    ## Number of energies in the grid without building the grid.  Named grids come from the precomputed registry.
+    if isinstance(energy_parameters, str) and energy_parameters in energyGridRegistry:
+        return energyGridRegistry[energy_parameters]["number_points"]
+    return _count_points(normalize_energy_parameters(energy_parameters))
+
+
+def validate_energy_grid(energy_parameters, strict=True, tolerance=1e-6):
+    """
+    Checks that every step divides its region and that the grid is monotonic.
+
+    Grids that change direction, e.g., (250, 5, 260, 5, 250), are valid gscan regions for _make_gscan_points,
+    so they only raise in strict mode.
+
+    Parameters
+    ----------
+    energy_parameters : str or tuple
+        Name in energy_list_parameters or (start, step, stop, step, stop, ...)
+    strict : bool
+        If True, a step that does not divide its region or a grid that is not monotonic raises ValueError.  If False, they give a warning,
+        because the stop is still included and the last step of that region is just shorter or longer, and scans can go back and forth.
+    tolerance : float
+        Allowed deviation of (stop - start) / step from a whole number
+
+    Returns
+    -------
+    list of str
+        Problems that were found but did not raise
+    """
+    energy_parameters = normalize_energy_parameters(energy_parameters)
+    problems = []
+    if len(energy_parameters) == 1: return problems
+
+    starts, steps, stops, numbersBeforeStop = _get_region_arrays(energy_parameters)
+    numbersSteps = np.abs(stops - starts) / steps
+    notDividing = np.abs(numbersSteps - np.round(numbersSteps)) > tolerance
+    for indexRegion in np.flatnonzero(notDividing):
+        problem = "Step " + str(steps[indexRegion]) + " does not divide the region from " + str(starts[indexRegion]) + " to " + str(stops[indexRegion]) + " eV."
+        if strict: raise ValueError(problem)
+        problems.append(problem)
+
+    directions = np.sign(stops - starts)
+    if np.any(directions == 0) or not (np.all(directions > 0) or np.all(directions < 0)):
+        problem = "Energy grid " + str(energy_parameters) + " is not monotonic.  All regions must go in the same direction."
+        if strict: raise ValueError(problem)
+        problems.append(problem)
+
+    if not strict:
+        for problem in problems: warnings.warn(problem, stacklevel=2)
+    return problems
+
+
+def estimate_energy_scan_duration(energy_parameters, exposure_time, exposures_per_energy=1, overhead_per_point=overheadPerPoint_Default):
+    ## Time in s for one step sweep of the grid
+    return get_number_points(energy_parameters) * exposures_per_energy * (exposure_time + overhead_per_point)
+
+
+def get_fly_segments(energy_parameters, exposure_time):
+    """
+    Converts a region definition into fly segments.
+
+    Parameters
+    ----------
+    energy_parameters : str or tuple
+        Name in energy_list_parameters or (start, step, stop, step, stop, ...)
+    exposure_time : float
+        Time in s between detector readings
+
+    Returns
+    -------
+    list of tuple
+        (start, stop, speed) for each region, with speed in eV/s = step / exposure_time
+    """
+    energy_parameters = normalize_energy_parameters(energy_parameters)
+    if len(energy_parameters) < 3:
+        raise ValueError("Fly scans need energy list parameters with the format (start, step, stop, step, stop, ...).")
+    starts, steps, stops, numbersBeforeStop = _get_region_arrays(energy_parameters)
+    return [(float(start), float(stop), float(step / exposure_time)) for start, step, stop in zip(starts, steps, stops)]
+
+
+def estimate_fly_duration(energy_parameters, exposure_time):
+    ## Time in s spent flying, not including the move to the start energy
+    energy_parameters = normalize_energy_parameters(energy_parameters)
+    starts, steps, stops, numbersBeforeStop = _get_region_arrays(energy_parameters)
+    return float(np.sum(np.abs(stops - starts) / steps) * exposure_time)
+
+
+def build_energy_grid_registry():
+    ## Point counts and limits for every named grid, computed once from the region definitions
+    registry = {}
+    for energyListName, energyParameters in energy_list_parameters.items():
+        energyParameters = normalize_energy_parameters(energyParameters)
+        limits = energyParameters[0::2]
+        registry[energyListName] = {
+            "number_points": _count_points(energyParameters),
+            "energy_min": min(limits),
+            "energy_max": max(limits),
+        }
+    return registry
+
+
+energyGridRegistry = build_energy_grid_registry()
+
+
+def get_energy_edge(energy_parameters):
+    """
+    Returns a name for the absorption edge of a region definition.
+
+    Named energy lists (e.g., "carbon_NEXAFS") give the element directly.
+    Numerical energies are matched to the narrowest named energy list whose range contains them.
+    """
+    if isinstance(energy_parameters, str): return energy_parameters.split("_")[0]
+    if energy_parameters is None: return None
+
+    ## Start and stop energies of gscan-style tuples are in the even-numbered indices.  A single number is its own start.
+    energies = np.atleast_1d(np.asarray(energy_parameters, dtype=float))[::2]
+    energyNominal = float(np.median(energies))
+    edgeMatched, rangeMatched = None, np.inf
+    for energyListName, energyGrid in energyGridRegistry.items():
+        if energyGrid["energy_min"] <= energyNominal <= energyGrid["energy_max"]:
+            if (energyGrid["energy_max"] - energyGrid["energy_min"]) < rangeMatched:
+                edgeMatched = energyListName.split("_")[0]
+                rangeMatched = energyGrid["energy_max"] - energyGrid["energy_min"]
+    if edgeMatched is None: edgeMatched = "custom_" + str(round(energyNominal))
+
+    return edgeMatched
+
+
+def refine_energy_grid(energies, signal, number_points_new, energy_step_min=0.05, weight_curvature=1.0):
+    """
+    Picks new energies where a measured spectrum changes quickly.
+
+    Each interval between measured energies is scored by how much the normalized signal changes across it
+    plus how strongly the spectrum curves at its ends.  New points are handed out one at a time to the interval whose
+    score per sub-interval is largest, so flat pre-edge and post-edge regions get few or none.
+
+    Parameters
+    ----------
+    energies : array-like
+        Energies measured so far
+    signal : array-like
+        Signal at those energies, e.g., normalized by I0
+    number_points_new : int
+        Maximum number of energies to add
+    energy_step_min : float
+        Intervals are not split below this spacing in eV
+    weight_curvature : float
+        Weight of the curvature term relative to the gradient term
+
+    Returns
+    -------
+    numpy.ndarray
+        New energies in ascending order, not including the ones already measured
+    """
+    energies = np.asarray(energies, dtype=float)
+    signal = np.asarray(signal, dtype=float)
+    order = np.argsort(energies)
+    energies, signal = energies[order], signal[order]
+    if len(energies) < 3 or number_points_new <= 0: return np.empty(0)
+
+    signalRange = np.ptp(signal)
+    if signalRange == 0 or not np.isfinite(signalRange): return np.empty(0)
+    signal = (signal - signal.min()) / signalRange
+
+    spacings = np.diff(energies)
+    changes = np.abs(np.diff(signal))
+    curvatures = np.abs(np.gradient(np.gradient(signal, energies), energies))
+    scores = changes + weight_curvature * 0.5 * (curvatures[:-1] + curvatures[1:]) * spacings**2
+
+    ## Number of sub-intervals each interval can be split into before it gets below energy_step_min
+    splitsMax = np.floor(spacings / energy_step_min).astype(int) - 1
+    splits = np.zeros(len(spacings), dtype=int)
+    for point in range(int(number_points_new)):
+        priorities = np.where(splits < splitsMax, scores / (splits + 1), -1)
+        indexInterval = int(np.argmax(priorities))
+        if priorities[indexInterval] <= 0: break
+        splits[indexInterval] += 1
+
+    energiesNew = [
+        np.linspace(energies[indexInterval], energies[indexInterval + 1], splits[indexInterval] + 2)[1:-1]
+        for indexInterval in np.flatnonzero(splits)
+    ]
+    if len(energiesNew) == 0: return np.empty(0)
+    return np.sort(np.concatenate(energiesNew))
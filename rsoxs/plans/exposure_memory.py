@@ -0,0 +1,113 @@
+## Exposure times learned during RSoXS scans, saved in rsoxs_config so that later scans on the same sample, edge, and polarization start from them.
+## Each entry is a list of points, one per energy, with the exposure time that was actually used (after any retakes) and either its ratio to the requested exposure time (sticky exposure steps) or the peak counts and izero reading (predictive exposure steps).
+## Storing ratios instead of times means that a later scan with a different exposure time still gets the right correction.
+## Entries older than the lifetime are deleted when they are looked up, so a changed sample or beam condition does not keep using old exposures.
+
+import copy
+import datetime
+
+import numpy as np
+
+from ..redis_config import rsoxs_config
+
+
+exposureMemoryLifetime_Default = 7 * 24 * 3600 ## s
+exposureMemoryEnergyTolerance = 0.01 ## eV, points closer than this are the same energy
+
+## Counters since the last reset_exposure_memory_metrics, shown in the queue summary
+exposureMemoryMetrics = {
+    "hits": 0, ## scans that were seeded from a stored entry
+    "misses": 0, ## scans without a stored entry
+    "expired": 0, ## stored entries that were too old and were deleted
+    "saved": 0, ## scans whose exposures were saved
+}
+
+
+def make_exposure_memory_key(sample_id, edge, polarization):
+    return str(sample_id) + "|" + str(edge) + "|" + str(polarization)
+
+
+def _is_expired(entry, lifetime):
+    updated = datetime.datetime.fromisoformat(entry["updated"])
+    return (datetime.datetime.now() - updated).total_seconds() > lifetime
+
+
+def get_exposure_memory(key, lifetime=exposureMemoryLifetime_Default, count=True):
+    """
+    Returns the stored points for a key, sorted by energy, or None if there are none or they expired.
+
+    If count is False, the lookup does not change exposureMemoryMetrics, e.g., for dry runs and summaries.
+    """
+    memory = rsoxs_config.get("exposure_memory", {})
+    entry = memory.get(key)
+    if entry is not None and _is_expired(entry, lifetime):
+        memory = copy.deepcopy(memory)
+        del memory[key]
+        rsoxs_config["exposure_memory"] = memory
+        if count: exposureMemoryMetrics["expired"] += 1
+        entry = None
+    if entry is None:
+        if count: exposureMemoryMetrics["misses"] += 1
+        return None
+    if count: exposureMemoryMetrics["hits"] += 1
+    return sorted(copy.deepcopy(list(entry["points"])), key=lambda point: point["energy"])
+
+
+def save_exposure_memory(key, points):
+    ## New points replace stored points at the same energies.  Stored points at other energies are kept, so partial scans add to the entry.
+    if len(points) == 0: return
+    memory = copy.deepcopy(rsoxs_config.get("exposure_memory", {}))
+    pointsStored = memory.get(key, {}).get("points", [])
+    energiesNew = np.array([point["energy"] for point in points], dtype=float)
+    pointsMerged = [point for point in pointsStored if not np.any(np.abs(energiesNew - point["energy"]) < exposureMemoryEnergyTolerance)]
+    pointsMerged.extend({name: (None if value is None else float(value)) for name, value in point.items()} for point in points)
+    memory[key] = {
+        "updated": datetime.datetime.now().isoformat(),
+        "points": sorted(pointsMerged, key=lambda point: point["energy"]),
+    }
+    rsoxs_config["exposure_memory"] = memory
+    exposureMemoryMetrics["saved"] += 1
+
+
+def interpolate_exposure_memory(points, energy, quantity="correction"):
+    ## Stored quantity (e.g., "correction" or "time") at energy, interpolated in log space, or None if energy is outside the range of points that have it
+    points = [point for point in points or [] if point.get(quantity)]
+    if len(points) == 0: return None
+    energies = np.array([point["energy"] for point in points], dtype=float)
+    if not energies[0] - exposureMemoryEnergyTolerance <= energy <= energies[-1] + exposureMemoryEnergyTolerance: return None
+    values = np.array([point[quantity] for point in points], dtype=float)
+    return float(np.exp(np.interp(energy, energies, np.log(values))))
+
+
+def prune_exposure_memory(lifetime=exposureMemoryLifetime_Default):
+    ## Deletes every expired entry and returns how many there were
+    memory = copy.deepcopy(rsoxs_config.get("exposure_memory", {}))
+    keysExpired = [key for key, entry in memory.items() if _is_expired(entry, lifetime)]
+    for key in keysExpired: del memory[key]
+    rsoxs_config["exposure_memory"] = memory
+    exposureMemoryMetrics["expired"] += len(keysExpired)
+    return len(keysExpired)
+
+
+def clear_exposure_memory(sample_id=None):
+    ## Deletes all entries, or only those of one sample, e.g., after a sample was changed or damaged
+    memory = copy.deepcopy(rsoxs_config.get("exposure_memory", {}))
+    if sample_id is None: memory = {}
+    else: memory = {key: entry for key, entry in memory.items() if key.split("|")[0] != str(sample_id)}
+    rsoxs_config["exposure_memory"] = memory
+
+
+def reset_exposure_memory_metrics():
+    for key in exposureMemoryMetrics: exposureMemoryMetrics[key] = 0
+
+
+def print_exposure_memory_metrics():
+    lookups = exposureMemoryMetrics["hits"] + exposureMemoryMetrics["misses"]
+    print(
+        "Exposure memory: " + str(exposureMemoryMetrics["hits"]) + " hits, "
+        + str(exposureMemoryMetrics["misses"]) + " misses"
+        + (" (" + str(round(100 * exposureMemoryMetrics["hits"] / lookups)) + "% hit rate)" if lookups > 0 else "")
+        + ", " + str(exposureMemoryMetrics["expired"]) + " expired, "
+        + str(exposureMemoryMetrics["saved"]) + " saved"
+    )
+    return dict(exposureMemoryMetrics)
@@ -0,0 +1,131 @@
+## Lookahead pre-positioning between acquisitions in the queue.
+## While the current acquisition finishes, axes that the next acquisition needs are started moving if they cannot affect the current measurement.
+## Moves are started with bps.abs_set in a shared group and waited on before the next acquisition loads its configuration, so nothing is measured mid-move.
+## The EPU, pre-positioned for the next polarization once the current acquisition is done, has its own group.  It is waited on right before the first
+## polarization or scan step of the next acquisition (or before a configuration that moves energy), so it moves while the configuration, sample, and temperature load.
+
+import time
+
+import bluesky.plan_stubs as bps
+
+
+lookaheadGroup = "lookahead"
+lookaheadGroup_Polarization = "lookahead_polarization"
+## Configuration axes (ophyd names) that move the EPU as well, so they cannot move while it is pre-positioned
+axesEPU = ("en",)
+
+allScanTypes = ("nexafs", "nexafs_fly", "rsoxs", "time", "time2D", "spiral")
+scanTypes_2DDetector = ("rsoxs", "time2D", "spiral")
+
+## Axis (ophyd name) : scan types whose measurement that axis affects while it moves.
+## Only axes listed here are pre-positioned.  Every other axis in a configuration (sample stage, mirrors, slits, izero, shutter, etc.) is assumed to interfere with everything or to depend on the configuration move order, so it is left for load_configuration.
+## polarization is the EPU gap and phase, which change the beam for every scan type, so it is only pre-positioned after the shutter has closed for the last step of the current acquisition.
+axisInterference = {
+    "Detector WAXS Translation": scanTypes_2DDetector, ## NEXAFS reads diodes and the beamstop, not the camera
+    "Detector SAXS Translation": scanTypes_2DDetector,
+    "Beam Stop SAXS": scanTypes_2DDetector,
+    "Beam Stop WAXS": allScanTypes, ## beamstop_waxs is the main NEXAFS detector
+    "polarization": allScanTypes,
+}
+
+
+def axis_interferes(axis_name, scan_type):
+    ## Axes missing from the table are assumed to interfere
+    return scan_type in axisInterference.get(axis_name, allScanTypes)
+
+
+def get_configuration_premoves(configuration_setpoints, scan_type_current):
+    """
+    Picks the configuration moves for the next acquisition that can run during the current scan.
+
+    Parameters
+    ----------
+    configuration_setpoints : list of dict
+        Entries of GLOBAL_CONFIGURATION_DICT for the next configuration, each with "motor", "position", and "order"
+    scan_type_current : str
+        scan_type of the step that is running while the moves happen
+
+    Returns
+    -------
+    list
+        Alternating motors and positions, in the format of bps.mv
+    """
+    premoves = []
+    for setpoint in configuration_setpoints:
+        motorName = getattr(setpoint["motor"], "name", str(setpoint["motor"]))
+        if motorName not in axisInterference: continue
+        if axis_interferes(motorName, scan_type_current): continue
+        premoves.extend([setpoint["motor"], setpoint["position"]])
+    return premoves
+
+
+def configuration_moves_epu(configuration_setpoints):
+    ## Whether loading a configuration (entries of GLOBAL_CONFIGURATION_DICT) moves the EPU
+    return any(getattr(setpoint["motor"], "name", str(setpoint["motor"])) in axesEPU for setpoint in configuration_setpoints)
+
+
+def start_premoves(*args, group=lookaheadGroup):
+    ## Starts moves without waiting, e.g., start_premoves(motor1, position1, motor2, position2)
+    for motor, position in zip(args[0::2], args[1::2]):
+        print("Pre-positioning " + str(getattr(motor, "name", motor)) + " to " + str(position))
+        yield from bps.abs_set(motor, position, group=group)
+
+
+def wait_premoves(group=lookaheadGroup):
+    yield from bps.wait(group=group)
+
+
+def benchmark_lookahead_overlap(move_time=5, measurement_time=5, load_time=5, number_acquisitions=5):
+    """
+    Measures the time saved by lookahead using simulated motors, with the moves and waits in the order of run_acquisitions_single.
+
+    Each simulated acquisition waits for the configuration premoves, loads its configuration and sample (a move of load_time), waits for the
+    polarization premove, and measures.  Without lookahead, the detector and EPU moves for the next acquisition run after the measurement.
+    With lookahead, the detector moves during the measurement (start_lookahead_during_scan) and the EPU during the next load (start_lookahead_after_scan).
+
+    Returns
+    -------
+    dict
+        Wall times in s for the sequential and overlapped runs and the savings
+    """
+    from bluesky import RunEngine
+    from ophyd.sim import SynAxis
+
+    RE = RunEngine({})
+    detector = SynAxis(name="Detector WAXS Translation", delay=move_time)
+    polarization = SynAxis(name="polarization", delay=move_time)
+    sample = SynAxis(name="sample", delay=load_time)
+
+    def sequential():
+        for index in range(number_acquisitions):
+            yield from bps.mv(sample, index + 1)
+            yield from bps.sleep(measurement_time)
+            yield from bps.mv(detector, index + 1)
+            yield from bps.mv(polarization, index + 1)
+
+    def overlapped():
+        for index in range(number_acquisitions):
+            yield from wait_premoves()
+            yield from bps.mv(sample, index + 1)
+            yield from wait_premoves(group=lookaheadGroup_Polarization)
+            yield from start_premoves(detector, index + 1)
+            yield from bps.sleep(measurement_time)
+            yield from start_premoves(polarization, index + 1, group=lookaheadGroup_Polarization)
+        yield from wait_premoves()
+        yield from wait_premoves(group=lookaheadGroup_Polarization)
+
+    timeStart = time.monotonic()
+    RE(sequential())
+    timeSequential = time.monotonic() - timeStart
+
+    timeStart = time.monotonic()
+    RE(overlapped())
+    timeOverlapped = time.monotonic() - timeStart
+
+    results = {
+        "time_sequential": timeSequential,
+        "time_overlapped": timeOverlapped,
+        "time_saved": timeSequential - timeOverlapped,
+    }
+    print("Sequential: " + str(round(timeSequential, 2)) + " s, with lookahead: " + str(round(timeOverlapped, 2)) + " s, saved " + str(round(results["time_saved"], 2)) + " s")
+    return results
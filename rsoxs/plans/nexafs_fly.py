@@ -0,0 +1,214 @@
+## Fly-mode NEXAFS from the same energy_list_parameters region definitions used by step scans.
+## The energy is moved continuously through each region, and the detectors are read every exposure_time.
+## The speed of each region is set so that one reading is taken per step of the requested grid, so the grid density is kept while settle, trigger, and readout overhead per point go away.
+## The EPU is set up as in the legacy NEXAFS_fly_scan_core: the polarization is set with the scan lock off, the lock is turned on, and the start is approached in the scan direction.
+## While flying with gap models in use (use_gap_models), the EPU leads the mono by the speed offset of each segment (set_fly_gap_offsets).  Readings are binned onto the requested grid at the end of the run (FlyScanBinner),
+## and saved with the run as the flyScanBinnedStream stream.
+
+import bluesky.plan_stubs as bps
+import bluesky.preprocessors as bpp
+import numpy as np
+from event_model import DocumentRouter
+from ophyd import Signal
+
+from nbs_bl.plans.scans import nbs_fly_scan
+from nbs_bl.hw import en, shutter_control
+
+from .energy_grids import get_energy_points, get_fly_segments, estimate_fly_duration
+from .adaptive_energy import get_reading_value
+from ..HW.energy import set_fly_gap_offsets, clear_fly_gap_offsets
+
+
+flyLockOffset = 10 ## eV past the start, against the scan direction, where the polarization is set before the scan lock is turned on
+flyApproachOffset = 0.1 ## eV before the start where the fly begins, so the start is approached in the scan direction
+flyScanBinnedStream = "binned" ## stream of the fly scan run with the readings binned onto the requested grid
+
+
+def bin_fly_scan_to_grid(energies_measured, signals_measured, energy_grid):
+    """
+    Bins fly scan readings back onto the requested energy grid.
+
+    Each reading goes to the nearest grid point, using bin edges halfway between neighboring grid points.
+
+    Parameters
+    ----------
+    energies_measured : array-like
+        Energy readback for each reading
+    signals_measured : array-like
+        Signal for each reading.  2D arrays are binned along the first axis.
+    energy_grid : array-like
+        Requested energies, e.g., from get_energy_points
+
+    Returns
+    -------
+    signals_binned : numpy.ndarray
+        Mean signal at each grid point, nan where no readings fell in the bin
+    counts : numpy.ndarray
+        Number of readings in each bin
+    """
+    energies_measured = np.asarray(energies_measured, dtype=float)
+    signals_measured = np.asarray(signals_measured, dtype=float)
+    energy_grid = np.asarray(energy_grid, dtype=float)
+
+    ## Bin edges are computed on the sorted grid, then mapped back so that descending grids work as well
+    order = np.argsort(energy_grid)
+    grid_sorted = energy_grid[order]
+    edges = (grid_sorted[1:] + grid_sorted[:-1]) / 2
+    indices_sorted = np.searchsorted(edges, energies_measured)
+
+    counts_sorted = np.bincount(indices_sorted, minlength=len(grid_sorted)).astype(float)
+    sums_sorted = np.zeros((len(grid_sorted),) + signals_measured.shape[1:])
+    np.add.at(sums_sorted, indices_sorted, signals_measured)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means_sorted = sums_sorted / counts_sorted.reshape((-1,) + (1,) * (sums_sorted.ndim - 1))
+
+    signals_binned = np.empty_like(means_sorted)
+    signals_binned[order] = means_sorted
+    counts = np.empty_like(counts_sorted)
+    counts[order] = counts_sorted
+    return signals_binned, counts
+
+
+class FlyScanBinner(DocumentRouter):
+    """
+    Callback that collects the scalar readings of a fly scan, to bin them onto the energy_grid of its start document.
+
+    Readings may come in one stream or in a stream per device.  The energy of each reading is interpolated from the energy readings by timestamp.
+    bin_readings is called by binned_stream_wrapper before the run closes, so that the result is saved with the run.
+    The result is kept in results: energy_grid, and signals and counts with the binned mean and number of readings of each data key.
+    """
+
+    def __init__(self, energy_name=None):
+        super().__init__()
+        self.energy_name = energy_name if energy_name is not None else en.energy.name
+        self.results = None
+        self._energy_grid = None
+        self._readings = {}
+        self._streams = {} ## descriptor uid : stream name
+
+    def start(self, doc):
+        self._energy_grid = doc.get("energy_grid")
+        self._readings = {}
+        self._streams = {}
+        self.results = None
+
+    def descriptor(self, doc):
+        self._streams[doc["uid"]] = doc.get("name")
+
+    def event(self, doc):
+        if self._streams.get(doc["descriptor"]) == flyScanBinnedStream: return
+        for key, value in doc["data"].items():
+            if np.ndim(value) != 0: continue
+            self._readings.setdefault(key, ([], []))
+            self._readings[key][0].append(doc["timestamps"].get(key, doc["time"]))
+            self._readings[key][1].append(value)
+
+    def bin_readings(self):
+        ## Bins the readings collected so far.  Returns the result, or None if there is nothing to bin.
+        if self._energy_grid is None or len(self._readings) == 0: return None
+        ## Data key of the energy, matched to its name as in get_reading_value
+        reading = {key: {"value": key} for key in self._readings}
+        try:
+            energyKey = get_reading_value(reading, self.energy_name)
+        except KeyError:
+            print("Fly scan readings were not binned: no " + str(self.energy_name) + " readings")
+            return None
+        timesEnergy, energies = (np.asarray(values, dtype=float) for values in self._readings[energyKey])
+        order = np.argsort(timesEnergy)
+        results = {"energy_grid": np.asarray(self._energy_grid, dtype=float), "signals": {}, "counts": {}}
+        for key, (times, values) in self._readings.items():
+            if key == energyKey: continue
+            energiesReading = np.interp(np.asarray(times, dtype=float), timesEnergy[order], energies[order])
+            results["signals"][key], results["counts"][key] = bin_fly_scan_to_grid(energiesReading, values, self._energy_grid)
+        self.results = results
+        numbersEmpty = [int(np.sum(counts == 0)) for counts in results["counts"].values()]
+        print("Binned " + str(len(results["signals"])) + " fly scan signals onto " + str(len(results["energy_grid"])) + " grid points, at most " + str(max(numbersEmpty + [0])) + " without readings")
+        return results
+
+
+def read_binned_readings(binner):
+    ## Saves the binned readings as one event of the flyScanBinnedStream stream: the grid, and the mean and number of readings of each data key at each grid point
+    results = binner.bin_readings()
+    if results is None: return None
+    signals = [Signal(name="energy_grid", value=results["energy_grid"])]
+    for key, signal in results["signals"].items():
+        signals.append(Signal(name=key + "_binned", value=np.nan_to_num(signal))) ## bins without readings are 0, with a count of 0
+        signals.append(Signal(name=key + "_binned_counts", value=results["counts"][key]))
+    yield from bps.create(flyScanBinnedStream)
+    for signal in signals:
+        yield from bps.read(signal)
+    yield from bps.save()
+    return results
+
+
+def binned_stream_wrapper(plan, binner):
+    ## Adds the readings binned by binner to the run of plan before it closes.  binner has to be subscribed to the documents of plan.
+    def insert_before_close(msg):
+        if msg.command == "close_run":
+            def new_gen():
+                yield from read_binned_readings(binner)
+                return (yield msg)
+            return new_gen(), None
+        else:
+            return None, None
+
+    return (yield from bpp.plan_mutator(plan, insert_before_close))
+
+
+def prepare_epu_for_fly(energy_start, direction, polarization=None, locked=True):
+    ## As in NEXAFS_fly_scan_core: set the polarization with the scan lock off, lock it, then go to just before the start so it is approached in the scan direction
+    if polarization is None or np.isnan(polarization): polarization = en.polarization.setpoint.get()
+    yield from bps.mv(en.scanlock, 0)
+    yield from bps.mv(en.energy, energy_start - direction * flyLockOffset, en.polarization, polarization)
+    if locked: yield from bps.mv(en.scanlock, 1)
+    yield from bps.mv(en.energy, energy_start - direction * flyApproachOffset)
+    return polarization
+
+
+def _cleanup_fly():
+    clear_fly_gap_offsets()
+    yield from bps.mv(en.scanlock, 0)
+    yield from bps.mv(shutter_control, 0)
+
+
+def nexafs_fly_scan(
+        energy_parameters,
+        exposure_time=0.5,
+        group_name=None,
+        polarization=None,
+        locked=True,
+        md=None,
+):
+    """
+    Runs a NEXAFS fly scan over the regions of a gscan-style energy list.
+
+    The requested grid is saved in the metadata under energy_grid, and the readings binned onto it by FlyScanBinner are saved in the flyScanBinnedStream stream of the run.
+    polarization defaults to the current polarization setpoint.  With locked, the EPU gap follows the energy at that polarization (scan lock).
+    """
+    segments = get_fly_segments(energy_parameters, exposure_time)
+    _md = {
+        "energy_list_parameters": str(energy_parameters),
+        "energy_grid": get_energy_points(energy_parameters),
+        "fly_segments": segments,
+    }
+    _md.update(md or {})
+
+    arguments_fly = []
+    for energy_start, energy_stop, speed in segments:
+        arguments_fly.extend([energy_start, energy_stop, speed])
+    print("Fly scanning " + str(len(segments)) + " regions from " + str(segments[0][0]) + " to " + str(segments[-1][1]) + " eV in about " + str(round(estimate_fly_duration(energy_parameters, exposure_time))) + " s")
+
+    def _fly():
+        direction = 1 if segments[0][1] >= segments[0][0] else -1
+        polarizationFly = yield from prepare_epu_for_fly(segments[0][0], direction, polarization, locked)
+        set_fly_gap_offsets(segments, polarizationFly)
+        binner = FlyScanBinner()
+        return (yield from bpp.subs_wrapper(binned_stream_wrapper(nbs_fly_scan(
+            en.energy,
+            *arguments_fly,
+            period=exposure_time,
+            group_name=group_name,
+            md=_md,
+            ), binner), binner))
+
+    return (yield from bpp.finalize_wrapper(_fly(), _cleanup_fly()))
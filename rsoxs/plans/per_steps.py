@@ -1,6 +1,6 @@
-from bluesky.preprocessors import rewindable_wrapper
+from bluesky.preprocessors import rewindable_wrapper, plan_mutator
 from bluesky.utils import separate_devices, all_safe_rewind
-from bluesky.plan_stubs import trigger_and_read, move_per_step
+from bluesky.plan_stubs import trigger_and_read, move_per_step, one_nd_step
 import bluesky.plan_stubs as bps
 import copy
 
@@ -13,6 +13,18 @@ from bluesky.plan_stubs import (
 )
 from nbs_bl.hw import shutter_open_time, shutter_y
 from bluesky.utils import Msg, short_uid as _short_uid
+import numpy as np
+
+from .exposure_memory import interpolate_exposure_memory
+
+
+## Counters for the exposure time controllers since the last reset_exposure_metrics
+exposureMetrics = {
+    "points": 0, ## steps taken with predictive_exposure_step
+    "predicted": 0, ## steps where the exposure time was set from a prediction
+    "clipped": 0, ## predictions limited by the allowed range or the largest change per step
+    "retakes": 0, ## extra exposures taken by take_exposure_corrected_reading after under or over exposure
+}
 
 
 def trigger_and_read_with_shutter(devices, shutter=None, name="primary", lead_detector=None):
@@ -97,8 +109,26 @@ def trigger_and_read_with_shutter(devices, shutter=None, name="primary", lead_de
     return (yield from rewindable_wrapper(inner_trigger_and_read(), rewindable))
 
 
+def get_exposure_state(detectors):
+    ## Under and over exposure of the last reading.  Detectors with use_frame_statistics are checked from their frame first.
+    under_exposed = False
+    over_exposed = False
+    for det in detectors:
+        if getattr(det, "use_frame_statistics", False) and hasattr(det, "check_frame_exposure"):
+            det.check_frame_exposure()
+        if not hasattr(det, "under_exposed"):
+            continue
+        if det.under_exposed.get():
+            under_exposed = True
+        if not hasattr(det, "saturated"):
+            continue
+        if det.saturated.get():
+            over_exposed = True
+    return under_exposed, over_exposed
+
+
 def take_exposure_corrected_reading(
-    detectors=None, take_reading=None, shutter=None, check_exposure=False, lead_detector=None
+    detectors=None, take_reading=None, shutter=None, check_exposure=False, lead_detector=None, count_retakes=False
 ):
     """Trigger and read detectors with automatic exposure time correction.
 
@@ -118,6 +148,8 @@ def take_exposure_corrected_reading(
         Whether to check and correct exposure time, by default False
     lead_detector : ophyd.Device, optional
         Primary detector that controls timing, by default None
+    count_retakes : bool, optional
+        Whether to count retakes in exposureMetrics, by default False.  Only set for predictive_exposure_step, whose steps are the ones counted there.
 
     Yields
     ------
@@ -130,19 +162,9 @@ def take_exposure_corrected_reading(
     take_reading = (
         take_reading if take_reading else trigger_and_read_with_shutter
     )  ## This line was added such that there are no functions directly inputted into the function heading.
-    yield from take_reading(list(detectors), shutter=shutter, lead_detector=lead_detector)
+    reading = yield from take_reading(list(detectors), shutter=shutter, lead_detector=lead_detector)
     if check_exposure:
-        under_exposed = False
-        over_exposed = False
-        for det in detectors:
-            if not hasattr(det, "under_exposed"):
-                continue
-            if det.under_exposed.get():
-                under_exposed = True
-            if not hasattr(det, "saturated"):
-                continue
-            if det.saturated.get():
-                over_exposed = True
+        under_exposed, over_exposed = get_exposure_state(detectors)
         while under_exposed or over_exposed:
             yield Msg("checkpoint")
             old_time = shutter_open_time.get()
@@ -172,21 +194,13 @@ def take_exposure_corrected_reading(
                     det.cam.acquire_time.set(new_time / 1000).wait()
                 if hasattr(det, "exposure_time"):
                     det.exposure_time.set(new_time / 1000).wait()
-            yield from take_reading(list(detectors), shutter=shutter)
-            under_exposed = False
-            over_exposed = False
-            for det in detectors:
-                if not hasattr(det, "under_exposed"):
-                    continue
-                if det.under_exposed.get():
-                    under_exposed = True
-                if not hasattr(det, "saturated"):
-                    continue
-                if det.saturated.get():
-                    over_exposed = True
+            if count_retakes: exposureMetrics["retakes"] += 1
+            reading = yield from take_reading(list(detectors), shutter=shutter, lead_detector=lead_detector)
+            under_exposed, over_exposed = get_exposure_state(detectors)
+    return reading
 
 
-def one_nd_sticky_exp_step(detectors, step, pos_cache, take_reading=None, remember=None):
+def one_nd_sticky_exp_step(detectors, step, pos_cache, take_reading=None, remember=None, memory=None):
     """
     Inner loop of an N-dimensional step scan
 
@@ -210,6 +224,10 @@ def one_nd_sticky_exp_step(detectors, step, pos_cache, take_reading=None, rememb
 
         Defaults to `trigger_and_read`
     remember :  pass a dict to remember the last exposure correction
+        the exposure time used at each energy and its ratio to the exposure time at the start of the scan are also added to remember["points"],
+        e.g., to be saved with save_exposure_memory
+    memory : list of dict, optional
+        points from get_exposure_memory.  Energies inside their range start from the stored correction instead of the last correction.
     """
     yield Msg("checkpoint")
     if remember == None:
@@ -220,8 +238,17 @@ def one_nd_sticky_exp_step(detectors, step, pos_cache, take_reading=None, rememb
     take_reading = take_reading if take_reading else trigger_and_read_with_shutter
 
     yield from move_per_step(step, pos_cache)
-    input_time = shutter_open_time.get()
-    if "last_correction" in remember:
+    energy = float(list(step.values())[0])
+    base_time = remember.setdefault("base_time", shutter_open_time.get())
+    correction_memory = interpolate_exposure_memory(memory, energy, "correction") if memory else None
+    if correction_memory is not None and 2 < base_time * correction_memory < 10000:
+        input_time = round(base_time * correction_memory)
+        yield from bps.mov(shutter_open_time, input_time)
+        for detector in detectors:
+            if hasattr(detector, "cam"):
+                yield from bps.mv(detector.cam.acquire_time, input_time / 1000)
+    elif "last_correction" in remember:
+        input_time = shutter_open_time.get()
         new_time = input_time
         if remember["last_correction"] != 1 and 0.0005 < remember["last_correction"] < 50000:
             new_time = round(input_time * remember["last_correction"])
@@ -231,7 +258,383 @@ def one_nd_sticky_exp_step(detectors, step, pos_cache, take_reading=None, rememb
             for detector in detectors:
                 if hasattr(detector, "cam"):
                     yield from bps.mv(detector.cam.acquire_time, new_time / 1000)
+    else:
+        input_time = shutter_open_time.get()
 
     yield from take_reading(list(detectors) + list(motors))
     output_time = shutter_open_time.get()
     remember["last_correction"] = float(output_time) / float(input_time)
+    remember.setdefault("points", []).append({"energy": energy, "time": float(output_time), "correction": float(output_time) / float(base_time)})
+
+
+def reset_exposure_metrics():
+    for key in exposureMetrics: exposureMetrics[key] = 0
+
+
+def print_exposure_metrics():
+    ## Returns a copy of the counters as well, e.g., for saving in metadata
+    points = max(1, exposureMetrics["points"])
+    print(
+        "Exposure control: " + str(exposureMetrics["points"]) + " predictive steps, "
+        + str(exposureMetrics["predicted"]) + " set from a prediction, "
+        + str(exposureMetrics["clipped"]) + " clipped, "
+        + str(exposureMetrics["retakes"]) + " retakes (" + str(round(100 * exposureMetrics["retakes"] / points, 1)) + "% of predictive steps)"
+    )
+    return dict(exposureMetrics)
+
+
+def _extrapolate_log(energies, values, energy):
+    ## Linear extrapolation in log space from the last two points keeps count rates and flux positive
+    logValues = np.log(np.maximum(values[-2:], 1e-12))
+    if len(values) < 2 or energies[-1] == energies[-2]: return float(values[-1])
+    slope = (logValues[-1] - logValues[-2]) / (energies[-1] - energies[-2])
+    return float(np.exp(logValues[-1] + slope * (energy - energies[-1])))
+
+
+def _get_rates(points):
+    ## Energies, count rates per unit flux, and fluxes of points that have counts
+    points = [point for point in points if point.get("counts") is not None]
+    energies = np.array([point["energy"] for point in points], dtype=float)
+    fluxes = np.array([point["flux"] if point.get("flux") else 1.0 for point in points], dtype=float)
+    times = np.array([point["time"] for point in points], dtype=float)
+    counts = np.maximum(np.array([point["counts"] for point in points], dtype=float), 1.0)
+    return energies, counts / (times * fluxes), fluxes
+
+
+def predict_exposure_time(history, energy, target_counts, time_min=2, time_max=10000, change_max=4, reference=None):
+    """
+    Predicts the exposure time in ms that gives target_counts at energy.
+
+    The count rate per unit flux (counts / exposure time / I0) and the flux are each extrapolated from the previous points,
+    so both the sample response and the energy dependence of the beam are followed.
+    If reference points from an earlier scan of the same sample cover the energy, the count rate follows their shape instead,
+    scaled to the last point of this scan, so sharp resonances are anticipated instead of extrapolated.
+
+    Parameters
+    ----------
+    history : list of dict
+        Previous points, each with "energy", "time" (ms), "counts", and "flux" (I0 reading, or None)
+    energy : float
+        Energy of the next point
+    target_counts : float
+        Peak counts to aim for, inside the linear range of the detector
+    time_min, time_max : float
+        Allowed exposure times in ms
+    change_max : float
+        Largest factor the exposure time can change by from one point to the next
+    reference : list of dict, optional
+        Points in the same format, e.g., from get_exposure_memory
+
+    Returns
+    -------
+    time : float or None
+        Predicted exposure time in ms, or None if there is no history or reference yet
+    clipped : bool
+        True if the prediction was limited by the allowed range or by change_max
+    """
+    energies, rates, fluxes = _get_rates(history)
+    energiesReference, ratesReference, fluxesReference = _get_rates(reference or [])
+    covered = len(energiesReference) > 0 and energiesReference.min() <= energy <= energiesReference.max()
+    if len(energies) == 0 and not covered: return None, False
+
+    if covered:
+        order = np.argsort(energiesReference)
+        energiesReference, ratesReference, fluxesReference = energiesReference[order], ratesReference[order], fluxesReference[order]
+        rate = np.exp(np.interp(energy, energiesReference, np.log(ratesReference)))
+        if len(energies) > 0:
+            rate *= rates[-1] / np.exp(np.interp(energies[-1], energiesReference, np.log(ratesReference)))
+            flux = _extrapolate_log(energies, fluxes, energy)
+        else: flux = np.exp(np.interp(energy, energiesReference, np.log(fluxesReference)))
+    else:
+        rate = _extrapolate_log(energies, rates, energy)
+        flux = _extrapolate_log(energies, fluxes, energy)
+    time = target_counts / (rate * flux)
+    timeBounded = min(max(time, time_min), time_max)
+    if len(energies) > 0:
+        timeLast = history[-1]["time"]
+        timeBounded = min(max(timeBounded, timeLast / change_max), timeLast * change_max)
+    return float(round(timeBounded)), not np.isclose(timeBounded, time)
+
+
+def predictive_exposure_step(
+    detectors,
+    step,
+    pos_cache,
+    take_reading=None,
+    history=None,
+    lead_detector=None,
+    izero=None,
+    target_fraction=0.5,
+    time_min=2,
+    time_max=10000,
+    memory=None,
+):
+    """
+    Inner loop of an N-dimensional step scan that sets the exposure time before each trigger.
+
+    The exposure time is predicted with predict_exposure_time from the peak counts of the lead detector (from its frame statistics, or stats1.max_value)
+    and the izero reading of the previous points.  The target is target_fraction of the saturation threshold of the lead detector,
+    so the prediction stays in the linear range.  The reading is still taken with take_reading, so exposure checking with retakes
+    (take_exposure_corrected_reading with check_exposure=True) remains as a fallback, and retakes are counted in exposureMetrics if it is given count_retakes=True.
+
+    Parameters
+    ----------
+    history : list, optional
+        Pass the same list for every step of a scan (e.g., with partial) so that predictions use the previous points
+    lead_detector : ophyd.Device, optional
+        Area detector with stats1.  Defaults to the first detector with a cam.
+    izero : ophyd.Device, optional
+        Flux monitor whose reading is in the same event
+    memory : list of dict, optional
+        Points from get_exposure_memory, used as the reference of predict_exposure_time
+    """
+    yield Msg("checkpoint")
+    if history is None:
+        history = []
+    motors = step.keys()
+    take_reading = take_reading if take_reading else trigger_and_read_with_shutter
+    if lead_detector is None:
+        lead_detector = next((detector for detector in detectors if hasattr(detector, "cam")), None)
+
+    yield from move_per_step(step, pos_cache)
+    energy = float(list(step.values())[0])
+    exposureMetrics["points"] += 1
+
+    if lead_detector is not None:
+        target_counts = target_fraction * getattr(lead_detector, "saturation_high_threshold", 100000)
+        time, clipped = predict_exposure_time(history, energy, target_counts, time_min, time_max, reference=memory)
+        if time is not None:
+            exposureMetrics["predicted"] += 1
+            exposureMetrics["clipped"] += int(clipped)
+            yield from bps.mov(shutter_open_time, time)
+            for detector in detectors:
+                if hasattr(detector, "cam"):
+                    yield from bps.mv(detector.cam.acquire_time, time / 1000)
+
+    reading = yield from take_reading(list(detectors) + list(motors))
+
+    if lead_detector is not None:
+        ## Read after any retakes, so the history has the exposure time and counts that were actually used
+        time = yield from bps.rd(shutter_open_time)
+        if getattr(lead_detector, "use_frame_statistics", False) and hasattr(lead_detector, "check_frame_exposure"):
+            counts = lead_detector.check_frame_exposure()["max_value"]
+        else:
+            counts = yield from bps.rd(lead_detector.stats1.max_value)
+        flux = None
+        if izero is not None and reading is not None:
+            flux = next((value["value"] for key, value in reading.items() if key.startswith(izero.name)), None)
+        if time and counts is not None:
+            history.append({"energy": energy, "time": float(time), "counts": float(counts), "flux": flux})
+    return reading
+
+
+def make_overlapped_readout_step(shutter, lead_detector=None):
+    """
+    Inner loop of an N-dimensional step scan that moves to the next point while the lead detector is still reading out.
+
+    Each step waits for the shutter to close after the exposure instead of waiting for the lead detector to finish.
+    The event of that step is created and the other devices (including the motors) are read, but the event is left open.
+    The next step starts its moves, then waits for the readout, reads the lead detector, and saves the previous event before
+    waiting for the moves and triggering again.  Events are therefore saved in step order, and nothing moves while the shutter is open.
+    Steps with exposures shorter than 0.75 s are taken with trigger_and_read, as in trigger_and_read_with_shutter.
+
+    Exposure checking with retakes is not possible here, because the next move has started before the exposure can be checked.
+
+    Parameters
+    ----------
+    shutter : device with set and waiting enabled, which opens and closes with the exposures of the lead detector
+    lead_detector : device, optional
+        Primary detector that controls timing.  Defaults to the first detector.
+
+    Returns
+    -------
+    per_step, finish_step
+        per_step for the scan, and a plan that saves the last open event.  Wrap the scan with overlapped_readout_wrapper(plan, finish_step)
+        so that the last event is saved before the run closes.
+    """
+    pending = {"lead_detector": None, "group": None, "readings": None, "rewindable": True}
+
+    def finish_step():
+        ## Reads the lead detector of the open event, if there is one, and saves it
+        if pending["lead_detector"] is None:
+            return None
+        lead, group, ret, rewindable = pending["lead_detector"], pending["group"], pending["readings"], pending["rewindable"]
+        pending.update({"lead_detector": None, "group": None, "readings": None, "rewindable": True})
+
+        def inner_finish_step():
+            yield from bps.wait(group=group)  ## the readout may already be over if the moves took longer
+            reading = yield from read(lead)
+            if reading is not None:
+                ret.update(reading)
+            yield from save()
+            return ret
+
+        return (yield from rewindable_wrapper(inner_finish_step(), rewindable))
+
+    def overlapped_readout_step(detectors, step, pos_cache, take_reading=None):
+        groupMove = _short_uid("move")
+        for motor, position in step.items():
+            if position == pos_cache[motor]:
+                continue
+            yield from bps.abs_set(motor, position, group=groupMove)
+            pos_cache[motor] = position
+        yield from finish_step()
+        yield Msg("checkpoint")  ## not allowed while an event is open
+        yield from bps.wait(group=groupMove)
+
+        devices = separate_devices(list(detectors) + list(step.keys()))
+        lead = lead_detector if lead_detector is not None else devices[0]
+        others = [device for device in devices if device is not lead]
+        if lead.cam.acquire_time.get() < 0.75:
+            return (yield from trigger_and_read([lead] + others))
+        rewindable = all_safe_rewind(others)  # if devices can be re-triggered
+
+        def inner_overlapped_readout_step():
+            groupMeasure = _short_uid("measure")
+            groupTrigger = _short_uid("trigger")
+            groupShutter = _short_uid("shutter")
+            yield from bps.abs_set(shutter, 1, just_wait=True, group=groupShutter)
+            yield from bps.trigger(lead, group=groupMeasure)
+            yield from bps.wait(group=groupShutter)
+            for obj in others:
+                if hasattr(obj, "trigger"):
+                    yield from trigger(obj, group=groupTrigger)
+            yield from wait(group=groupTrigger)
+            ## The exposure is over once the shutter closes again, so the next step can start moving
+            yield from bps.abs_set(shutter, 0, just_wait=True, group=groupShutter)
+            yield from bps.wait(group=groupShutter)
+
+            yield from create("primary")
+            ret = {}
+            for obj in others:
+                reading = yield from read(obj)
+                if reading is not None:
+                    ret.update(reading)
+            pending.update({"lead_detector": lead, "group": groupMeasure, "readings": ret, "rewindable": rewindable})
+            return ret
+
+        return (yield from rewindable_wrapper(inner_overlapped_readout_step(), rewindable))
+
+    return overlapped_readout_step, finish_step
+
+
+def overlapped_readout_wrapper(plan, finish_step):
+    ## Saves the event left open by the last step of make_overlapped_readout_step before the run closes
+    def insert_before_close(msg):
+        if msg.command == "close_run":
+            def new_gen():
+                yield from finish_step()
+                yield msg
+            return new_gen(), None
+        else:
+            return None, None
+
+    return (yield from plan_mutator(plan, insert_before_close))
+
+
+def benchmark_overlapped_readout(exposure_time=2, readout_time=3, move_time=1, number_points=5):
+    """
+    Measures the time saved by make_overlapped_readout_step using a simulated CCD with a shutter and readout latency.
+
+    The same list scan is run with one_nd_step and trigger_and_read_with_shutter, and with make_overlapped_readout_step.
+    Also checks that both runs give their events in step order and that the motor never moved while the shutter was open.
+
+    Returns
+    -------
+    dict
+        Wall times in s for both runs, the savings, and the number of moves that overlapped an exposure (should be 0)
+    """
+    import threading
+    import time
+    from functools import partial
+    from bluesky import RunEngine
+    from bluesky.plans import list_scan
+    from ophyd import Device, Component, Signal
+    from ophyd.sim import SynAxis
+    from ophyd.status import Status, DeviceStatus
+
+    class SimShutter(Signal):
+        def set(self, value, just_wait=False, **kwargs):
+            if not just_wait:
+                return super().set(value, **kwargs)
+            status = Status(self)
+
+            def check_value(value=None, **kwargs):
+                if value == status_value and not status.done:
+                    status.set_finished()
+
+            status_value = value
+            self.subscribe(check_value, run=True)
+            status.add_callback(lambda status: self.clear_sub(check_value))
+            return status
+
+    class SimCam(Device):
+        acquire_time = Component(Signal, value=exposure_time)
+
+    class SimCCD(Device):
+        cam = Component(SimCam, "cam")
+        image = Component(Signal, value=0)
+
+        def trigger(self):
+            status = DeviceStatus(self)
+
+            def expose():
+                shutter.put(1)
+                time.sleep(exposure_time)
+                shutter.put(0)
+                time.sleep(readout_time)
+                self.image.put(self.image.get() + 1)
+                status.set_finished()
+
+            threading.Thread(target=expose, daemon=True).start()
+            return status
+
+    shutter = SimShutter(name="shutter", value=0)
+    ccd = SimCCD(name="ccd")
+    motor = SynAxis(name="motor", delay=move_time)
+    positions = list(range(1, number_points + 1))
+
+    ## Every motor move and shutter change with its time, to find moves during exposures
+    log = []
+    shutter.subscribe(lambda value, **kwargs: log.append(("shutter", value, time.monotonic())), run=False)
+    motor.readback.subscribe(lambda value, **kwargs: log.append(("motor", value, time.monotonic())), run=False)
+
+    def count_moves_during_exposure():
+        shutterOpen = False
+        moves = 0
+        for name, value, timestamp in log:
+            if name == "shutter":
+                shutterOpen = value == 1
+            elif shutterOpen:
+                moves += 1
+        return moves
+
+    def run(plan):
+        events = []
+        log.clear()
+        RE = RunEngine({})
+        timeStart = time.monotonic()
+        RE(plan, lambda name, doc: events.append(doc["data"][motor.name]) if name == "event" else None)
+        return time.monotonic() - timeStart, events, count_moves_during_exposure()
+
+    sequentialStep = partial(one_nd_step, take_reading=partial(trigger_and_read_with_shutter, shutter=shutter, lead_detector=ccd))
+    timeSequential, eventsSequential, movesSequential = run(list_scan([ccd], motor, positions, per_step=sequentialStep))
+    overlappedStep, finishStep = make_overlapped_readout_step(shutter, lead_detector=ccd)
+    timeOverlapped, eventsOverlapped, movesOverlapped = run(
+        overlapped_readout_wrapper(list_scan([ccd], motor, positions, per_step=overlappedStep), finishStep)
+    )
+
+    results = {
+        "time_sequential": timeSequential,
+        "time_overlapped": timeOverlapped,
+        "time_saved": timeSequential - timeOverlapped,
+        "events_in_order": eventsSequential == positions and eventsOverlapped == positions,
+        "moves_during_exposure": movesSequential + movesOverlapped,
+    }
+    print(
+        "Sequential readout: " + str(round(timeSequential, 2)) + " s, overlapped readout: " + str(round(timeOverlapped, 2))
+        + " s, saved " + str(round(results["time_saved"], 2)) + " s for " + str(number_points) + " points"
+        + ", events in order: " + str(results["events_in_order"])
+        + ", moves during exposures: " + str(results["moves_during_exposure"])
+    )
+    return results
@@ -0,0 +1,264 @@
+## Planner passes that run over a sorted acquisitions queue before it is executed.
+## Compatible consecutive acquisitions are coalesced into batches so that they share the configuration, sample, polarization, and scan overhead.
+## Each acquisition keeps its own uid_local, metadata, and status, so results and resume information are still attributed per acquisition.
+
+from .energy_grids import (
+    get_energy_points, 
+    estimate_energy_scan_duration, 
+    estimate_fly_duration, 
+    get_energy_edge,
+    overheadPerPoint_Default,
+)
+from ..devices.detector_modes import choose_detector_mode, estimate_readout_time
+
+
+## Parameters that must match for acquisitions on different samples to share one configuration load and polarization changes
+coalescingParameters_MultiLocation = [
+    "configuration_instrument",
+    "scan_type",
+    "energy_list_parameters",
+    "polarization_frame",
+    "polarizations",
+    "exposure_time",
+    "exposures_per_energy",
+    "cycles",
+    "energy_sweep_order",
+    "detector_mode",
+    "temperatures",
+]
+
+## Parameters that must match for acquisitions on the same sample to be merged into a single energy scan
+coalescingParameters_MultiSegment = [
+    "sample_id",
+    "configuration_instrument",
+    "scan_type",
+    "polarization_frame",
+    "polarizations",
+    "sample_angles",
+    "exposure_time",
+    "exposures_per_energy",
+    "group_name",
+    "detector_mode",
+    "temperatures",
+    "energy_sweep_order",
+    "exposure_memory", ## one exposure memory key is used for the merged scan, and the key is per edge
+]
+
+
+energyDecimals_MultiSegment = 4 ## energies of merged segments are rounded to 0.1 meV
+
+
+def is_coalescable(acquisition):
+    ## Partially completed acquisitions are run on their own so that they resume exactly where they stopped
+    if len(acquisition.get("steps_completed") or []) > 0: return False
+    if acquisition["configuration_instrument"] == "NoBeam": return False
+    return True
+
+
+def can_merge_multi_segment(acquisitions, acquisition):
+    ## Only step energy scans with a single ascending sweep can be concatenated into one energy list, which is measured in ascending order
+    for candidate in acquisitions + [acquisition]:
+        if candidate["scan_type"] not in ("nexafs", "rsoxs"): return False
+        if candidate["cycles"] != 0: return False
+        if candidate["energy_sweep_order"] != "ascending": return False
+    ## Segments at different edges are separate scans, e.g., carbon and nitrogen on the same sample
+    if get_energy_edge(acquisitions[0]["energy_list_parameters"]) != get_energy_edge(acquisition["energy_list_parameters"]): return False
+    return all(acquisitions[0][parameter] == acquisition[parameter] for parameter in coalescingParameters_MultiSegment)
+
+
+def can_merge_multi_location(acquisitions, acquisition):
+    if acquisition["scan_type"] == "spiral": return False
+    if acquisition["sample_id"] in [candidate["sample_id"] for candidate in acquisitions]: return False
+    return all(acquisitions[0][parameter] == acquisition[parameter] for parameter in coalescingParameters_MultiLocation)
+
+
+def coalesce_acquisitions_queue(queue):
+    """
+    Groups compatible consecutive acquisitions of a sorted queue into batches.
+
+    Acquisitions are never reordered, only merged with their neighbors, so the order set by sortAcquisitionsQueue is kept.
+
+    Parameters
+    ----------
+    queue : list of dict
+        Sanitized and sorted acquisitions
+
+    Returns
+    -------
+    list of dict
+        Each batch has a "mode" ("single", "multi_segment", or "multi_location") and the list of "acquisitions" it runs.
+        multi_segment batches are on one sample and run the combined energies of all acquisitions as one scan per angle and polarization.
+        multi_location batches are on different samples and share the configuration load and polarization changes.
+    """
+    batches = []
+    for acquisition in queue:
+        if batches and is_coalescable(acquisition):
+            batch = batches[-1]
+            acquisitionsBatch = batch["acquisitions"]
+            if all(is_coalescable(candidate) for candidate in acquisitionsBatch):
+                if batch["mode"] in ("single", "multi_segment") and can_merge_multi_segment(acquisitionsBatch, acquisition):
+                    batch["mode"] = "multi_segment"
+                    acquisitionsBatch.append(acquisition)
+                    continue
+                if batch["mode"] in ("single", "multi_location") and can_merge_multi_location(acquisitionsBatch, acquisition):
+                    batch["mode"] = "multi_location"
+                    acquisitionsBatch.append(acquisition)
+                    continue
+        batches.append({"mode": "single", "acquisitions": [acquisition]})
+    return batches
+
+
+def get_multi_segment_energies(acquisitions):
+    """
+    Combines the energies of acquisitions on the same sample into a single ascending list.
+
+    Energies shared between acquisitions are only measured once.
+
+    Returns
+    -------
+    energies : list of float
+        Combined energy list
+    attribution : list of dict
+        For each acquisition, its uid_local, sample_id, energy_list_parameters, and the energies that belong to it, to be saved in the scan metadata
+    """
+    energies = set()
+    attribution = []
+    for acquisition in acquisitions:
+        ## Rounded so that the same energy reached by different step sizes is not measured twice, e.g., 280.00000000000006 and 280.0
+        energiesAcquisition = [round(energy, energyDecimals_MultiSegment) for energy in get_energy_points(acquisition["energy_list_parameters"])]
+        energies.update(energiesAcquisition)
+        attribution.append({
+            "uid_local": str(acquisition["uid_local"]),
+            "sample_id": acquisition["sample_id"],
+            "energy_list_parameters": str(acquisition["energy_list_parameters"]),
+            "energies": energiesAcquisition,
+        })
+    return sorted(energies), attribution
+
+
+def print_coalescing_summary(batches):
+    numberAcquisitions = sum(len(batch["acquisitions"]) for batch in batches)
+    print("Coalesced " + str(numberAcquisitions) + " acquisitions into " + str(len(batches)) + " batches")
+    for batch in batches:
+        if batch["mode"] == "single": continue
+        print(batch["mode"] + ": " + ", ".join(str(acquisition["sample_id"]) for acquisition in batch["acquisitions"]))
+
+
+## Temperature scheduling
+## Acquisitions are grouped by temperature setpoint, and the groups are run in monotonic order so that the stage is not ramped up and down repeatedly.
+## The direction (ascending or descending) is picked based on which end of the setpoint range is closer to the current temperature.
+## While the stage ramps to the next setpoint, acquisitions that do not need a temperature and are on samples that never need one are run.
+
+temperatureSettleTime_Default = 120 ## s, matches the stability window (_lagtime) of Lakeshore336Picky
+
+
+def estimate_acquisition_duration(acquisition, overheadPerPoint=overheadPerPoint_Default):
+    ## Rough duration in seconds, only meant for deciding how many acquisitions fit in a temperature ramp
+    ## Scans with the WAXS CCD also pay the modeled readout time of their detector mode at every exposure
+    overheadPerPoint = overheadPerPoint + estimate_readout_time(choose_detector_mode(acquisition))
+    if acquisition["scan_type"] == "nexafs_fly":
+        ## No per-point overhead while flying
+        numberSweeps = max(1, 2 * acquisition["cycles"]) * len(acquisition["sample_angles"]) * len(acquisition["polarizations"])
+        return numberSweeps * estimate_fly_duration(acquisition["energy_list_parameters"], acquisition["exposure_time"])
+    if acquisition["scan_type"] in ("nexafs", "rsoxs"):
+        numberSweeps = max(1, 2 * acquisition["cycles"]) * len(acquisition["sample_angles"]) * len(acquisition["polarizations"])
+        return numberSweeps * estimate_energy_scan_duration(acquisition["energy_list_parameters"], acquisition["exposure_time"], acquisition["exposures_per_energy"], overheadPerPoint)
+    if acquisition["scan_type"] == "spiral":
+        stepSize, widthX, widthY = acquisition["spiral_dimensions"]
+        numberPoints = int(widthX / stepSize + 1) * int(widthY / stepSize + 1)
+    else: numberPoints = 1
+    numberPoints = numberPoints * len(acquisition["sample_angles"]) * len(acquisition["polarizations"]) * acquisition["exposures_per_energy"]
+    return numberPoints * (acquisition["exposure_time"] + overheadPerPoint)
+
+
+def predict_temperature_ramp_time(temperatureStart, temperatureEnd, ramp_rate, settle_time=temperatureSettleTime_Default):
+    ## ramp_rate is in C/min, as in the Lakeshore 336.  Returns None if the ramp time cannot be predicted.
+    if temperatureStart is None or not ramp_rate: return None
+    return abs(temperatureEnd - temperatureStart) / ramp_rate * 60 + settle_time
+
+
+def schedule_temperatures(queue, temperature_current=None, ramp_rate=None, settle_time=temperatureSettleTime_Default):
+    """
+    Orders a sorted queue into temperature groups and decides which acquisitions run while the stage ramps.
+
+    Parameters
+    ----------
+    queue : list of dict
+        Sanitized and sorted acquisitions
+    temperature_current : float, optional
+        Current stage temperature in C.  If None, the setpoints are run in ascending order.
+    ramp_rate : float, optional
+        Ramp rate in C/min.  If None, ramp times are not predicted and nothing is run during ramps.
+    settle_time : float
+        Time in s added to each ramp for the temperature to stabilize
+
+    Returns
+    -------
+    segments : list of dict
+        In run order.  Each segment has a "mode":
+        "ramp_temperature" starts ramping to "setpoint" without waiting,
+        "wait_temperature" waits until "setpoint" is reached and stable,
+        "acquisitions" runs the listed "acquisitions".
+    schedule : list of dict
+        For each setpoint, the predicted ramp time in s and the acquisitions run during and after the ramp, for reporting
+    """
+    setpoints = sorted(set(acquisition.get("temperatures") for acquisition in queue if acquisition.get("temperatures") is not None))
+    if temperature_current is not None and len(setpoints) > 1:
+        if abs(temperature_current - setpoints[-1]) < abs(temperature_current - setpoints[0]): setpoints = setpoints[::-1]
+
+    ## Acquisitions without a temperature are only run during ramps if their sample never needs a temperature, since that sample is not expected to be on the heated stage.
+    samplesTemperatureControlled = set(acquisition["sample_id"] for acquisition in queue if acquisition.get("temperatures") is not None)
+    acquisitionsUnsafe = [acquisition for acquisition in queue if acquisition.get("temperatures") is None and acquisition["sample_id"] in samplesTemperatureControlled]
+    acquisitionsOverlappable = [acquisition for acquisition in queue if acquisition.get("temperatures") is None and acquisition["sample_id"] not in samplesTemperatureControlled]
+
+    segments = []
+    schedule = []
+    if len(acquisitionsUnsafe) > 0: segments.append({"mode": "acquisitions", "acquisitions": acquisitionsUnsafe})
+    
+    temperaturePrevious = temperature_current
+    for setpoint in setpoints:
+        timeRamp = predict_temperature_ramp_time(temperaturePrevious, setpoint, ramp_rate, settle_time)
+        segments.append({"mode": "ramp_temperature", "setpoint": setpoint})
+        
+        acquisitionsDuringRamp = []
+        timeFilled = 0
+        while timeRamp is not None and len(acquisitionsOverlappable) > 0 and timeFilled < timeRamp:
+            acquisition = acquisitionsOverlappable.pop(0)
+            acquisitionsDuringRamp.append(acquisition)
+            timeFilled += estimate_acquisition_duration(acquisition)
+        if len(acquisitionsDuringRamp) > 0: segments.append({"mode": "acquisitions", "acquisitions": acquisitionsDuringRamp})
+        
+        segments.append({"mode": "wait_temperature", "setpoint": setpoint})
+        acquisitionsAtSetpoint = [acquisition for acquisition in queue if acquisition.get("temperatures") == setpoint]
+        segments.append({"mode": "acquisitions", "acquisitions": acquisitionsAtSetpoint})
+
+        schedule.append({
+            "setpoint": setpoint,
+            "time_ramp": timeRamp,
+            "time_overlapped": timeFilled,
+            "number_acquisitions_during_ramp": len(acquisitionsDuringRamp),
+            "number_acquisitions_at_setpoint": len(acquisitionsAtSetpoint),
+        })
+        temperaturePrevious = setpoint
+
+    if len(acquisitionsOverlappable) > 0: segments.append({"mode": "acquisitions", "acquisitions": acquisitionsOverlappable})
+
+    return segments, schedule
+
+
+def print_temperature_schedule(schedule, temperature_current=None, ramp_rate=None):
+    print("Temperature schedule starting from " + str(temperature_current) + " C at " + str(ramp_rate) + " C/min:")
+    timeRampTotal = 0
+    timeOverlappedTotal = 0
+    for entry in schedule:
+        if entry["time_ramp"] is None: timeRamp = "unknown"
+        else:
+            timeRamp = str(round(entry["time_ramp"] / 60, 1)) + " min"
+            timeRampTotal += entry["time_ramp"]
+            timeOverlappedTotal += min(entry["time_overlapped"], entry["time_ramp"])
+        print(
+            "  " + str(entry["setpoint"]) + " C: predicted ramp and settle " + timeRamp
+            + ", " + str(entry["number_acquisitions_during_ramp"]) + " acquisitions during ramp"
+            + ", " + str(entry["number_acquisitions_at_setpoint"]) + " acquisitions at setpoint"
+        )
+    print("Predicted total ramp and settle time: " + str(round(timeRampTotal / 60, 1)) + " min, of which about " + str(round(timeOverlappedTotal / 60, 1)) + " min overlaps with measurements")
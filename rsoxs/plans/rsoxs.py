@@ -3,6 +3,7 @@
 import bluesky.plan_stubs as bps
 from bluesky.preprocessors import finalize_wrapper
 from functools import partial
+import warnings
 
 from nbs_bl.beamline import GLOBAL_BEAMLINE as bl
 from nbs_bl.hw import (
@@ -30,6 +31,7 @@ from nbs_bl.help import (
 from nbs_bl.plans.scans import nbs_energy_scan
 
 from .per_steps import take_exposure_corrected_reading, one_nd_sticky_exp_step
+from .energy_grids import validate_energy_grid
 
 try:
     import tomllib
@@ -192,6 +194,12 @@ def load_rsoxs(filename):
                 key = _key
             name = value.get("name", key)
             region = value.get("region")
+            ## One bad region is skipped so that the rest of the file still loads
+            try:
+                validate_energy_grid(region, strict=False)
+            except (ValueError, TypeError) as error:
+                warnings.warn("Skipping " + str(key) + " in " + str(filename) + ": region " + str(region) + " is not valid.  " + str(error), stacklevel=2)
+                continue
             element = value.get("element", "")
             edge = value.get("edge", "")
             rsoxs_func = _rsoxs_factory(region, element, edge, key)
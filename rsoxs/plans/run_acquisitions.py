@@ -1,9 +1,9 @@
 ##
-import numpy as np
 import copy
 import datetime
 
-from rsoxs.configuration_setup.configurations_instrument import load_configuration
+from rsoxs.configuration_setup.configurations_instrument import load_configuration, load_detector_mode, GLOBAL_CONFIGURATION_DICT
+from ..devices.detector_modes import choose_detector_mode
 from rsoxs.Functions.alignment import (
     #load_configuration, 
     load_samp, 
@@ -14,7 +14,23 @@ from nbs_bl.plans.scans import nbs_count, nbs_list_scan, nbs_energy_scan
 from ..Functions.energyscancore import cdsaxs_scan
 from ..Functions.rsoxs_plans import do_rsoxs
 from rsoxs.plans.rsoxs import spiral_scan
-from .default_energy_parameters import energy_list_parameters
+from .acquisition_steps import expand_acquisition_steps, get_remaining_steps, make_step_id, get_approach_position
+from .energy_grids import get_energy_grid
+from .queue_planning import (
+    coalesce_acquisitions_queue, 
+    get_multi_segment_energies, 
+    print_coalescing_summary,
+    schedule_temperatures,
+    print_temperature_schedule,
+)
+from .nexafs_fly import nexafs_fly_scan
+from .lookahead import get_configuration_premoves, start_premoves, wait_premoves, configuration_moves_epu, lookaheadGroup_Polarization
+from .exposure_memory import (
+    make_exposure_memory_key, 
+    get_exposure_memory, 
+    reset_exposure_memory_metrics, 
+    print_exposure_memory_metrics,
+)
 from rsoxs.HW.detectors import snapshot
 from ..startup import rsoxs_config
 from nbs_bl.beamline import GLOBAL_BEAMLINE as bl
@@ -32,6 +48,7 @@ from nbs_bl.hw import (
     slits3,
     manipulator,
     sam_Th,
+    tem_tempstage,
     #waxs_det,
     #Det_W,
 )
@@ -40,6 +57,7 @@ from ..configuration_setup.configuration_load_save_sanitize import (
     sanitizeAcquisition, 
     sortAcquisitionsQueue,
     updateConfigurationWithAcquisition,
+    getAcquisitionEdge,
 )
 from ..configuration_setup.configuration_load_save import sync_rsoxs_config_to_nbs_manipulator
 
@@ -52,26 +70,64 @@ from nbs_bl.samples import add_current_position_as_sample
 def run_acquisitions_queue(
         configuration = copy.deepcopy(rsoxs_config["bar"]),
         dryrun = True,
-        sort_by = ["priority"], ## TODO: Not sure yet how to give it a list of groups in a particular order.  Maybe a list within a list.
+        sort_by = ["priority"], ## e.g., ["group by configuration", "group by edge", "priority"], most important criterion first
+        coalesce = False, ## If True, compatible consecutive acquisitions are merged so that they share configuration, sample, polarization, and scan overhead
+        schedule_temperature = False, ## If True, acquisitions are grouped by temperature setpoint in monotonic order, and acquisitions that do not need the temperature stage run while it ramps
         ):
     ## Run a series of single acquisitions
 
     ## For some reason, the configuration variable has to be set here.  If it is set in the input, it shows prior configuration, not the current one.
-    ## TODO: Understand why 
+    ## TODO: Understand why
     configuration = copy.deepcopy(rsoxs_config["bar"])
 
     acquisitions = gatherAcquisitionsFromConfiguration(configuration)
-    ## TODO: Can only sort by "priority" at the moment, not by anything else
-    queue = sortAcquisitionsQueue(acquisitions, sortBy=sort_by) 
+    queue = sortAcquisitionsQueue(acquisitions, sortBy=sort_by, configuration=configuration)
+    
+    if schedule_temperature:
+        temperature_current = tem_tempstage.readback.get()
+        ramp_rate = tem_tempstage.ramp_rate.get()
+        segments, schedule = schedule_temperatures(queue, temperature_current=temperature_current, ramp_rate=ramp_rate)
+        print_temperature_schedule(schedule, temperature_current=temperature_current, ramp_rate=ramp_rate)
+    else: segments = [{"mode": "acquisitions", "acquisitions": queue}]
+
+    batches = []
+    for segment in segments:
+        if segment["mode"] != "acquisitions": batches.append(segment)
+        elif coalesce: batches.extend(coalesce_acquisitions_queue(segment["acquisitions"]))
+        else: batches.extend([{"mode": "single", "acquisitions": [acquisition]} for acquisition in segment["acquisitions"]])
+    if coalesce: print_coalescing_summary([batch for batch in batches if "acquisitions" in batch])
+    
+    print_exposure_memory_summary(queue)
+    reset_exposure_memory_metrics()
     
     print("Starting queue")
 
-    for indexAcquisition, acquisition in enumerate(queue):
+    for indexBatch, batch in enumerate(batches):
         print("\n\n")
-        yield from run_acquisitions_single(acquisition=acquisition, dryrun=dryrun)
+        ## The next acquisition is used to pre-position axes while the current one finishes
+        acquisition_next = None
+        if indexBatch + 1 < len(batches) and "acquisitions" in batches[indexBatch + 1]: acquisition_next = batches[indexBatch + 1]["acquisitions"][0]
+        if batch["mode"] == "ramp_temperature":
+            ## The controller ramps at its ramp rate while the next batches run
+            print("Starting temperature ramp to " + str(batch["setpoint"]) + " C")
+            if dryrun == False: yield from bps.mv(tem_tempstage.setpoint, batch["setpoint"])
+        elif batch["mode"] == "wait_temperature":
+            ## The setpoint was written when the ramp started, so only the readback is waited for
+            print("Waiting for temperature to reach " + str(batch["setpoint"]) + " C")
+            if dryrun == False: yield from tem_tempstage.wait_for_setpoint(batch["setpoint"])
+        elif batch["mode"] == "multi_segment":
+            yield from run_acquisitions_multi_segment(acquisitions=batch["acquisitions"], dryrun=dryrun)
+        elif batch["mode"] == "multi_location":
+            yield from run_acquisitions_multi_location(acquisitions=batch["acquisitions"], dryrun=dryrun)
+        else: yield from run_acquisitions_single(acquisition=batch["acquisitions"][0], dryrun=dryrun, acquisition_next=acquisition_next)
+    
+    if dryrun == False:
+        yield from wait_premoves()
+        yield from wait_premoves(group=lookaheadGroup_Polarization)
 
 
     print("\n\nFinished queue")
+    if dryrun == False: print_exposure_memory_metrics()
 
     ## TODO: get time estimates for individual acquisitions and the full queue.  Import datetime and can print timestamps for when things actually completed.
 
@@ -79,30 +135,83 @@ def run_acquisitions_queue(
 
 
 
-## TODO: This function can benefit from refactoring.
-## As is, a single iteration of this function does not necessarily correspond to a single scan.  It may run multiple scans with multiple corresponding scan IDs if, e.g., multiple angles and polarizations are given.
-## As a result, the local uid and scan status are a bit misleading, as there might be multiple scans per spreadsheet line.
-## One idea is to change the spreadsheet workflow so that multiple samples, energy lists, etc. can be entered onto a single spreadsheet line to avoid writing out every acquisition one-by-one.  And then a separate function can be used to generate a queue with with a single line corresponding to one acquisition.
-## Separately, it would also be good to break this function into smaller sub-functions for better readability.
+## Each acquisition (spreadsheet line) is expanded into atomic steps, one scan per step, e.g., one sweep at one sample angle and polarization.
+## Completed step ids are saved to the acquisition in rsoxs_config, so if the queue is aborted or a scan fails, rerunning the acquisition or the queue resumes from the first unfinished step.
+## TODO: One idea is to change the spreadsheet workflow so that multiple samples, energy lists, etc. can be entered onto a single spreadsheet line to avoid writing out every acquisition one-by-one.
+
+updateAcquireStatusDuringDryRun = False ## Hardcoded variable for troubleshooting.  False during normal operation, but True during troubleshooting.
+
+
+def print_exposure_memory_summary(queue):
+    ## How many RSoXS scans in the queue that use exposure memory will start from stored exposure corrections
+    keys = []
+    for acquisition in queue:
+        if acquisition["scan_type"] != "rsoxs" or not acquisition.get("exposure_memory"): continue
+        for polarization in acquisition["polarizations"]:
+            keys.append(make_exposure_memory_key(acquisition["sample_id"], getAcquisitionEdge(acquisition), polarization))
+    if len(keys) == 0: return
+    numberStored = sum(get_exposure_memory(key, count=False) is not None for key in set(keys))
+    print("Exposure memory: " + str(numberStored) + " of " + str(len(set(keys))) + " sample, edge, and polarization combinations in the queue have stored exposure corrections")
+
+
+def update_acquisition_status(acquisition, status, dryrun=True):
+    ## Sets acquire_status with a timestamp and stores the acquisition back into rsoxs_config
+    if dryrun == False or updateAcquireStatusDuringDryRun == True:
+        timeStamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        acquisition["acquire_status"] = str(status) + " " + str(timeStamp)
+        rsoxs_config["bar"] = updateConfigurationWithAcquisition(rsoxs_config["bar"], acquisition)
+
+
+def mark_step_completed(acquisition, step_id, dryrun=True):
+    ## Persist completion of this step so that an interruption after this point resumes from the next step
+    if dryrun == False or updateAcquireStatusDuringDryRun == True:
+        acquisition["steps_completed"].append(step_id)
+        if len(get_remaining_steps(expand_acquisition_steps(acquisition), acquisition["steps_completed"])) == 0:
+            update_acquisition_status(acquisition, "Finished", dryrun=dryrun)
+        else: rsoxs_config["bar"] = updateConfigurationWithAcquisition(rsoxs_config["bar"], acquisition)
+
+
+def set_acquisition_temperature(acquisition, dryrun=True):
+    ## Writes the temperature setpoint of the acquisition and waits until the readback has settled there.
+    ## If the queue was scheduled by temperature, the stage already settled at this setpoint and this returns right away.
+    if acquisition.get("temperatures") is None: return
+    print("Setting temperature: " + str(acquisition["temperatures"]) + " C")
+    if dryrun == False: yield from tem_tempstage.set_and_wait_plan(acquisition["temperatures"])
+
 
 def run_acquisitions_single(
         acquisition,
-        dryrun = True
+        dryrun = True,
+        acquisition_next = None, ## If provided, axes that it needs are pre-positioned during the last step when they cannot affect the measurement
 ):
     
-    updateAcquireStatusDuringDryRun = False ## Hardcoded variable for troubleshooting.  False during normal operation, but True during troubleshooting.
-    
     ## The acquisition is sanitized again in case it were not run from a spreadsheet
     ## But for now, still requires that a full configuration be set up for the sample
     acquisition = sanitizeAcquisition(acquisition) ## This would be run before if a spreadsheet were loaded, but now it will ensure the acquisition is sanitized in case the acquisition is run in the terminal
     
+    steps = expand_acquisition_steps(acquisition)
+    steps_remaining = get_remaining_steps(steps, acquisition["steps_completed"])
+    if len(steps_remaining) == 0:
+        print("All " + str(len(steps)) + " steps of this acquisition were already completed.  Nothing to run.  To run it again, reset it with resetAcquisitionSteps.")
+        return
+    if len(steps_remaining) < len(steps):
+        print("Resuming acquisition from step " + str(steps_remaining[0]["step_id"]) + ", " + str(len(steps) - len(steps_remaining)) + " of " + str(len(steps)) + " steps already completed.")
+
+    ## Pre-positioning started during the previous acquisition has to finish before anything else moves.
+    ## The EPU pre-positioned after it keeps moving while the configuration, sample, and temperature load.
+    if dryrun == False: yield from wait_premoves()
+
     parameter = "configuration_instrument"
     if acquisition[parameter] is not None:
+        yield from wait_lookahead_polarization(acquisition[parameter], dryrun=dryrun)
         yield from load_configuration(
             configuration_name = acquisition[parameter],
             dryrun = dryrun,
             )  
 
+    ## Binning and readout region for what this scan needs from the WAXS CCD
+    yield from load_detector_mode(choose_detector_mode(acquisition), dryrun=dryrun)
+
     ## TODO: set up diodes to high or low gain
     ## But there are issues at the moment with setup_diode_i400() and most people don't use this, so leave it for now
 
@@ -114,107 +223,263 @@ def run_acquisitions_single(
             ) ## TODO: what is the difference between load_sample (loads from dict) and load_samp(loads from id or number)?  Can they be consolidated?
         
 
-    ## TODO: set temperature if needed, but this is lowest priority
+    yield from set_acquisition_temperature(acquisition, dryrun=dryrun)
+    yield from wait_lookahead_polarization(dryrun=dryrun)
 
-    for indexAngle, sampleAngle in enumerate(acquisition["sample_angles"]):
+    ## Angle and polarization are only moved when they change between steps
+    sampleAngle_Current = None
+    polarization_Current = None
+    for step in steps_remaining:
         
-        ## TODO: come up with better way to handle.
-        ## This is mainly for cases where bar image and fiducials are not run.
-        ## Rotation is either not needed or handled differently.
-        if sampleAngle != "Do not rotate":
-            ## TODO: Requires spots to be picked from image, so I have to comment when I don't have beam
-            yield from rotate_now(
-                theta = sampleAngle,
-                dryrun = dryrun,
-                ) ## TODO: What is the difference between rotate_sample and rotate_now?
+        sampleAngle = step["sample_angle"]
+        if sampleAngle != sampleAngle_Current:
+            ## TODO: come up with better way to handle.
+            ## This is mainly for cases where bar image and fiducials are not run.
+            ## Rotation is either not needed or handled differently.
+            if sampleAngle != "Do not rotate":
+                ## TODO: Requires spots to be picked from image, so I have to comment when I don't have beam
+                yield from rotate_now(
+                    theta = sampleAngle,
+                    dryrun = dryrun,
+                    ) ## TODO: What is the difference between rotate_sample and rotate_now?
+            sampleAngle_Current = sampleAngle
         
-        for indexPolarization, polarization in enumerate(acquisition["polarizations"]):
+        polarization = step["polarization"]
+        if polarization != polarization_Current:
             print("Setting polarization: " + str(polarization))
             if dryrun == False: 
                 ## If a timeScan or spiral is being run when I don't have beam (during shutdown or when another station is using beam), I don't want to make any changes to the energy or polarization.
                 ## TODO: Actually, make this even smarter.  If RSoXS station does not have control or if cannot write EPU Epics PV, then do this
                 if acquisition["configuration_instrument"] == "NoBeam": print("Not moving motors.")
                 else: yield from set_polarization(polarization)
+            polarization_Current = polarization
+        
+        print("Running scan: " + str(acquisition["scan_type"]) + ", step " + str(step["step_id"]))
+        update_acquisition_status(acquisition, "Started", dryrun=dryrun)
+        if step is steps_remaining[-1] and acquisition_next is not None:
+            yield from start_lookahead_during_scan(acquisition=acquisition, acquisition_next=acquisition_next, dryrun=dryrun)
+        if dryrun == False:
+            yield from run_acquisition_step(acquisition=acquisition, step=step)
+        mark_step_completed(acquisition, step["step_id"], dryrun=dryrun)
+    
+    if acquisition_next is not None:
+        yield from start_lookahead_after_scan(acquisition=acquisition, acquisition_next=acquisition_next, polarization_current=polarization_Current, dryrun=dryrun)
+
+    sync_rsoxs_config_to_nbs_manipulator()
+
+
+def start_lookahead_during_scan(acquisition, acquisition_next, dryrun=True):
+    ## Starts moves of the next configuration that do not affect the scan about to run, e.g., the WAXS detector during NEXAFS
+    configuration_next = sanitizeAcquisition(acquisition_next)["configuration_instrument"]
+    if configuration_next in (None, acquisition["configuration_instrument"], "NoBeam"): return
+    if configuration_next not in GLOBAL_CONFIGURATION_DICT: return
+    premoves = get_configuration_premoves(GLOBAL_CONFIGURATION_DICT[configuration_next], acquisition["scan_type"])
+    if len(premoves) == 0: return
+    if dryrun == False: yield from start_premoves(*premoves)
+    else: print("Would pre-position " + str(len(premoves) // 2) + " axes for configuration " + str(configuration_next))
+
+
+def start_lookahead_after_scan(acquisition, acquisition_next, polarization_current, dryrun=True):
+    ## The shutter is closed after the last scan, so the EPU can start moving to the next polarization while the next configuration and sample load.
+    ## The next acquisition waits for it with wait_lookahead_polarization.
+    acquisition_next = sanitizeAcquisition(acquisition_next)
+    steps_next = get_remaining_steps(expand_acquisition_steps(acquisition_next), acquisition_next["steps_completed"])
+    if len(steps_next) == 0: return
+    polarization_next = steps_next[0]["polarization"]
+    if polarization_next == polarization_current: return
+    if "NoBeam" in (acquisition["configuration_instrument"], acquisition_next["configuration_instrument"]): return
+    ## Only linear polarizations in the lab frame map directly onto en.polarization.  Anything else is left to set_polarization.
+    if acquisition_next["polarization_frame"] != "lab" or not (0 <= polarization_next <= 180): return
+    if dryrun == False: yield from start_premoves(en.polarization, polarization_next, group=lookaheadGroup_Polarization)
+    else: print("Would pre-position polarization to " + str(polarization_next))
+
+
+def wait_lookahead_polarization(configuration_name=None, dryrun=True):
+    ## Waits for the EPU pre-positioned by start_lookahead_after_scan.
+    ## Before loading configuration_name, only waits if the configuration moves the EPU as well (e.g., sets the energy).
+    if dryrun == True: return
+    if configuration_name in GLOBAL_CONFIGURATION_DICT and not configuration_moves_epu(GLOBAL_CONFIGURATION_DICT[configuration_name]): return
+    yield from wait_premoves(group=lookaheadGroup_Polarization)
+
+
+def run_acquisitions_multi_segment(
+        acquisitions,
+        dryrun = True
+):
+    ## Runs acquisitions on the same sample that differ only in energies as one energy scan per sample angle and polarization.
+    ## The combined energy list is measured in ascending order, and shared energies are only measured once.
+    ## Which energies belong to which acquisition is saved in the scan metadata under coalesced_acquisitions.
+    acquisitions = [sanitizeAcquisition(acquisition) for acquisition in acquisitions]
+    acquisitionFirst = acquisitions[0]
+    energies, attribution = get_multi_segment_energies(acquisitions)
+    print("Running " + str(len(acquisitions)) + " acquisitions on sample " + str(acquisitionFirst["sample_id"]) + " as one scan with " + str(len(energies)) + " energies")
+
+    if dryrun == False: yield from wait_premoves()
+    yield from wait_lookahead_polarization(acquisitionFirst["configuration_instrument"], dryrun=dryrun)
+    yield from load_configuration(
+        configuration_name = acquisitionFirst["configuration_instrument"],
+        dryrun = dryrun,
+        )
+    yield from load_detector_mode(choose_detector_mode(acquisitionFirst), dryrun=dryrun)
+    yield from load_samp(
+        sample_id_or_index = acquisitionFirst["sample_id"], 
+        dryrun = dryrun,
+        )
+    ## temperatures is one of the coalescing parameters, so all acquisitions share it
+    yield from set_acquisition_temperature(acquisitionFirst, dryrun=dryrun)
+    yield from wait_lookahead_polarization(dryrun=dryrun)
+    
+    if acquisitionFirst["scan_type"]=="nexafs": use_2D_detector = False
+    if acquisitionFirst["scan_type"]=="rsoxs": use_2D_detector = True
+    for indexAngle, sampleAngle in enumerate(acquisitionFirst["sample_angles"]):
+        if sampleAngle != "Do not rotate":
+            yield from rotate_now(
+                theta = sampleAngle,
+                dryrun = dryrun,
+                )
+        for indexPolarization, polarization in enumerate(acquisitionFirst["polarizations"]):
+            print("Setting polarization: " + str(polarization))
+            if dryrun == False: yield from set_polarization(polarization)
             
-            print("Running scan: " + str(acquisition["scan_type"]))
-            if dryrun == False or updateAcquireStatusDuringDryRun == True:
-                timeStamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-                acquisition["acquire_status"] = "Started " + str(timeStamp)
-                rsoxs_config["bar"] = updateConfigurationWithAcquisition(rsoxs_config["bar"], acquisition)
+            stepID = make_step_id(indexAngle, sampleAngle, indexPolarization, polarization, 0)
+            print("Running scan: " + str(acquisitionFirst["scan_type"]) + ", step " + str(stepID))
+            for acquisition in acquisitions: update_acquisition_status(acquisition, "Started", dryrun=dryrun)
             if dryrun == False:
-                if "time" in acquisition["scan_type"]:
-                    if acquisition["scan_type"]=="time": use_2D_detector = False
-                    if acquisition["scan_type"]=="time2D": use_2D_detector = True
-                    energy = acquisition["energy_list_parameters"]
-                    print("Setting energy: " + str(energy))
-                    if dryrun == False: 
-                        if acquisition["configuration_instrument"] == "NoBeam": print("Not moving motors.")
-                        else: yield from bps.mv(en, energy)
-                    yield from nbs_count(num=acquisition["exposures_per_energy"], 
-                                         use_2d_detector=use_2D_detector, 
-                                         dwell=acquisition["exposure_time"],
-                                         )
-                
-                if acquisition["scan_type"] == "spiral":
-                    energy = acquisition["energy_list_parameters"]
-                    print("Setting energy: " + str(energy))
-                    if dryrun == False: 
-                        if acquisition["configuration_instrument"] == "NoBeam": print("Not moving motors.")
-                        else: yield from bps.mv(en, energy)
-                    ## TODO: could I just run waxs_spiral_mode() over here and then after spiral_scan finishes, run waxs_normal_mode()?  Eliot may have mentioned something about not being able to do this inside the Run Engine or within spreadsheet, but maybe get this clarified during data security?
-                    yield from spiral_scan(
-                        stepsize=acquisition["spiral_dimensions"][0], 
-                        widthX=acquisition["spiral_dimensions"][1], 
-                        widthY=acquisition["spiral_dimensions"][2],
-                        n_exposures=acquisition["exposures_per_energy"], 
-                        dwell=acquisition["exposure_time"],
-                        )
-
-                if acquisition["scan_type"] in ("nexafs", "rsoxs"):
-                    print("Energy parameters: " + str(acquisition["energy_list_parameters"]))
-                    if acquisition["scan_type"]=="nexafs": use_2D_detector = False
-                    if acquisition["scan_type"]=="rsoxs": use_2D_detector = True
-                    energy_parameters = acquisition["energy_list_parameters"]
-                    if isinstance(energy_parameters, str): energy_parameters = energy_list_parameters[energy_parameters]
-                    
-                    ## If cycles = 0, then just run one sweep in ascending energy
-                    if acquisition["cycles"] == 0: 
-                        yield from nbs_energy_scan(
-                                *energy_parameters,
-                                use_2d_detector=use_2D_detector, 
-                                dwell=acquisition["exposure_time"],
-                                n_exposures=acquisition["exposures_per_energy"], 
-                                group_name=acquisition["group_name"],
-                                )
-                    
-                    ## If cycles is an integer > 0, then run pairs of sweeps going in ascending then descending order of energy
-                    else: 
-                        for cycle in np.arange(0, acquisition["cycles"], 1):
-                            yield from nbs_energy_scan(
-                                *energy_parameters,
-                                use_2d_detector=use_2D_detector, 
-                                dwell=acquisition["exposure_time"],
-                                n_exposures=acquisition["exposures_per_energy"], 
-                                group_name=acquisition["group_name"],
-                                )
-                            yield from nbs_energy_scan(
-                                *energy_parameters[::-1], ## Reverse the energy list parameters to produce reversed energy list
-                                use_2d_detector=use_2D_detector, 
-                                dwell=acquisition["exposure_time"],
-                                n_exposures=acquisition["exposures_per_energy"], 
-                                group_name=acquisition["group_name"],
-                                )
-                    
-                    ## TODO: maybe default to cycles = 1?  It would be good practice to have forward and reverse scan to assess reproducibility
+                yield from nbs_list_scan(
+                    en.energy,
+                    energies,
+                    use_2d_detector=use_2D_detector, 
+                    dwell=acquisitionFirst["exposure_time"],
+                    n_exposures=acquisitionFirst["exposures_per_energy"], 
+                    group_name=acquisitionFirst["group_name"],
+                    md={"coalesced_acquisitions": attribution},
+                    exposure_memory_key=make_exposure_memory_key(acquisitionFirst["sample_id"], getAcquisitionEdge(acquisitionFirst), polarization) if use_2D_detector and acquisitionFirst["exposure_memory"] else None,
+                    )
+            for acquisition in acquisitions: mark_step_completed(acquisition, stepID, dryrun=dryrun)
+
+    sync_rsoxs_config_to_nbs_manipulator()
+
+
+def run_acquisitions_multi_location(
+        acquisitions,
+        dryrun = True
+):
+    ## Runs acquisitions on different samples that share the same configuration, scan, and polarizations.
+    ## The configuration is loaded once, and the polarization loop is outside of the sample loop so that each polarization is only set once.
+    ## Changing polarization moves the EPU and takes longer than moving between samples on the bar.
+    acquisitions = [sanitizeAcquisition(acquisition) for acquisition in acquisitions]
+    acquisitionFirst = acquisitions[0]
+    print("Running " + str(len(acquisitions)) + " acquisitions on samples " + ", ".join(str(acquisition["sample_id"]) for acquisition in acquisitions) + " with shared configuration and polarizations")
+
+    if dryrun == False: yield from wait_premoves()
+    yield from wait_lookahead_polarization(acquisitionFirst["configuration_instrument"], dryrun=dryrun)
+    yield from load_configuration(
+        configuration_name = acquisitionFirst["configuration_instrument"],
+        dryrun = dryrun,
+        )
+    yield from load_detector_mode(choose_detector_mode(acquisitionFirst), dryrun=dryrun)
+    ## temperatures is one of the coalescing parameters, so all samples are measured at the same setpoint
+    yield from set_acquisition_temperature(acquisitionFirst, dryrun=dryrun)
+    yield from wait_lookahead_polarization(dryrun=dryrun)
+    
+    for polarization in acquisitionFirst["polarizations"]:
+        print("Setting polarization: " + str(polarization))
+        if dryrun == False: yield from set_polarization(polarization)
+
+        for acquisition in acquisitions:
+            steps = [step for step in expand_acquisition_steps(acquisition) if step["polarization"] == polarization]
+            steps_remaining = get_remaining_steps(steps, acquisition["steps_completed"])
+            if len(steps_remaining) == 0: continue
             
-            if dryrun == False or updateAcquireStatusDuringDryRun == True:
-                timeStamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-                acquisition["acquire_status"] = "Finished " + str(timeStamp) ## TODO: Add timestamp
-                rsoxs_config["bar"] = updateConfigurationWithAcquisition(rsoxs_config["bar"], acquisition)
+            yield from load_samp(
+                sample_id_or_index = acquisition["sample_id"], 
+                dryrun = dryrun,
+                )
+            sampleAngle_Current = None
+            for step in steps_remaining:
+                sampleAngle = step["sample_angle"]
+                if sampleAngle != sampleAngle_Current:
+                    if sampleAngle != "Do not rotate":
+                        yield from rotate_now(
+                            theta = sampleAngle,
+                            dryrun = dryrun,
+                            )
+                    sampleAngle_Current = sampleAngle
+                
+                print("Running scan: " + str(acquisition["scan_type"]) + " on sample " + str(acquisition["sample_id"]) + ", step " + str(step["step_id"]))
+                update_acquisition_status(acquisition, "Started", dryrun=dryrun)
+                if dryrun == False:
+                    yield from run_acquisition_step(acquisition=acquisition, step=step)
+                mark_step_completed(acquisition, step["step_id"], dryrun=dryrun)
 
     sync_rsoxs_config_to_nbs_manipulator()
 
 
+def run_acquisition_step(acquisition, step):
+    ## Runs the single scan described by one step of an acquisition.  Sample, angle, and polarization are already set.
+
+    if "time" in acquisition["scan_type"]:
+        if acquisition["scan_type"]=="time": use_2D_detector = False
+        if acquisition["scan_type"]=="time2D": use_2D_detector = True
+        energy = step["energy_parameters"]
+        print("Setting energy: " + str(energy))
+        if acquisition["configuration_instrument"] == "NoBeam": print("Not moving motors.")
+        else: yield from bps.mv(en, energy)
+        yield from nbs_count(num=acquisition["exposures_per_energy"], 
+                             use_2d_detector=use_2D_detector, 
+                             dwell=acquisition["exposure_time"],
+                             )
+    
+    if acquisition["scan_type"] == "spiral":
+        energy = step["energy_parameters"]
+        print("Setting energy: " + str(energy))
+        if acquisition["configuration_instrument"] == "NoBeam": print("Not moving motors.")
+        else: yield from bps.mv(en, energy)
+        ## TODO: could I just run waxs_spiral_mode() over here and then after spiral_scan finishes, run waxs_normal_mode()?  Eliot may have mentioned something about not being able to do this inside the Run Engine or within spreadsheet, but maybe get this clarified during data security?
+        yield from spiral_scan(
+            stepsize=acquisition["spiral_dimensions"][0], 
+            widthX=acquisition["spiral_dimensions"][1], 
+            widthY=acquisition["spiral_dimensions"][2],
+            n_exposures=acquisition["exposures_per_energy"], 
+            dwell=acquisition["exposure_time"],
+            )
+
+    if step.get("approach", False) and step.get("direction", 0) != 0:
+        ## In snake order, sweeps go both ways, so the first energy is approached in the sweep direction to keep backlash consistent
+        energyFirst = get_energy_grid(step["energy_parameters"])[0]
+        energyApproach = get_approach_position("energy", energyFirst, step["direction"])
+        print("Approaching " + str(energyFirst) + " eV from " + str(energyApproach) + " eV")
+        if acquisition["configuration_instrument"] != "NoBeam": yield from bps.mv(en, energyApproach)
+
+    if acquisition["scan_type"] == "nexafs_fly":
+        ## Continuous energy scan.  exposure_time is the time between readings, and each region is flown at its step size per exposure_time.
+        print("Energy parameters: " + str(step["energy_parameters"]))
+        yield from nexafs_fly_scan(
+                step["energy_parameters"],
+                exposure_time=acquisition["exposure_time"],
+                group_name=acquisition["group_name"],
+                )
+
+    if acquisition["scan_type"] in ("nexafs", "rsoxs"):
+        ## Sweeps are expanded ahead of time.  If cycles = 0, there is one sweep in ascending energy.  If cycles is an integer > 0, there are pairs of sweeps going in ascending then descending order of energy.
+        ## TODO: maybe default to cycles = 1?  It would be good practice to have forward and reverse scan to assess reproducibility
+        print("Energy parameters: " + str(step["energy_parameters"]))
+        if acquisition["scan_type"]=="nexafs": use_2D_detector = False
+        if acquisition["scan_type"]=="rsoxs": use_2D_detector = True
+        ## With exposure_memory, exposures are checked, corrections learned on this sample, edge, and polarization in earlier scans seed this one, and this scan's corrections are saved for the next.
+        ## Otherwise exposures are not checked, as in scans run outside of the queue.
+        exposure_memory_key = None
+        if use_2D_detector and acquisition["exposure_memory"]: exposure_memory_key = make_exposure_memory_key(acquisition["sample_id"], getAcquisitionEdge(acquisition), step["polarization"])
+        yield from nbs_energy_scan(
+                *step["energy_parameters"],
+                use_2d_detector=use_2D_detector, 
+                dwell=acquisition["exposure_time"],
+                n_exposures=acquisition["exposures_per_energy"], 
+                group_name=acquisition["group_name"],
+                exposure_memory_key=exposure_memory_key,
+                )
+
+
 
 
 
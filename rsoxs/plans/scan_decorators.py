@@ -3,11 +3,12 @@ from nbs_bl.utils import merge_func
 import bluesky.plan_stubs as bps
 from functools import partial
 from nbs_bl.beamline import GLOBAL_BEAMLINE as bl
-from nbs_bl.hw import shutter_control, shutter_open_time, shutter_y, en#, waxs_det
+from nbs_bl.hw import shutter_control, shutter_open_time, shutter_y, en, izero_mesh#, waxs_det
 from bluesky.preprocessors import finalize_wrapper
 
 #from nbs_bl.beamline import GLOBAL_BEAMLINE
-from .per_steps import take_exposure_corrected_reading, one_nd_sticky_exp_step, trigger_and_read_with_shutter
+from .per_steps import take_exposure_corrected_reading, one_nd_sticky_exp_step, trigger_and_read_with_shutter, predictive_exposure_step, reset_exposure_metrics, print_exposure_metrics, make_overlapped_readout_step, overlapped_readout_wrapper
+from .exposure_memory import get_exposure_memory, save_exposure_memory
 from rsoxs.configuration_setup.configurations_instrument import load_configuration
 
 
@@ -56,7 +57,7 @@ def rsoxs_waxs_decorator(func):
 
     @rsoxs_configuration_decorator
     @merge_func(func)
-    def _inner(*args, use_2d_detector=False, extra_dets=[], dwell=1, n_exposures=1, open_shutter=True, **kwargs):
+    def _inner(*args, use_2d_detector=False, extra_dets=[], dwell=1, n_exposures=1, open_shutter=True, predict_exposure=False, exposure_memory_key=None, overlap_readout=False, accumulate_exposures=False, **kwargs):
         """
         Parameters
         ----------
@@ -68,6 +69,18 @@ def rsoxs_waxs_decorator(func):
             which have their own shutter control.
         n_exposures : int, optional
             Number of exposures for the Greateyes detector to take per step
+        predict_exposure : bool, optional
+            For step scans with the Greateyes detector, set the exposure time of each step from the counts and izero of the previous steps,
+            with retakes only as a fallback.  dwell is used for the first step.
+        exposure_memory_key : str, optional
+            For step scans with the Greateyes detector, key from make_exposure_memory_key.  Exposure times stored under it seed this scan,
+            and the exposure times used in this scan are saved under it.  Giving a key turns on exposure checking and retakes, which are off otherwise.
+        overlap_readout : bool, optional
+            For step scans with the Greateyes detector, start moving to the next step as soon as the shutter closes, while the detector is
+            still reading out.  Exposures are not checked or retaken, so this is ignored if predict_exposure or exposure_memory_key is given.
+        accumulate_exposures : bool, optional
+            Sum the n_exposures exposures of each step in memory and save only the sum, with saturated pixels masked in each exposure (see FrameAccumulator).
+            dwell is then the time of each exposure, and exposure checks adjust it.
         """
 
         
@@ -92,7 +105,17 @@ def rsoxs_waxs_decorator(func):
                         print("Invalid time, exposure time not set")
             
             old_n_exp = waxs_det.number_exposures
-            waxs_det.number_exposures = n_exposures
+            if accumulate_exposures and n_exposures > 1:
+                waxs_det.number_exposures = 1
+                waxs_det.set_accumulation(n_exposures)
+            else:
+                waxs_det.number_exposures = n_exposures
+
+            def _post_scan_reset():
+                yield from post_scan_hardware_reset()
+                if waxs_det.accumulator is not None:
+                    waxs_det.set_accumulation(1)
+
             _extra_dets = [waxs_det]
             _extra_dets.extend(extra_dets)
             if "per_shot" in func.__signature__.parameters:
@@ -102,23 +125,54 @@ def rsoxs_waxs_decorator(func):
                 return (
                     yield from finalize_wrapper(
                         plan=func(*args, extra_dets=_extra_dets, per_shot=rsoxs_per_shot, dwell=None, **kwargs),
-                        final_plan=post_scan_hardware_reset(),
+                        final_plan=_post_scan_reset(),
+                    )
+                )
+            elif overlap_readout and not predict_exposure and exposure_memory_key is None:
+                rsoxs_per_step, finish_step = make_overlapped_readout_step(shutter_control, lead_detector=waxs_det)
+                return (
+                    yield from finalize_wrapper(
+                        plan=overlapped_readout_wrapper(
+                            func(*args, extra_dets=_extra_dets, per_step=rsoxs_per_step, dwell=None, **kwargs), finish_step
+                        ),
+                        final_plan=_post_scan_reset(),
                     )
                 )
             else:
-                rsoxs_per_step = rsoxs_per_step = partial(
-                    one_nd_sticky_exp_step,
-                    take_reading=partial(
-                        take_exposure_corrected_reading,
-                        shutter=shutter_control,
-                        check_exposure=False,
-                        lead_detector=waxs_det,
-                    ),
+                memory = get_exposure_memory(exposure_memory_key) if exposure_memory_key is not None else None
+                remember = {"points": []}
+                history = []
+                take_reading = partial(
+                    take_exposure_corrected_reading,
+                    shutter=shutter_control,
+                    check_exposure=predict_exposure or exposure_memory_key is not None, ## Corrections are only learned if exposure is checked
+                    lead_detector=waxs_det,
+                    count_retakes=predict_exposure,
                 )
+                if predict_exposure:
+                    reset_exposure_metrics() ## metrics printed at the end are for this scan only
+                    rsoxs_per_step = partial(
+                        predictive_exposure_step,
+                        take_reading=take_reading,
+                        history=history,
+                        lead_detector=waxs_det,
+                        izero=izero_mesh,
+                        memory=memory,
+                    )
+                else:
+                    rsoxs_per_step = partial(one_nd_sticky_exp_step, take_reading=take_reading, remember=remember, memory=memory)
+
+                def _final_plan():
+                    yield from _post_scan_reset()
+                    if exposure_memory_key is not None:
+                        save_exposure_memory(exposure_memory_key, history if predict_exposure else remember["points"])
+                    if predict_exposure:
+                        print_exposure_metrics()
+
                 return (
                     yield from finalize_wrapper(
                         plan=func(*args, extra_dets=_extra_dets, per_step=rsoxs_per_step, dwell=None, **kwargs),
-                        final_plan=post_scan_hardware_reset(),
+                        final_plan=_final_plan(),
                     )
                 )
         else:
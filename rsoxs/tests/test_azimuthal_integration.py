@@ -0,0 +1,98 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("scipy")
+pytest.importorskip("event_model")
+pytest.importorskip("bluesky_darkframes")
+pytest.importorskip("frozendict")
+
+from rsoxs.callbacks.azimuthal_integration import (  # noqa: E402
+    LiveAzimuthalIntegration,
+    get_integration_geometry,
+    get_polygon_mask,
+    hc,
+    integrate_frame,
+)
+
+
+shape = (200, 220)
+beamCenter = (100, 90)
+distance = 10.0
+pixelSize = 0.06
+
+
+def make_ring_image(radius_ring=3.0, width=0.1, anisotropic=False):
+    ## Scattering ring at radius_ring mm from the beam center, stronger along chi = 0 if anisotropic
+    rows, columns = np.indices(shape, dtype=float)
+    x = (columns - beamCenter[0]) * pixelSize
+    y = (rows - beamCenter[1]) * pixelSize
+    image = 10 + 1000 * np.exp(-((np.hypot(x, y) - radius_ring) / width)**2)
+    if anisotropic: image = image * (1 + np.cos(np.arctan2(y, x))**2)
+    return image
+
+
+def test_polygon_mask():
+    mask = get_polygon_mask((10, 10), [(2, 2), (6, 2), (6, 5), (2, 5)])
+    assert mask.sum() == 4 * 3
+    assert mask[2:5, 2:6].all()
+
+
+def test_ring_peak_scales_with_energy():
+    "The ring is found at q = 4 pi sin(theta) / wavelength, at every energy, with the same geometry."
+    geometry = get_integration_geometry(shape, beamCenter[0], beamCenter[1], distance, pixel_size=pixelSize)
+    assert get_integration_geometry(shape, beamCenter[0], beamCenter[1], distance, pixel_size=pixelSize) is geometry
+    image = make_ring_image()
+    sinThetaRing = np.sin(np.arctan2(3.0, distance) / 2)
+    for energy in (250, 285, 300):
+        reduced = integrate_frame(image, geometry, energy)
+        qRing = 4 * np.pi * sinThetaRing * energy / hc
+        qPeak = reduced["q"][np.nanargmax(reduced["intensity"])]
+        assert qPeak == pytest.approx(qRing, abs=2 * (reduced["q"][1] - reduced["q"][0]))
+
+
+def test_mask_and_anisotropy():
+    "Masked pixels are left out of the averages, and an image stronger along chi = 0 has a positive anisotropy."
+    mask = [(0, 0), (50, 0), (50, 50), (0, 50)]
+    geometryMasked = get_integration_geometry(shape, beamCenter[0], beamCenter[1], distance, pixel_size=pixelSize, mask_polygon=mask)
+    assert geometryMasked["counts"].sum() == shape[0] * shape[1] - 50 * 50
+    image = np.full(shape, 5.0)
+    image[:50, :50] = 1e6
+    reduced = integrate_frame(image, geometryMasked, 285)
+    assert np.nanmax(reduced["intensity"]) == pytest.approx(5)
+    assert np.nanmax(np.abs(reduced["anisotropy"])) == pytest.approx(0, abs=1e-9)
+
+    geometry = get_integration_geometry(shape, beamCenter[0], beamCenter[1], distance, pixel_size=pixelSize)
+    reduced = integrate_frame(make_ring_image(anisotropic=True), geometry, 285)
+    assert reduced["anisotropy"][np.nanargmax(reduced["intensity"])] > 0.2
+
+
+def test_live_integration_emits_reduced_stream():
+    "Each light frame is integrated with the latest dark subtracted, and the reduced event is emitted after it and before the stop."
+    documents = []
+    callback = LiveAzimuthalIntegration(emit=lambda name, doc: documents.append((name, doc)), image_key="waxs_image", pixel_size=pixelSize)
+    start = {"uid": "run", "time": 0, "RSoXS_WAXS_SDD": distance, "RSoXS_WAXS_BCX": beamCenter[0], "RSoXS_WAXS_BCY": beamCenter[1]}
+    dataKeys = {"waxs_image": {"source": "sim", "dtype": "array", "shape": list(shape)}, "en_energy_setpoint": {"source": "sim", "dtype": "number", "shape": []}}
+    callback("start", start)
+    callback("descriptor", {"uid": "dark", "run_start": "run", "time": 0, "name": "dark", "data_keys": dataKeys})
+    callback("descriptor", {"uid": "light", "run_start": "run", "time": 0, "name": "primary", "data_keys": dataKeys})
+    dark = np.full(shape, 10.0)
+    callback("event", {"uid": "e0", "descriptor": "dark", "seq_num": 1, "time": 0, "data": {"waxs_image": dark}, "timestamps": {}})
+    for index, energy in enumerate((270, 285)):
+        image = make_ring_image() + dark
+        callback("event", {"uid": "e" + str(index + 1), "descriptor": "light", "seq_num": index + 1, "time": 0, "data": {"waxs_image": image, "en_energy_setpoint": energy}, "timestamps": {}})
+    callback("stop", {"uid": "stop", "run_start": "run", "time": 0, "exit_status": "success", "num_events": {"primary": 2, "dark": 1}})
+
+    names = [name for name, doc in documents]
+    assert names[:4] == ["start", "descriptor", "descriptor", "event"]
+    assert names[-1] == "stop"
+    assert names.count("descriptor") == 3 and names.count("event") == 5
+    descriptorReduced = next(doc for name, doc in documents if name == "descriptor" and doc["name"] == "azimuthal_integration")
+    reducedEvents = [doc for name, doc in documents if name == "event" and doc["descriptor"] == descriptorReduced["uid"]]
+    assert [event["data"]["light_seq_num"] for event in reducedEvents] == [1, 2]
+    positionsLight = {doc["seq_num"]: index for index, (name, doc) in enumerate(documents) if name == "event" and doc["descriptor"] == "light"}
+    assert all(documents.index(("event", event)) > positionsLight[event["data"]["light_seq_num"]] for event in reducedEvents)
+    assert [event["data"]["energy"] for event in reducedEvents] == [270, 285]
+    assert documents[-1][1]["num_events"]["azimuthal_integration"] == 2
+    assert len(callback.results) == 2
+    ## The dark offset is subtracted, so the background away from the ring is the 10 of make_ring_image
+    assert np.nanmin(callback.results[0]["intensity"]) == pytest.approx(10, abs=1)
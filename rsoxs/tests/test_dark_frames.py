@@ -0,0 +1,105 @@
+import time
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("ophyd")
+pytest.importorskip("bluesky_darkframes")
+
+from bluesky_darkframes import NoMatchingSnapshot  # noqa: E402
+from frozendict import frozendict  # noqa: E402
+from ophyd import Signal  # noqa: E402
+
+from rsoxs.devices.dark_frames import (  # noqa: E402
+    DarkFrameLibrary,
+    PersistentDarkFramePreprocessor,
+    StoredSnapshotDevice,
+    _load_npy_seq,
+    _write_npy_seq,
+)
+
+exposureSignal = Signal(name="test_waxs_cam_acquire_time", value=1.0)
+
+
+class SimDetector:
+    name = "test_waxs"
+
+
+def dark_plan(detector):
+    yield from ()
+
+
+def make_state(exposure):
+    ## State as made by DarkFramePreprocessor from the locked signals
+    return {exposureSignal.name: ((exposureSignal.name, exposure),)}
+
+
+def make_snapshot(directory, image):
+    ## Snapshot of a detector that saves its image like SimGreatEyes
+    resource, datum = _write_npy_seq(directory, image)
+    stored = {
+        "name": "test_waxs",
+        "describe": {"test_waxs_image": {"source": "SIM", "dtype": "array", "shape": list(image.shape), "external": "FILESTORE:"}},
+        "describe_configuration": {},
+        "read": {"test_waxs_image": {"value": datum["datum_id"], "timestamp": time.time()}},
+        "read_configuration": {},
+        "asset_docs": [("resource", resource), ("datum", datum)],
+    }
+    return StoredSnapshotDevice(stored)
+
+
+def make_preprocessor(directory, max_age=100):
+    library = DarkFrameLibrary(str(directory))
+    return PersistentDarkFramePreprocessor(
+        dark_plan=dark_plan, detector=SimDetector(), max_age=max_age, locked_signals=[exposureSignal], library=library, exposure_signal=exposureSignal,
+    )
+
+
+def get_image(snapshot):
+    resource, datum = [doc for name, doc in snapshot.collect_asset_docs()]
+    return _load_npy_seq(resource, datum)
+
+
+def test_dark_from_the_library(tmp_path):
+    "A dark taken by one preprocessor is found by a new one, e.g., after a kernel restart, and is then cached with its age."
+    preprocessor = make_preprocessor(tmp_path)
+    preprocessor.add_snapshot(make_snapshot(str(tmp_path), np.full((4, 4), 7.0)), make_state(1.0))
+    preprocessorNew = make_preprocessor(tmp_path)
+    preprocessorNew.library.entries[0]["created"] -= 60
+    snapshot = preprocessorNew.get_snapshot(make_state(1.0))
+    assert np.all(get_image(snapshot) == 7)
+    assert preprocessorNew.get_time_left(make_state(1.0)) == pytest.approx(40, abs=1)
+    assert time.monotonic() - preprocessorNew.cache[frozendict(make_state(1.0))][0] == pytest.approx(60, abs=1)
+    with pytest.raises(NoMatchingSnapshot):
+        preprocessorNew.get_snapshot(make_state(2.0))
+
+
+def test_library_age_cutoff(tmp_path):
+    "Darks older than max_age are not used from the library, and darks nearly max_age old drop out of the memory cache when they reach it."
+    preprocessor = make_preprocessor(tmp_path)
+    preprocessor.add_snapshot(make_snapshot(str(tmp_path), np.full((4, 4), 7.0)), make_state(1.0))
+    preprocessor.library.entries[0]["created"] -= 101
+    preprocessor.clear()
+    with pytest.raises(NoMatchingSnapshot):
+        preprocessor.get_snapshot(make_state(1.0))
+    preprocessor.library.entries[0]["created"] += 2
+    preprocessor.get_snapshot(make_state(1.0))
+    preprocessor.library.entries[0]["created"] -= 2
+    preprocessor.max_age = 99 ## ages the memory cache by a second, as if a second had passed
+    with pytest.raises(NoMatchingSnapshot):
+        preprocessor.get_snapshot(make_state(1.0))
+
+
+def test_synthesized_dark(tmp_path):
+    "A dark for an exposure time between those in the library is synthesized from the bias and dark current fit, and is as old as the oldest dark of the fit."
+    preprocessor = make_preprocessor(tmp_path)
+    preprocessor.add_snapshot(make_snapshot(str(tmp_path), np.full((4, 4), 110.0)), make_state(1.0))
+    preprocessor.add_snapshot(make_snapshot(str(tmp_path), np.full((4, 4), 150.0)), make_state(5.0))
+    preprocessor.library.entries[0]["created"] -= 30
+    preprocessor.clear()
+    snapshot = preprocessor.get_snapshot(make_state(2.0))
+    assert get_image(snapshot) == pytest.approx(np.full((4, 4), 120.0))
+    assert snapshot.created == preprocessor.library.entries[0]["created"]
+    assert time.monotonic() - preprocessor.cache[frozendict(make_state(2.0))][0] == pytest.approx(30, abs=1)
+    with pytest.raises(NoMatchingSnapshot):
+        preprocessor.get_snapshot(make_state(10.0))
@@ -0,0 +1,76 @@
+import pytest
+
+from rsoxs.devices.detector_modes import (
+    detectorModes,
+    geometryBinning,
+    get_mode_settings,
+    get_beam_center_unbinned,
+    get_readout_time,
+    image_to_sensor_region,
+    rescale_geometry,
+    sensorShape,
+)
+
+
+mdConfiguration = {
+    "RSoXS_WAXS_BCX": 474,
+    "RSoXS_WAXS_BCY": 502,
+    "WAXS_Mask": [(477.418, 535.415), (446.074, 511.344), (872.214, -0.476), (948.916, -0.476)],
+    "RSoXS_WAXS_Binning": geometryBinning,
+    "RSoXS_WAXS_Offset": [0, 0],
+}
+
+
+def test_full_frame_without_region():
+    "Without readout regions, every mode reads the full sensor at its binning."
+    for mode in detectorModes:
+        settings = get_mode_settings(mode, beam_center=(1000, 1000), use_region=False)
+        assert settings["region_image"] is None
+        assert (settings["min_y"], settings["min_x"], settings["size_y"], settings["size_x"]) == (0, 0) + sensorShape
+        assert settings["binning"] == detectorModes[mode]["binning"]
+
+
+def test_region_on_sensor():
+    "Regions fit on the sensor and are aligned to the binning, whatever the transform."
+    for transform_type in range(8):
+        settings = get_mode_settings("beam_region", beam_center=(1900, 100), transform_type=transform_type, use_region=True)
+        row, column, rows, columns = settings["region_image"]
+        binning = settings["binning"]
+        assert row >= 0 and column >= 0 and row + rows <= sensorShape[0] and column + columns <= sensorShape[1]
+        assert row % binning == 0 and column % binning == 0 and rows % binning == 0 and columns % binning == 0
+        assert settings["size_x"] * settings["size_y"] == rows * columns
+        assert image_to_sensor_region((0, 0) + sensorShape, transform_type) == (0, 0) + sensorShape
+
+
+def test_rescale_geometry_round_trip():
+    "The beam center and mask keep their unbinned positions when rescaled to a mode and back."
+    md = dict(mdConfiguration)
+    beamCenter = get_beam_center_unbinned(md)
+    for mode in detectorModes:
+        settings = get_mode_settings(mode, beam_center=beamCenter, use_region=True)
+        mdMode = dict(md)
+        mdMode.update(rescale_geometry(md, settings))
+        assert mdMode["RSoXS_WAXS_Pixel_Size"] == pytest.approx(0.015 * settings["binning"])
+        assert get_beam_center_unbinned(mdMode) == pytest.approx(beamCenter)
+        mdBack = dict(mdMode)
+        mdBack.update(rescale_geometry(mdMode, get_mode_settings("default")))
+        assert mdBack["RSoXS_WAXS_BCX"] == pytest.approx(md["RSoXS_WAXS_BCX"])
+        assert mdBack["RSoXS_WAXS_BCY"] == pytest.approx(md["RSoXS_WAXS_BCY"])
+        for point, pointBack in zip(md["WAXS_Mask"], mdBack["WAXS_Mask"]):
+            assert pointBack == pytest.approx(point)
+
+
+def test_coarse_binning_halves_beam_center():
+    "Going from 4 x 4 to 8 x 8 binning puts the beam center at about half its binned position."
+    md = dict(mdConfiguration)
+    geometry = rescale_geometry(md, get_mode_settings("coarse"))
+    assert geometry["RSoXS_WAXS_Binning"] == 8
+    assert geometry["RSoXS_WAXS_BCX"] == pytest.approx((474 + 0.5) / 2 - 0.5)
+    assert geometry["RSoXS_WAXS_BCY"] == pytest.approx((502 + 0.5) / 2 - 0.5)
+
+
+def test_readout_time_drops_with_binning_and_region():
+    assert get_readout_time(8, 8) < get_readout_time(4, 4) < get_readout_time(1, 1)
+    assert get_readout_time(4, 4, region=(0, 0, 1024, 1024)) < get_readout_time(4, 4)
+    with pytest.raises(ValueError):
+        get_readout_time(adc_speed="10 MHz")
@@ -0,0 +1,69 @@
+import pytest
+
+pytest.importorskip("ophyd")
+
+from ophyd import Component as C, Device, Signal  # noqa: E402
+from ophyd.areadetector.filestore_mixins import FileStoreHDF5IterativeWrite  # noqa: E402
+from ophyd.areadetector.plugins import HDF5Plugin  # noqa: E402
+from ophyd.sim import make_fake_device  # noqa: E402
+
+from rsoxs.devices.detector_state import SignalStateCache  # noqa: E402
+
+
+class SimCam(Device):
+    num_images = C(Signal, value=1)
+    array_callbacks = C(Signal, value=0)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stage_sigs["num_images"] = 5
+
+
+class HDF5PluginWithFileStore(HDF5Plugin, FileStoreHDF5IterativeWrite):
+    pass
+
+
+class SimDetector(Device):
+    ## Stages like RSOXSGreatEyesDetector, with the stage_sigs applied through the cache before ophyd's stage
+    cam = C(SimCam, "cam1:")
+    hdf5 = C(HDF5PluginWithFileStore, "HDF1:", write_path_template="/tmp/")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.state_cache = SignalStateCache(timeout=5)
+
+    def stage(self):
+        stripped = self.state_cache.apply_stage_sigs(self)
+        try:
+            return super().stage()
+        finally:
+            self.state_cache.restore_stage_sigs(stripped)
+
+    def unstage(self):
+        self.state_cache.restore_original_values(self)
+        return super().unstage()
+
+
+def make_detector():
+    detector = make_fake_device(SimDetector)("SIM:", name="test_det")
+    hdf5 = detector.hdf5
+    hdf5.file_path_exists.sim_put(1)
+    hdf5.plugin_type.sim_put("NDFileHDF5")
+    for name in hdf5.array_size.component_names:
+        getattr(hdf5.array_size, name).sim_put(16)
+    hdf5.stage_sigs["enable"] = "Enable"  # the fake string signal only settles on a string
+    return detector
+
+
+def test_file_plugin_capture_is_started():
+    "The file plugin is staged by ophyd, so capture is on after its file path is set, and off again after unstage."
+    detector = make_detector()
+    detector.stage()
+    try:
+        assert detector.cam.num_images.get() == 5
+        assert detector.hdf5.file_write_mode.get() == "Stream"
+        assert detector.hdf5.capture.get() == 1
+    finally:
+        detector.unstage()
+    assert detector.hdf5.capture.get() == 0
+    assert detector.cam.num_images.get() == 1
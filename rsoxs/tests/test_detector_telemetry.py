@@ -0,0 +1,86 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from rsoxs.devices.detector_telemetry import DetectorTelemetry, RingBuffer, baselineSamples  # noqa: E402
+
+
+def make_telemetry():
+    ## Telemetry that keeps its events in a list, without the logging hook
+    events = []
+    telemetry = DetectorTelemetry("test_waxs")
+    telemetry.hooks = []
+    telemetry.add_hook(events.append)
+    return telemetry, events
+
+
+def test_ring_buffer():
+    "The buffer keeps the last values in time order, with percentiles and a trend per hour."
+    buffer = RingBuffer(3)
+    for index in range(5):
+        buffer.append(index, timestamp=1800 * index)
+    assert len(buffer) == 3
+    assert buffer.values().tolist() == [2, 3, 4]
+    assert buffer.times().tolist() == [3600, 5400, 7200]
+    assert buffer.last() == 4
+    assert buffer.percentile(50) == 3
+    assert buffer.trend() == pytest.approx(2)
+    buffer.clear()
+    assert buffer.last() is None and buffer.trend() is None
+
+
+def test_readout_drift_fires_once_and_rearms():
+    "A drift of the readout ratio from its baseline fires once, and again only after it has cleared."
+    telemetry, events = make_telemetry()
+    for index in range(baselineSamples):
+        telemetry.record("readout_ratio", 1.0)
+    assert events == []
+    for index in range(10):
+        telemetry.record("readout_ratio", 1.5)
+    assert [event["event"] for event in events] == ["readout_drift"]
+    assert events[0]["baseline"] == pytest.approx(1.0)
+    assert events[0]["value"] > 1.2
+    for index in range(20):
+        telemetry.record("readout_ratio", 1.0)
+    for index in range(10):
+        telemetry.record("readout_ratio", 1.5)
+    assert [event["event"] for event in events] == ["readout_drift", "readout_drift"]
+    assert telemetry.metrics["readout_drift"] == 2
+
+
+def test_reset_baseline():
+    "After a reset, the baseline is taken again from the next samples, so the new level does not count as a drift."
+    telemetry, events = make_telemetry()
+    for index in range(baselineSamples):
+        telemetry.record("file_write_time", 0.1)
+    telemetry.reset_baseline("file_write_time")
+    for index in range(2 * baselineSamples):
+        telemetry.record("file_write_time", 0.5)
+    assert events == []
+    assert telemetry.averages["file_write_time"][1] == pytest.approx(0.5)
+
+
+def test_state_hooks():
+    "Slow file writes, temperature drift, cooling off, and saturated frames each fire their event when they start."
+    telemetry, events = make_telemetry()
+    telemetry.record_file_write(5)
+    telemetry.record_file_write(6)
+    telemetry.sample_status(-78, -80, True, force=True)
+    telemetry.sample_status(-78, -80, True, force=True)
+    telemetry.sample_status(-80, -80, True, force=True)
+    telemetry.sample_status(20, -80, False, force=True)
+    telemetry.record_saturation({"saturated_pixels": 1000, "max_value": 262143, "saturated": True})
+    assert [event["event"] for event in events] == ["file_write_slow", "temperature_drift", "cooling_off", "saturation"]
+    assert telemetry.buffers["temperature"].values().tolist() == [-78, -78, -80, 20]
+
+
+def test_failing_hook_does_not_raise():
+    telemetry, events = make_telemetry()
+
+    def failing_hook(event):
+        raise RuntimeError("hook failed")
+
+    telemetry.add_hook(failing_hook)
+    telemetry.record_file_write(5)
+    assert len(events) == 1
+    assert telemetry.metrics["events"] == 1
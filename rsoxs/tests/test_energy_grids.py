@@ -0,0 +1,91 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from rsoxs.plans.energy_grids import (  # noqa: E402
+    energyGridRegistry,
+    get_energy_grid,
+    get_fly_segments,
+    get_number_points,
+    refine_energy_grid,
+    validate_energy_grid,
+)
+
+
+def test_grid_includes_stops_once():
+    "Each region includes its stop, and the start of the next region is not repeated."
+    grid = get_energy_grid((270, 5, 280, 1, 283))
+    assert grid.tolist() == [270, 275, 280, 281, 282, 283]
+    assert get_energy_grid((283, 1, 280)).tolist() == [283, 282, 281, 280]
+    assert get_energy_grid(285).tolist() == [285]
+    assert not grid.flags.writeable
+
+
+def test_number_points_matches_grid():
+    "Point counts, precomputed for the named grids, match the length of the grids."
+    for energyListName, entry in energyGridRegistry.items():
+        grid = get_energy_grid(energyListName)
+        assert get_number_points(energyListName) == entry["number_points"] == len(grid)
+        assert grid.min() == pytest.approx(entry["energy_min"])
+        assert grid.max() == pytest.approx(entry["energy_max"])
+
+
+def test_validate_energy_grid():
+    assert validate_energy_grid((270, 5, 280, 1, 283)) == []
+    with pytest.raises(ValueError):
+        validate_energy_grid((270, 3, 280))
+    with pytest.warns(UserWarning):
+        assert len(validate_energy_grid((270, 3, 280), strict=False)) == 1
+    with pytest.raises(ValueError):
+        validate_energy_grid((270, 5, 280, 1, 275))
+    with pytest.warns(UserWarning):
+        assert len(validate_energy_grid((250, 5, 260, 5, 250), strict=False)) == 1
+    with pytest.raises(TypeError):
+        validate_energy_grid((270, 5))
+
+
+def test_fly_segments():
+    "Fly segments go from start to stop of each region at step / exposure_time."
+    segments = get_fly_segments((270, 0.5, 280, 0.1, 285), exposure_time=0.5)
+    assert segments == [(270, 280, pytest.approx(1)), (280, 285, pytest.approx(0.2))]
+    with pytest.raises(ValueError):
+        get_fly_segments(285, exposure_time=1)
+
+
+def test_refine_energy_grid_densifies_around_edge():
+    "New energies go to the intervals around a steep edge, not to the flat regions, and not below the minimum step."
+    energies = np.arange(270, 300.1, 1.0)
+    signal = 1 / (1 + np.exp(-(energies - 285) / 0.5))
+    energiesNew = refine_energy_grid(energies, signal, 10, energy_step_min=0.25)
+    assert 0 < len(energiesNew) <= 10
+    assert np.all(np.abs(energiesNew - 285) < 3)
+    assert len(np.intersect1d(energiesNew, energies)) == 0
+    assert np.min(np.diff(np.sort(np.concatenate([energies, energiesNew])))) >= 0.25 - 1e-9
+    assert len(refine_energy_grid(energies, np.ones_like(energies), 10)) == 0
+
+
+def test_adaptive_energy_passes_with_sim_signals():
+    "The adaptive passes run as a plan, and stay within the point budget with more points near the edge."
+    pytest.importorskip("bluesky")
+    pytest.importorskip("ophyd")
+    from functools import partial
+    from bluesky import RunEngine
+    from bluesky.plans import list_scan
+    from ophyd.sim import SynAxis, SynSignal
+    from rsoxs.plans.adaptive_energy import adaptive_energy_passes
+
+    energy = SynAxis(name="energy")
+    signal = SynSignal(func=lambda: 1 / (1 + np.exp(-(energy.readback.get() - 285) / 0.5)), name="signal")
+    RE = RunEngine({}, call_returns_result=True)
+    energies, spectrum = RE(adaptive_energy_passes(
+        partial(list_scan, [signal], energy),
+        (270, 2, 300),
+        "signal",
+        point_budget=30,
+        passes=3,
+        energy_step_min=0.25,
+    )).plan_result
+    assert len(energies) <= 30
+    assert np.all(np.diff(energies) > 0)
+    assert spectrum == pytest.approx(1 / (1 + np.exp(-(energies - 285) / 0.5)))
+    assert np.sum(np.abs(energies - 285) < 3) > np.sum(np.abs(energies - 275) < 3)
@@ -0,0 +1,82 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from rsoxs.HW.epu_gap_model import (  # noqa: E402
+    epuGapModels,
+    fit_gap_model,
+    fit_speed_model,
+    get_model_gap,
+    get_model_speed_offset,
+    load_gap_models,
+    register_gap_model,
+    register_speed_model,
+    save_gap_models,
+    unregister_gap_models,
+)
+
+
+@pytest.fixture(autouse=True)
+def clear_models():
+    unregister_gap_models()
+    yield
+    unregister_gap_models()
+
+
+def make_calibration(offset=0):
+    ## Best gaps of a smooth calibration table, in um
+    energies = np.linspace(250, 1000, 40)
+    return energies, 20000 + 40 * energies - 0.01 * energies**2 + offset
+
+
+def test_fit_gap_model():
+    "The fit reproduces the calibration table, and the residual report flags a bad point."
+    energies, gaps = make_calibration()
+    model = fit_gap_model(energies, gaps, polarization=0, degree=3)
+    assert model["residuals"]["rms"] < 1e-6
+    assert (model["energy_min"], model["energy_max"]) == (250, 1000)
+    gaps[10] += 500
+    model = fit_gap_model(energies, gaps, polarization=0, degree=3)
+    assert model["residuals"]["energy_worst"] == energies[10]
+    with pytest.raises(ValueError):
+        register_gap_model(model, residual_max=100)
+    assert len(epuGapModels) == 0
+    with pytest.raises(ValueError):
+        fit_gap_model(energies[:3], gaps[:3], polarization=0, degree=3)
+
+
+def test_model_gap_lookup():
+    "Linear polarizations between calibrated ones are interpolated, 90-180 is folded onto 0-90, and uncovered energies fall back to None."
+    energies, gaps = make_calibration()
+    register_gap_model(fit_gap_model(energies, gaps, polarization=0, degree=3))
+    register_gap_model(fit_gap_model(energies, gaps + 1000, polarization=90, degree=3))
+    gapZero = get_model_gap(500, 0)
+    assert gapZero == pytest.approx(20000 + 40 * 500 - 0.01 * 500**2)
+    assert get_model_gap(500, 45) == pytest.approx(gapZero + 500)
+    assert get_model_gap(500, 135) == pytest.approx(gapZero + 500)
+    assert get_model_gap(500, 180) == pytest.approx(gapZero)
+    assert get_model_gap(2000, 0) is None
+    assert get_model_gap(500, -1) is None
+    assert get_model_gap(500, 0, harmonic=3) is None
+
+
+def test_speed_model():
+    "The speed offset goes through zero at zero speed and is None without a speed model."
+    assert get_model_speed_offset(1, 0) is None
+    model = fit_speed_model([0.5, 1, 2], [15, 30, 60], polarization=0)
+    assert model["coefficients"][0] == 0
+    register_speed_model(model)
+    assert get_model_speed_offset(1.5, 0) == pytest.approx(45)
+    assert get_model_speed_offset(-1.5, 0) == pytest.approx(45)
+
+
+def test_save_and_load(tmp_path):
+    energies, gaps = make_calibration()
+    register_gap_model(fit_gap_model(energies, gaps, polarization=0, degree=3))
+    register_speed_model(fit_speed_model([0.5, 1, 2], [15, 30, 60], polarization=0))
+    gap, offset = get_model_gap(500, 0), get_model_speed_offset(1, 0)
+    save_gap_models(str(tmp_path / "gap_models.json"))
+    unregister_gap_models()
+    load_gap_models(str(tmp_path / "gap_models.json"))
+    assert get_model_gap(500, 0) == pytest.approx(gap)
+    assert get_model_speed_offset(1, 0) == pytest.approx(offset)
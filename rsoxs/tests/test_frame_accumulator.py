@@ -0,0 +1,115 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("ophyd")
+
+from ophyd import Signal  # noqa: E402
+from ophyd.status import Status  # noqa: E402
+
+from rsoxs.devices.frame_accumulator import FrameAccumulator  # noqa: E402
+
+
+class SimDetector:
+    ## Thresholds and exposure signals of a detector, with frames given in order by get_frame
+    name = "test_waxs"
+    saturation_high_threshold = 1000
+    saturation_level = 1000
+    saturation_high_pixel_count = 0
+    saturation_low_threshold = 10
+    underexposure_min_value = 20
+    underexposure_num_pixels = 100
+
+    def __init__(self, frames=()):
+        self.frames = list(frames)
+        self.frame = None
+        self.frame_statistics = None
+        self.saturated = Signal(name="saturated", value=False)
+        self.under_exposed = Signal(name="under_exposed", value=False)
+
+    def trigger_frame(self):
+        self.frame = self.frames.pop(0)
+        status = Status()
+        status.set_finished()
+        return status
+
+    def get_frame(self):
+        return self.frame
+
+
+def make_frames(number_frames=4):
+    ## Pixel (0, 0) is always valid, (0, 1) saturates in the first frame, (0, 2) wraps to a low value in the last frame, and (0, 3) saturates in every frame
+    frames = np.full((number_frames, 4, 4), 100, dtype=np.uint32)
+    frames[0, 0, 1] = 5000
+    frames[-1, 0, 2] = 2
+    frames[:, 0, 3] = 5000
+    return frames
+
+
+def test_masked_pixels_are_scaled():
+    "Pixels masked in some frames are scaled up from the frames where they were valid, and pixels masked in every frame are set to the saturation value."
+    detector = SimDetector()
+    accumulator = FrameAccumulator(4)
+    for frame in make_frames(): accumulator.add(detector, frame)
+    summed = accumulator.get_sum(detector.saturation_level)
+    assert accumulator.valid_count[0].tolist() == [4, 3, 3, 0]
+    assert summed[0].tolist() == [400, 400, 400, 4 * detector.saturation_level]
+    assert np.all(summed[1:] == 400)
+    assert [statistics["saturated_pixels"] for statistics in accumulator.frame_statistics] == [2, 1, 1, 1]
+
+
+def test_pixels_below_full_scale_are_kept():
+    "Pixels above the exposure check threshold but below the full scale of the frame are valid, and pixels at full scale are masked."
+    detector = SimDetector()
+    detector.saturation_level = 2**18 - 1
+    accumulator = FrameAccumulator(2)
+    frame = np.full((2, 2), 100, dtype=np.uint32)
+    frame[0, 0] = 200000
+    frame[0, 1] = 2**18 - 1
+    for index in range(2): accumulator.add(detector, frame)
+    assert accumulator.valid_count[0].tolist() == [2, 0]
+
+
+def test_directory_is_given_at_stage(tmp_path):
+    "Without a directory of its own, the accumulator writes where stage tells it to, e.g., the proposal directory of the detector."
+    accumulator = FrameAccumulator(2, compression="none")
+    with pytest.raises(ValueError):
+        accumulator.stage()
+    accumulator.stage(str(tmp_path))
+    try:
+        assert accumulator.writer.directory == str(tmp_path)
+    finally:
+        accumulator.unstage()
+
+
+def test_sum_dtype_and_number_frames():
+    assert FrameAccumulator(4).dtype == np.uint32
+    assert FrameAccumulator(2**15).dtype == np.uint64
+    with pytest.raises(ValueError):
+        FrameAccumulator(0)
+
+
+def test_trigger_writes_sum(tmp_path):
+    "A trigger sums the frames in a thread, writes only the sum, and sets the exposure signals of the detector."
+    h5py = pytest.importorskip("h5py")
+    detector = SimDetector(make_frames())
+    accumulator = FrameAccumulator(4, str(tmp_path), compression="none")
+    accumulator.stage()
+    try:
+        accumulator.trigger(detector, detector.trigger_frame).wait(10)
+    finally:
+        accumulator.unstage()
+    assert detector.saturated.get()
+    assert not detector.under_exposed.get()
+    assert detector.frame_statistics["saturated_all_frames"] == 1
+    assert detector.frame_statistics["masked_pixels"] == 3
+    reading = accumulator.update_reading(detector, {})
+    assert reading["test_waxs_frame_max_values"]["value"] == [5000, 5000, 5000, 5000]
+    assert reading["test_waxs_masked_pixels"]["value"] == 3
+    documents = list(accumulator.collect_asset_docs())
+    assert [name for name, doc in documents] == ["resource", "datum"]
+    assert documents[1][1]["datum_id"] == reading["test_waxs_image"]["value"]
+    with h5py.File(str(tmp_path / documents[0][1]["resource_path"]), "r") as file:
+        data = file["/entry/data/data"]
+        assert data.shape == (1, 4, 4)
+        assert data.dtype == np.uint32
+        assert data[0, 0, 1] == 400
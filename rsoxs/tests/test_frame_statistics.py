@@ -0,0 +1,98 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from rsoxs.devices.frame_statistics import compute_frame_statistics, evaluate_exposure, get_sampling_stride  # noqa: E402
+from rsoxs.devices.sim_greateyes import SimGreatEyesSensor  # noqa: E402
+
+
+class Thresholds:
+    saturation_high_threshold = 100000
+    saturation_high_pixel_count = 500
+    saturation_low_threshold = 500
+    saturation_low_pixel_count = 500
+    underexposure_min_value = 2000
+    underexposure_num_pixels = 950000
+
+
+def make_sim_frame(exposure_time=1, binning=2, flux=3000):
+    sensor = SimGreatEyesSensor(seed=0, flux=flux, full_well=Thresholds.saturation_high_threshold)
+    return sensor.make_frame(exposure_time, bin_x=binning, bin_y=binning)
+
+
+def get_full_pixel_statistics(frame):
+    return {
+        "saturated_pixels": np.count_nonzero(frame > Thresholds.saturation_high_threshold - 1),
+        "low_pixels": np.count_nonzero(frame < Thresholds.saturation_low_threshold),
+        "underexposed_pixels": np.count_nonzero(frame < Thresholds.underexposure_min_value),
+    }
+
+
+def test_stride_one_matches_every_pixel():
+    "Without sampling, the counts are exactly those of every pixel."
+    frame = make_sim_frame(exposure_time=30)
+    statistics = compute_frame_statistics(frame, saturation_high_threshold=Thresholds.saturation_high_threshold - 1, stride=1)
+    full = get_full_pixel_statistics(frame)
+    for key, value in full.items():
+        assert statistics[key] == value
+    assert statistics["max_value"] == frame.max()
+    for percentile, value in statistics["percentiles"].items():
+        assert value == pytest.approx(np.percentile(frame, percentile))
+
+
+def test_strided_sample_estimates_whole_frame():
+    "The default strided sample estimates the whole-frame fractions of a saturated sim frame within a few percent of the frame."
+    frame = make_sim_frame(exposure_time=30)
+    stride = get_sampling_stride(frame.shape)
+    assert stride > 1
+    statistics = compute_frame_statistics(frame, saturation_high_threshold=Thresholds.saturation_high_threshold - 1)
+    full = get_full_pixel_statistics(frame)
+    assert full["saturated_pixels"] > 0
+    for key, value in full.items():
+        assert abs(statistics[key] - value) < 0.02 * frame.size
+    assert statistics["percentiles"][50] == pytest.approx(np.percentile(frame, 50), rel=0.05)
+
+
+def test_mask_counts():
+    "Counts in a mask are scaled up from the sampled pixels."
+    frame = np.full((256, 256), 10, dtype=np.uint32)
+    mask = np.zeros(frame.shape, dtype=bool)
+    mask[:64, :64] = True
+    statistics = compute_frame_statistics(frame, stride=4, mask=mask)
+    assert statistics["masked_counts"] == pytest.approx(frame[mask].sum())
+
+
+def test_evaluate_exposure():
+    "Saturation and underexposure follow the pixel count thresholds of the detector."
+    frameSaturated = make_sim_frame(exposure_time=30)
+    underExposed, saturated = evaluate_exposure(compute_frame_statistics(frameSaturated, saturation_high_threshold=Thresholds.saturation_high_threshold - 1), Thresholds)
+    assert saturated and not underExposed
+    frameDark = make_sim_frame(exposure_time=0.001, binning=1, flux=0)
+    underExposed, saturated = evaluate_exposure(compute_frame_statistics(frameDark), Thresholds)
+    assert underExposed and not saturated
+
+
+def test_sim_detector_sets_exposure_signals():
+    "Each trigger of the simulated detector computes the statistics of its frame and sets saturated and under_exposed."
+    pytest.importorskip("ophyd")
+    pytest.importorskip("nbs_bl")
+    pytest.importorskip("nslsii")
+    pytest.importorskip("sst_base")
+    from rsoxs.devices.detectors import SimGreatEyes
+
+    ## Bright enough to saturate the ring in a short exposure
+    detector = SimGreatEyes(name="test_waxs", sensor=SimGreatEyesSensor(seed=0, flux=1e5))
+    detector.cam.adc_speed.put("3 MHz")
+    detector.set_exptime(0.2)
+    detector.stage()
+    try:
+        detector.trigger().wait(10)
+        assert detector.frame_statistics["saturated"]
+        assert detector.saturated.get()
+        detector.set_exptime(0.001)
+        detector.shutter_off()
+        detector.trigger().wait(10)
+        assert not detector.saturated.get()
+        assert detector.frame_statistics["max_value"] == detector.get_frame()[:: detector.frame_statistics["stride"], :: detector.frame_statistics["stride"]].max()
+    finally:
+        detector.unstage()
@@ -0,0 +1,51 @@
+import pytest
+
+pytest.importorskip("bluesky")
+pytest.importorskip("ophyd")
+
+from ophyd import Component as C, Device, Signal  # noqa: E402
+
+## grating_state closes the shutter from nbs_bl.hw, which is only there with a configured beamline
+try:
+    from rsoxs.HW.grating_state import GratingStateManager
+except ImportError as error:
+    pytest.skip("rsoxs.HW.grating_state could not be imported: " + str(error), allow_module_level=True)
+
+
+class SimGratingX(Device):
+    readback = C(Signal, value="250l/mm")
+
+
+class SimOffsetMotor(Device):
+    user_offset = C(Signal, value=0)
+
+
+class SimMono(Device):
+    gratingx = C(SimGratingX, "")
+    cff = C(Signal, value=1.5)
+    grating = C(SimOffsetMotor, "")
+    mirror2 = C(SimOffsetMotor, "")
+
+
+def run_plan(plan):
+    ## Messages of a plan and its return value, without a RunEngine
+    messages = []
+    try:
+        while True:
+            messages.append(next(plan))
+    except StopIteration as stop:
+        return messages, stop.value
+
+
+def test_grating_in_place_is_a_no_op():
+    "Asking for the grating that is in place does nothing, even if its cff differs from the one a move would set."
+    mono = SimMono(name="mono_en")
+    manager = GratingStateManager(mono, Signal(name="en", value=270))
+    messages, moved = run_plan(manager.move_to("250"))
+    assert messages == []
+    assert moved == 0
+    assert mono.cff.get() == 1.5
+    assert manager.metrics == {"requests": 1, "moves": 0, "avoided": 1}
+    mono.gratingx.readback.put("1200")
+    assert manager.is_at("1200")
+    manager.unsubscribe()
@@ -0,0 +1,46 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("bluesky")
+pytest.importorskip("ophyd")
+
+from bluesky import RunEngine  # noqa: E402
+from bluesky.plans import list_scan  # noqa: E402
+import bluesky.preprocessors as bpp  # noqa: E402
+from ophyd.sim import SynAxis, SynGauss  # noqa: E402
+
+## nexafs_fly moves the energy from nbs_bl.hw, which is only there with a configured beamline
+try:
+    from rsoxs.plans.nexafs_fly import FlyScanBinner, bin_fly_scan_to_grid, binned_stream_wrapper, flyScanBinnedStream
+except ImportError as error:
+    pytest.skip("rsoxs.plans.nexafs_fly could not be imported: " + str(error), allow_module_level=True)
+
+
+def test_bin_fly_scan_to_grid():
+    "Readings go to the nearest grid point, also on descending grids, and empty bins are nan."
+    signals, counts = bin_fly_scan_to_grid([270.1, 270.4, 271.2, 272.9], [1, 3, 5, 7], [273, 272, 271, 270])
+    assert counts.tolist() == [1, 0, 1, 2]
+    assert signals[[0, 2, 3]].tolist() == [7, 5, 2]
+    assert np.isnan(signals[1])
+
+
+def test_binned_readings_are_saved_with_the_run():
+    "The binned readings are an extra stream of the run, with the mean and the number of readings at each grid point."
+    motor = SynAxis(name="energy")
+    detector = SynGauss("detector", motor, "energy", center=271, Imax=1, sigma=10)
+    energies = [270, 270.2, 271, 271.1, 272]
+    binner = FlyScanBinner(energy_name="energy")
+    documents = []
+    RE = RunEngine({})
+    RE.subscribe(lambda name, doc: documents.append((name, doc)))
+    plan = list_scan([detector], motor, energies, md={"energy_grid": [270, 271, 272]})
+    RE(bpp.subs_wrapper(binned_stream_wrapper(plan, binner), binner))
+
+    descriptors = {doc["uid"]: doc["name"] for name, doc in documents if name == "descriptor"}
+    eventsBinned = [doc for name, doc in documents if name == "event" and descriptors[doc["descriptor"]] == flyScanBinnedStream]
+    assert len(eventsBinned) == 1
+    data = eventsBinned[0]["data"]
+    assert np.asarray(data["energy_grid"]).tolist() == [270, 271, 272]
+    assert np.asarray(data["detector_binned_counts"]).tolist() == [2, 2, 1]
+    assert np.asarray(data["detector_binned"]) == pytest.approx(binner.results["signals"]["detector"])
+    assert documents[-1][1]["num_events"][flyScanBinnedStream] == 1
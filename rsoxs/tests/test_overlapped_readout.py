@@ -0,0 +1,20 @@
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("bluesky")
+pytest.importorskip("ophyd")
+
+## per_steps imports the shutter from nbs_bl.hw, which is only there with a configured beamline
+try:
+    from rsoxs.plans.per_steps import benchmark_overlapped_readout
+except ImportError as error:
+    pytest.skip("rsoxs.plans.per_steps could not be imported: " + str(error), allow_module_level=True)
+
+
+def test_overlapped_readout_saves_time():
+    "Moving during the readout is faster than reading out first, keeps events in step order, and never moves while the shutter is open."
+    results = benchmark_overlapped_readout(exposure_time=0.8, readout_time=0.3, move_time=0.2, number_points=3)
+    assert results["events_in_order"]
+    assert results["moves_during_exposure"] == 0
+    ## The moves of the last two steps happen during readouts
+    assert results["time_saved"] > 0.2
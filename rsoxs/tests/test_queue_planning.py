@@ -0,0 +1,128 @@
+import pytest
+
+pytest.importorskip("numpy")
+
+from rsoxs.plans.queue_planning import (  # noqa: E402
+    coalesce_acquisitions_queue,
+    estimate_acquisition_duration,
+    get_multi_segment_energies,
+    predict_temperature_ramp_time,
+    schedule_temperatures,
+)
+
+
+def make_acquisition(sample_id, uid_local, **parameters):
+    ## Sanitized acquisition with the parameters the planner looks at
+    acquisition = {
+        "sample_id": sample_id,
+        "uid_local": uid_local,
+        "configuration_instrument": "WAXSNEXAFS",
+        "scan_type": "nexafs",
+        "energy_list_parameters": (270, 1, 280),
+        "polarization_frame": "lab",
+        "polarizations": [0],
+        "sample_angles": [0],
+        "exposure_time": 1,
+        "exposures_per_energy": 1,
+        "cycles": 0,
+        "energy_sweep_order": "ascending",
+        "detector_mode": None,
+        "temperatures": None,
+        "group_name": "test",
+        "exposure_memory": False,
+        "steps_completed": [],
+    }
+    acquisition.update(parameters)
+    return acquisition
+
+
+def get_batches(queue):
+    return [(batch["mode"], [acquisition["uid_local"] for acquisition in batch["acquisitions"]]) for batch in coalesce_acquisitions_queue(queue)]
+
+
+def test_segments_of_one_sample_are_merged():
+    "Consecutive energy segments on one sample are merged into one scan, with shared energies measured once."
+    queue = [
+        make_acquisition("A", 1, energy_list_parameters=(270, 1, 280)),
+        make_acquisition("A", 2, energy_list_parameters=(280, 0.5, 282)),
+    ]
+    assert get_batches(queue) == [("multi_segment", [1, 2])]
+    energies, attribution = get_multi_segment_energies(queue)
+    assert energies == sorted(set(energies))
+    assert len(energies) == 11 + 5 - 1
+    assert [entry["uid_local"] for entry in attribution] == ["1", "2"]
+
+
+def test_segments_at_different_edges_are_not_merged():
+    "Carbon and nitrogen segments on one sample are separate scans, so each edge keeps its own exposure memory."
+    queue = [
+        make_acquisition("A", 1, energy_list_parameters=(270, 1, 280)),
+        make_acquisition("A", 2, energy_list_parameters=(400, 1, 410)),
+    ]
+    assert get_batches(queue) == [("single", [1]), ("single", [2])]
+    queue = [make_acquisition("A", 1, energy_sweep_order="snake"), make_acquisition("A", 2, energy_sweep_order="snake", energy_list_parameters=(280, 0.5, 282))]
+    assert get_batches(queue) == [("single", [1]), ("single", [2])]
+
+
+def test_shared_energies_are_rounded():
+    "The same energy reached with different float steps is measured once."
+    queue = [
+        make_acquisition("A", 1, energy_list_parameters=(270.1, 0.1, 270.5)),
+        make_acquisition("A", 2, energy_list_parameters=(270.2, 0.2, 270.4)),
+    ]
+    energies, attribution = get_multi_segment_energies(queue)
+    assert energies == [270.1, 270.2, 270.3, 270.4, 270.5]
+
+
+def test_samples_with_the_same_scan_share_a_batch():
+    "Different samples with the same scan are run as one multi_location batch, in queue order."
+    queue = [make_acquisition("A", 1), make_acquisition("B", 2), make_acquisition("C", 3, exposure_time=2), make_acquisition("D", 4, exposure_time=2)]
+    assert get_batches(queue) == [("multi_location", [1, 2]), ("multi_location", [3, 4])]
+
+
+def test_acquisitions_that_are_not_coalesced():
+    "Started acquisitions, NoBeam, cycles, spirals, and acquisitions with different settings are run on their own."
+    assert get_batches([make_acquisition("A", 1), make_acquisition("A", 2, steps_completed=["0"])]) == [("single", [1]), ("single", [2])]
+    assert get_batches([make_acquisition("A", 1, configuration_instrument="NoBeam"), make_acquisition("B", 2, configuration_instrument="NoBeam")]) == [("single", [1]), ("single", [2])]
+    assert get_batches([make_acquisition("A", 1, cycles=1), make_acquisition("A", 2, cycles=1)]) == [("single", [1]), ("single", [2])]
+    assert get_batches([make_acquisition("A", 1, scan_type="spiral"), make_acquisition("B", 2, scan_type="spiral")]) == [("single", [1]), ("single", [2])]
+    assert get_batches([make_acquisition("A", 1, temperatures=50), make_acquisition("A", 2, temperatures=60)]) == [("single", [1]), ("single", [2])]
+    assert get_batches([make_acquisition("A", 1), make_acquisition("A", 2, exposure_memory=True)]) == [("single", [1]), ("single", [2])]
+
+
+def get_segments(segments):
+    return [(segment["mode"], segment.get("setpoint", [acquisition["uid_local"] for acquisition in segment.get("acquisitions", [])])) for segment in segments]
+
+
+def test_temperatures_run_in_monotonic_order_from_the_closest_end():
+    queue = [make_acquisition("A", 1, temperatures=50), make_acquisition("A", 2, temperatures=100), make_acquisition("A", 3, temperatures=75)]
+    segments, schedule = schedule_temperatures(queue, temperature_current=90)
+    assert [segment["setpoint"] for segment in segments if segment["mode"] == "wait_temperature"] == [100, 75, 50]
+    segments, schedule = schedule_temperatures(queue)
+    assert [entry["setpoint"] for entry in schedule] == [50, 75, 100]
+    assert all(entry["time_ramp"] is None for entry in schedule)
+
+
+def test_acquisitions_run_during_ramps():
+    "Acquisitions on samples that never need a temperature fill the predicted ramp time, and the others run before any ramp."
+    queue = [
+        make_acquisition("A", 1, temperatures=60),
+        make_acquisition("A", 2),
+        make_acquisition("B", 3, energy_list_parameters=(270, 0.5, 320)),
+        make_acquisition("C", 4, energy_list_parameters=(270, 0.5, 320)),
+        make_acquisition("D", 5, energy_list_parameters=(270, 0.5, 320)),
+    ]
+    timeRamp = predict_temperature_ramp_time(20, 60, ramp_rate=10, settle_time=120)
+    assert timeRamp == pytest.approx(40 / 10 * 60 + 120)
+    assert estimate_acquisition_duration(queue[2]) < timeRamp < 2 * estimate_acquisition_duration(queue[2])
+    segments, schedule = schedule_temperatures(queue, temperature_current=20, ramp_rate=10, settle_time=120)
+    assert get_segments(segments) == [
+        ("acquisitions", [2]),
+        ("ramp_temperature", 60),
+        ("acquisitions", [3, 4]),
+        ("wait_temperature", 60),
+        ("acquisitions", [1]),
+        ("acquisitions", [5]),
+    ]
+    assert schedule[0]["number_acquisitions_during_ramp"] == 2
+    assert schedule[0]["time_overlapped"] >= timeRamp
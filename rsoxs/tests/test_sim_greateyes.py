@@ -0,0 +1,81 @@
+import time
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from rsoxs.devices.sim_greateyes import SimGreatEyesSensor, edgeEnergy, resonanceEnergy  # noqa: E402
+
+
+def get_ring_radius(sensor, energy):
+    ## Radius (pixels) of the brightest pixels of the scattering rate, away from the beamstop
+    rate = sensor.get_scattering_rate(energy)
+    rows, columns = np.indices(rate.shape)
+    radius = np.hypot(rows + 0.5 - sensor.beam_center[0], columns + 0.5 - sensor.beam_center[1])
+    return np.median(radius[rate > 0.9 * rate.max()])
+
+
+def test_frames_follow_binning_and_region():
+    sensor = SimGreatEyesSensor(shape=(256, 256), seed=0)
+    frame = sensor.make_frame(0.1, bin_x=4, bin_y=2)
+    assert frame.shape == (128, 64)
+    assert frame.dtype == np.uint32
+    assert sensor.make_frame(0.1, bin_x=2, bin_y=2, region=(64, 32, 64, 128)).shape == (32, 64)
+    assert np.array_equal(SimGreatEyesSensor(shape=(64, 64), seed=1).make_frame(1), SimGreatEyesSensor(shape=(64, 64), seed=1).make_frame(1))
+
+
+def test_dark_frames():
+    "Dark frames are the bias plus a dark current that doubles every dark_doubling degrees."
+    sensor = SimGreatEyesSensor(shape=(256, 256), seed=0)
+    assert sensor.get_dark_rate(-80 + sensor.dark_doubling) == pytest.approx(2 * sensor.get_dark_rate(-80))
+    darkCold = sensor.make_frame(10, light=False, temperature=-80)
+    darkWarm = sensor.make_frame(10, light=False, temperature=0)
+    assert darkCold.mean() == pytest.approx(sensor.bias + 10 * sensor.get_dark_rate(-80), abs=1)
+    assert darkWarm.mean() == pytest.approx(sensor.bias + 10 * sensor.get_dark_rate(0), rel=0.01)
+
+
+def test_saturated_pixels_are_clipped():
+    sensor = SimGreatEyesSensor(shape=(256, 256), flux=1e6, full_well=50000, seed=0)
+    frame = sensor.make_frame(10)
+    assert frame.max() == 50000
+
+
+def test_readout_time():
+    "Binning and faster readout modes shorten the readout, and every row is shifted whatever the binning."
+    sensor = SimGreatEyesSensor()
+    assert sensor.get_readout_time(4, 4) < sensor.get_readout_time(2, 2) < sensor.get_readout_time(1, 1)
+    assert sensor.get_readout_time(1, 1, "3 MHz") < sensor.get_readout_time(1, 1, "1 MHz") < sensor.get_readout_time(1, 1, "50 kHz")
+    assert sensor.get_readout_time(64, 64) > sensor.shape[0] * sensor.row_shift_time
+
+
+def test_scattering_follows_energy():
+    "The ring is at a fixed q, so it moves inward at higher energy, and it is strongest at the resonance."
+    sensor = SimGreatEyesSensor(shape=(512, 512), pixel_size=0.06, seed=0)
+    assert get_ring_radius(sensor, 270) > get_ring_radius(sensor, 320)
+    assert sensor.get_scattering_rate(resonanceEnergy).max() > 2 * sensor.get_scattering_rate(edgeEnergy - 10).max()
+
+
+def test_sim_detector_timing():
+    "A trigger is done after the exposure and readout time of the cam settings, and dark frames are taken with the shutter disabled."
+    pytest.importorskip("ophyd")
+    pytest.importorskip("nbs_bl")
+    pytest.importorskip("nslsii")
+    pytest.importorskip("sst_base")
+    from rsoxs.devices.detectors import SimGreatEyes
+
+    detector = SimGreatEyes(name="test_waxs", sensor=SimGreatEyesSensor(seed=0))
+    detector.cam.adc_speed.put("3 MHz")
+    detector.set_exptime(0.2)
+    detector.stage()
+    try:
+        timeStart = time.monotonic()
+        detector.trigger().wait(10)
+        timeAcquisition = time.monotonic() - timeStart
+        assert timeAcquisition >= 0.2 + detector.get_readout_time() - 0.01
+        assert detector.get_frame().shape == detector.sensor.get_binned_shape(detector.binvalue, detector.binvalue)
+        totalLight = detector.stats1.total.get()
+        detector.shutter_off()
+        detector.trigger().wait(10)
+        assert detector.stats1.total.get() < totalLight
+    finally:
+        detector.unstage()